@@ -2,11 +2,14 @@
 
 import argparse
 import os
+import joblib
+import numpy as np
 import pandas as pd
 from inmoose.pycombat import pycombat_norm
 from ml_helpers import *
 
-def load_data(data_location, data_file, index_columns):
+
+def load_data(data_location, data_file, index_columns, file_format="csv"):
     """
     Load metabolite data.
 
@@ -14,16 +17,20 @@ def load_data(data_location, data_file, index_columns):
     - data_location (str): Location of data files.
     - data_file (str): Name of the data file.
     - index_columns (list): List of columns to be used as index.
-    
+    - file_format (str): Format of the data file, one of 'csv', 'parquet' or 'arrow'.
+
     Returns:
     - pd.DataFrame: Loaded metabolite data.
     """
-    df_features = pd.read_csv(
-        os.path.join(data_location, data_file), sep=";", index_col=index_columns
+    df_features = read_table(
+        os.path.join(data_location, data_file), file_format, index_columns
     )
     return df_features
 
-def apply_combat_correction(data, batch_metacol, covariates=None):
+
+def apply_combat_correction(
+    data, batch_metacol, covariates=None, file_format="csv", float_dtype="float64"
+):
     """
     Apply ComBat batch correction using InMoose to the given data.
 
@@ -31,58 +38,403 @@ def apply_combat_correction(data, batch_metacol, covariates=None):
     - data (pd.DataFrame): DataFrame containing the data with a MultiIndex.
     - batch_metacol (str): The name of the metadata column indicating batch information.
     - covariates (pd.Series, optional): Series containing covariates for adjustment. Default is None.
+    - file_format (str): Format of the output file, one of 'csv', 'parquet' or 'arrow'.
+    - float_dtype (str): Floating point precision of the corrected features, float32 or float64.
 
     Returns:
     - None
     """
     try:
         if not isinstance(data.index, pd.MultiIndex):
-            raise ValueError("The input data must have a MultiIndex with 'batch' as one of the levels.")
+            raise ValueError(
+                "The input data must have a MultiIndex with 'batch' as one of the levels."
+            )
 
         batch = data.index.get_level_values(batch_metacol)
 
         if len(batch) != data.shape[0]:
-            raise ValueError("Mismatch between the length of the data and the batch labels.")
+            raise ValueError(
+                "Mismatch between the length of the data and the batch labels."
+            )
 
         if covariates is not None:
             covariates = covariates.loc[data.index]
             if len(covariates) != len(data):
-                raise ValueError("Mismatch between the length of the data and the covariates.")
+                raise ValueError(
+                    "Mismatch between the length of the data and the covariates."
+                )
 
         data_t = data.T
 
-        corrected_data_t = pycombat_norm(
-            data_t,
-            batch=batch.values,
-            covariates=covariates.values.reshape(-1, 1) if covariates is not None else None,
-            ref_batch=None,
-            use_empirical_bayes=True,
-            mean_only=False,
-            verbose=False
+        with profiler.step("combat"):
+            corrected_data_t = pycombat_norm(
+                data_t,
+                batch=batch.values,
+                covariates=covariates.values.reshape(-1, 1)
+                if covariates is not None
+                else None,
+                ref_batch=None,
+                use_empirical_bayes=True,
+                mean_only=False,
+                verbose=False,
+            )
+
+        corrected_data = pd.DataFrame(
+            corrected_data_t.T, index=data.index, columns=data.columns
         )
+        output_file = f"metabolites_batch_corrected{FILE_EXTENSIONS[file_format]}"
+        with profiler.step("write"):
+            write_table(
+                corrected_data, output_file, file_format, float_dtype, index=True
+            )
+        print(f"Batch corrected data saved to {output_file}")
+
+    except Exception as e:
+        print(f"An error occurred during batch correction: {e}")
+        raise
+
+
+def read_chunks(data_file, file_format="csv", chunksize=None):
+    """
+    Read a data file chunk by chunk, or as a single chunk.
+
+    Parameters:
+    - data_file (str): Path to the data file.
+    - file_format (str): Format of the data file, one of 'csv', 'parquet' or 'arrow'.
+    - chunksize (int, optional): Number of rows per chunk. If not provided, the whole file is read at once.
+
+    Yields:
+    - pd.DataFrame: Consecutive rows of the file, with the metadata as columns.
+    """
+    if chunksize:
+        yield from iter_chunks(data_file, file_format, chunksize)
+    else:
+        yield read_table(data_file, file_format)
+
+
+def combat_moments(chunks, index_columns, batch_metacol):
+    """
+    Compute the size, mean and sum of squared deviations of every feature in every batch, chunk by chunk.
+
+    Chunk moments are merged with the pairwise update of Chan et al., which keeps the sums of squares accurate for large feature levels.
+
+    Parameters:
+    - chunks (iterable): pd.DataFrame chunks of the data, with the metadata as columns.
+    - index_columns (list): List of metadata columns, the remaining columns are the features.
+    - batch_metacol (str): The name of the metadata column indicating batch information.
+
+    Returns:
+    - list: Names of the features.
+    - dict: Tuples of size, feature means and feature sums of squared deviations of every batch.
+    """
+    features = None
+    moments = {}
+    for chunk in chunks:
+        if features is None:
+            features = [col for col in chunk.columns if col not in index_columns]
+        values = chunk[features].to_numpy(dtype="float64")
+        batches = chunk[batch_metacol].astype(str).to_numpy()
+        for batch in pd.unique(batches):
+            batch_values = values[batches == batch]
+            n_chunk = len(batch_values)
+            mean_chunk = batch_values.mean(axis=0)
+            m2_chunk = np.square(batch_values - mean_chunk).sum(axis=0)
+            if batch not in moments:
+                moments[batch] = (n_chunk, mean_chunk, m2_chunk)
+                continue
+            n, mean, m2 = moments[batch]
+            delta = mean_chunk - mean
+            n_total = n + n_chunk
+            moments[batch] = (
+                n_total,
+                mean + delta * n_chunk / n_total,
+                m2 + m2_chunk + np.square(delta) * n * n_chunk / n_total,
+            )
+    return features, dict(sorted(moments.items()))
+
+
+def fit_combat(moments, features, ref_batch=None, model=None, conv=0.0001):
+    """
+    Estimate the parametric empirical Bayes ComBat parameters from the batch moments.
+
+    With a batch-only design the location/scale model and its priors depend on the data only through the moments of every batch, so the estimates are those of `pycombat_norm` without covariates.
+    With a reference batch, the data are standardised by the mean and variance of the reference batch and the priors of every other batch are estimated from that batch alone, so new batches can be corrected against a fitted model without re-estimating the batches it already holds.
+
+    Parameters:
+    - moments (dict): Batch moments returned by `combat_moments`.
+    - features (list): Names of the features.
+    - ref_batch (str, optional): Batch left unchanged, the other batches are corrected towards it. Default is None.
+    - model (dict, optional): Previously fitted model. Its batches keep their parameters and the other batches are estimated against its reference batch. Default is None.
+    - conv (float): Convergence criterion of the iterative posterior estimation.
+
+    Returns:
+    - dict: Fitted model, with the features, the reference batch, the features grand mean and pooled variance, and the additive (gamma) and multiplicative (delta) batch effects as pd.DataFrame with one row per batch.
+    """
+    if model is not None:
+        if list(model["features"]) != list(features):
+            raise ValueError(
+                "The features of the data do not match the features of the ComBat model."
+            )
+        ref_batch = model["ref_batch"]
+        grand_mean, var_pooled = model["grand_mean"], model["var_pooled"]
+        moments = {
+            batch: moment
+            for batch, moment in moments.items()
+            if batch not in model["gamma"].index
+        }
+        if moments and ref_batch is None:
+            raise ValueError(
+                "New batches can only be corrected with a ComBat model fitted with a reference batch."
+            )
+    elif ref_batch is not None:
+        if ref_batch not in moments:
+            raise ValueError(f"The reference batch {ref_batch} is not in the data.")
+        n_ref, grand_mean, m2_ref = moments[ref_batch]
+        var_pooled = m2_ref / n_ref
+    else:
+        n_total = sum(n for n, _, _ in moments.values())
+        grand_mean = sum(n * mean for n, mean, _ in moments.values()) / n_total
+        var_pooled = sum(m2 for _, _, m2 in moments.values()) / n_total
+
+    gamma, delta = {}, {}
+    if ref_batch in moments:
+        gamma[ref_batch] = np.zeros(len(features))
+        delta[ref_batch] = np.ones(len(features))
+    for batch, (n, mean, m2) in moments.items():
+        if batch == ref_batch:
+            continue
+        gamma_hat = (mean - grand_mean) / np.sqrt(var_pooled)
+        delta_hat = m2 / n / var_pooled
+        gamma_bar, t2 = gamma_hat.mean(), gamma_hat.var()
+        a_prior = (2 * delta_hat.var() + delta_hat.mean() ** 2) / delta_hat.var()
+        b_prior = (
+            delta_hat.mean() * delta_hat.var() + delta_hat.mean() ** 3
+        ) / delta_hat.var()
+
+        # sums of the standardised data and of its squares in the batch
+        s_sum = n * gamma_hat
+        s_squares = n * (delta_hat + gamma_hat**2)
 
-        corrected_data = pd.DataFrame(corrected_data_t.T, index=data.index, columns=data.columns)
-        # corrected_data.to_parquet("metabolites_processed.parquet", index=True)
-        corrected_data.to_csv("metabolites_batch_corrected.txt", sep=";", index=True)
-        print("Batch corrected data saved to metabolites_batch_corrected.txt")
+        g_old, d_old = gamma_hat, delta_hat
+        change = 1
+        while change > conv:
+            g_new = (t2 * n * gamma_hat + d_old * gamma_bar) / (t2 * n + d_old)
+            sum2 = s_squares - 2 * g_new * s_sum + n * g_new**2
+            d_new = (0.5 * sum2 + b_prior) / (0.5 * n + a_prior - 1)
+            change = max(
+                np.amax(np.absolute(g_new - g_old) / g_old),
+                np.amax(np.absolute(d_new - d_old) / d_old),
+            )
+            g_old, d_old = g_new, d_new
+        gamma[batch], delta[batch] = g_new, d_new
+
+    gamma = pd.DataFrame.from_dict(gamma, orient="index", columns=features)
+    delta = pd.DataFrame.from_dict(delta, orient="index", columns=features)
+    if model is not None:
+        gamma = pd.concat([model["gamma"], gamma])
+        delta = pd.concat([model["delta"], delta])
+
+    return {
+        "features": list(features),
+        "ref_batch": ref_batch,
+        "grand_mean": grand_mean,
+        "var_pooled": var_pooled,
+        "gamma": gamma,
+        "delta": delta,
+    }
+
+
+def chunked_combat_correction(
+    data_file,
+    index_columns,
+    batch_metacol,
+    file_format="csv",
+    float_dtype="float64",
+    chunksize=1000,
+    ref_batch=None,
+    model=None,
+):
+    """
+    Apply ComBat batch correction chunk by chunk, without loading the data into memory.
+
+    A first pass over the data collects the batch moments the ComBat parameters are estimated from, a second pass corrects every chunk and appends it to the output file, so memory stays bounded by one chunk.
+    With a fitted model, only the batches it does not hold are estimated, in time proportional to their size.
+
+    Parameters:
+    - data_file (str): Path to the data file.
+    - index_columns (list): List of metadata columns, the remaining columns are the features.
+    - batch_metacol (str): The name of the metadata column indicating batch information.
+    - file_format (str): Format of the input and output files, one of 'csv', 'parquet' or 'arrow'.
+    - float_dtype (str): Floating point precision of the corrected features, float32 or float64.
+    - chunksize (int, optional): Number of rows per chunk. If not provided, the data are read at once.
+    - ref_batch (str, optional): Batch left unchanged, the other batches are corrected towards it. Default is None.
+    - model (dict, optional): Previously fitted model returned by `fit_combat`. Default is None.
+
+    Returns:
+    - dict: Fitted model.
+    """
+    try:
+        with profiler.step("combat"):
+            features, moments = combat_moments(
+                read_chunks(data_file, file_format, chunksize),
+                index_columns,
+                batch_metacol,
+            )
+            model = fit_combat(moments, features, ref_batch, model)
+        grand_mean = model["grand_mean"]
+        scale = np.sqrt(model["var_pooled"])
+
+        output_file = f"metabolites_batch_corrected{FILE_EXTENSIONS[file_format]}"
+        with profiler.step("write"), table_writer(
+            output_file, file_format, float_dtype
+        ) as write:
+            for chunk in read_chunks(data_file, file_format, chunksize):
+                batches = chunk[batch_metacol].astype(str).to_numpy()
+                values = chunk[features].to_numpy(dtype="float64")
+                gamma = model["gamma"].loc[batches].to_numpy()
+                delta = model["delta"].loc[batches].to_numpy()
+                corrected = ((values - grand_mean) / scale - gamma) / np.sqrt(
+                    delta
+                ) * scale + grand_mean
+                # the reference batch is kept as is
+                corrected[batches == model["ref_batch"]] = values[
+                    batches == model["ref_batch"]
+                ]
+                metadata = chunk[[col for col in index_columns if col in chunk.columns]]
+                write(
+                    pd.concat(
+                        [
+                            metadata,
+                            pd.DataFrame(
+                                corrected, index=chunk.index, columns=features
+                            ),
+                        ],
+                        axis=1,
+                    )
+                )
+        print(f"Batch corrected data saved to {output_file}")
+        return model
 
     except Exception as e:
         print(f"An error occurred during batch correction: {e}")
+        raise
+
 
 def main(args):
-    index_columns = [col for col in [args.batch_metacol, args.patient_metacol, args.disease_metacol] if col]
-    data = load_data(args.data_location, args.data_file, index_columns)
-    covariates = pd.Series(args.covariates) if args.covariates else None
-    apply_combat_correction(data, args.batch_metacol, covariates)
+    index_columns = [
+        col
+        for col in [args.batch_metacol, args.patient_metacol, args.disease_metacol]
+        if col
+    ]
+    data_file = os.path.join(args.data_location, args.data_file)
+    model = joblib.load(args.apply_model) if args.apply_model else None
+    # the reference batch adjustment of pycombat_norm fails, so it is applied from the batch moments
+    if args.chunksize or args.ref_batch or model is not None:
+        if args.covariates:
+            print(
+                "Covariates are not supported by the chunked or reference batch correction, they are ignored."
+            )
+        model = chunked_combat_correction(
+            data_file,
+            index_columns,
+            args.batch_metacol,
+            args.format,
+            args.float_dtype,
+            args.chunksize,
+            args.ref_batch,
+            model,
+        )
+    else:
+        with profiler.step("load"):
+            data = load_data(
+                args.data_location, args.data_file, index_columns, args.format
+            )
+        covariates = pd.Series(args.covariates) if args.covariates else None
+        apply_combat_correction(
+            data, args.batch_metacol, covariates, args.format, args.float_dtype
+        )
+        if args.save_model:
+            with profiler.step("fit_model"):
+                features, moments = combat_moments(
+                    [data.reset_index()], index_columns, args.batch_metacol
+                )
+                model = fit_combat(moments, features)
+    if args.save_model and model is not None:
+        joblib.dump(model, args.save_model)
+        print(f"ComBat model saved to {args.save_model}")
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Apply ComBat batch correction to metabolomics data.")
-    parser.add_argument("--data_location", type=str, default="", help="Location of data files.")
-    parser.add_argument("--data_file", type=str, required=True, help="Name of the data file.")
-    parser.add_argument("--disease_metacol", type=str, help="Name of the disease metadata column.")
-    parser.add_argument("--batch_metacol", type=str, help="Name of the batch metadata column.")
-    parser.add_argument("--patient_metacol", type=str, required=True, help="Name of the patient metadata column.")
-    parser.add_argument("--covariates", nargs='+', type=float, help="List of covariates for adjustment.")
-    
+    parser = argparse.ArgumentParser(
+        description="Apply ComBat batch correction to metabolomics data."
+    )
+    parser.add_argument(
+        "--data_location", type=str, default="", help="Location of data files."
+    )
+    parser.add_argument(
+        "--data_file", type=str, required=True, help="Name of the data file."
+    )
+    parser.add_argument(
+        "--disease_metacol", type=str, help="Name of the disease metadata column."
+    )
+    parser.add_argument(
+        "--batch_metacol", type=str, help="Name of the batch metadata column."
+    )
+    parser.add_argument(
+        "--patient_metacol",
+        type=str,
+        required=True,
+        help="Name of the patient metadata column.",
+    )
+    parser.add_argument(
+        "--covariates", nargs="+", type=float, help="List of covariates for adjustment."
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(FILE_EXTENSIONS),
+        default="csv",
+        help="Format of the input and output data files.",
+    )
+    parser.add_argument(
+        "--float_dtype",
+        choices=["float64", "float32"],
+        default="float64",
+        help="Floating point precision of the corrected features.",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Number of rows per chunk. If provided, the ComBat parameters are estimated in a first pass over the data and the corrected chunks are appended to the output in a second one, without loading the data into memory. Covariates are not supported.",
+    )
+    parser.add_argument(
+        "--ref_batch",
+        type=str,
+        help="Batch left unchanged, the other batches are corrected towards it. Required to correct new batches with a saved model.",
+    )
+    parser.add_argument(
+        "--save_model",
+        type=str,
+        help="Path to the file where the fitted ComBat model is saved. If empty, the model is not saved.",
+    )
+    parser.add_argument(
+        "--apply_model",
+        type=str,
+        help="Path to a saved ComBat model. If provided, its batches are corrected with the stored parameters and only new batches are estimated, against the reference batch of the model.",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=0,
+        help="Number of CPUs shared by the parallel jobs and the BLAS threads. If 0, the NASQQ_CPUS environment variable or all available CPUs.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        help="Path to the JSON file with the time and peak memory of each step. If empty, the metrics are not saved.",
+    )
+
     args = parser.parse_args()
+    profiler.configure("batch_correction", args.metrics_file)
+    args.n_jobs = parallelism.configure(args.n_jobs)
     main(args)
+    profiler.write()
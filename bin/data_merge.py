@@ -2,9 +2,19 @@
 import argparse
 import pandas as pd
 import numpy as np
-
-
-def merge_files(txt_file, csv_file, output_file, batch_value, log1p, metadata_column):
+from script_helpers import FILE_EXTENSIONS, parallelism, profiler, write_table
+
+
+def merge_files(
+    txt_file,
+    csv_file,
+    output_file,
+    batch_value,
+    log1p,
+    metadata_column,
+    file_format="csv",
+    float_dtype="float64",
+):
     """Merge data from a text file and a CSV file based on specified columns.
 
     Parameters:
@@ -14,39 +24,45 @@ def merge_files(txt_file, csv_file, output_file, batch_value, log1p, metadata_co
     - batch_value (str): Value to be added in the 'batch' column of the text file.
     - log1p (bool): If True, apply log(1 + x) transformation to numeric columns.
     - metadata_column (str): Name of the column to be placed third in the merged DataFrame.
+    - file_format (str): Format of the output file, one of 'csv', 'parquet' or 'arrow'.
+    - float_dtype (str): Floating point precision of the features, float32 or float64.
 
     Returns:
     - pd.DataFrame: Merged DataFrame.
 
     """
-    df_txt = pd.read_csv(txt_file, sep=",", dtype={"patient_no": str})
-    df_csv = pd.read_csv(csv_file, dtype={"patient_no": str})
-
-    df_txt["batch"] = str(batch_value)
-
-    columns_to_convert = ["patient_no", "batch"]
-    for col in columns_to_convert:
-        df_txt[col] = df_txt[col].astype(str).str.strip()
-        df_csv[col] = df_csv[col].astype(str).str.strip()
-
-    merged_df = pd.merge(df_txt, df_csv, on=["patient_no", "batch"])
-    cols = ["patient_no", "batch", metadata_column] + [
-        col
-        for col in merged_df.columns
-        if col not in ["patient_no", "batch", metadata_column]
-    ]
-    merged_df = merged_df[cols]
-
-    if log1p:
-        numeric_cols = merged_df.select_dtypes(include=[np.number]).columns
-        merged_df[numeric_cols] = np.log1p(merged_df[numeric_cols])
-
+    with profiler.step("load"):
+        df_txt = pd.read_csv(txt_file, sep=",", dtype={"patient_no": str})
+        df_csv = pd.read_csv(csv_file, dtype={"patient_no": str})
+
+    with profiler.step("merge"):
+        df_txt["batch"] = str(batch_value)
+
+        columns_to_convert = ["patient_no", "batch"]
+        for col in columns_to_convert:
+            df_txt[col] = df_txt[col].astype(str).str.strip()
+            df_csv[col] = df_csv[col].astype(str).str.strip()
+
+        merged_df = pd.merge(df_txt, df_csv, on=["patient_no", "batch"])
+        cols = ["patient_no", "batch", metadata_column] + [
+            col
+            for col in merged_df.columns
+            if col not in ["patient_no", "batch", metadata_column]
+        ]
+        merged_df = merged_df[cols]
+
+        if log1p:
+            numeric_cols = merged_df.select_dtypes(include=[np.number]).columns
+            merged_df[numeric_cols] = np.log1p(merged_df[numeric_cols])
+
+    extension = FILE_EXTENSIONS[file_format]
     output_file_final = (
         output_file
         if batch_value != "None"
-        else output_file.replace(".txt", "_without_merge.txt")
+        else output_file.replace(extension, f"_without_merge{extension}")
     )
-    merged_df.to_csv(output_file_final, sep=";", index=False)
+    with profiler.step("write"):
+        write_table(merged_df, output_file_final, file_format, float_dtype)
     return merged_df
 
 
@@ -65,8 +81,32 @@ def main():
         help="Apply log1p transformation to numeric columns",
     )
     parser.add_argument("metadata_column", type=str, help="Name of the metadata column")
+    parser.add_argument(
+        "--format",
+        choices=list(FILE_EXTENSIONS),
+        default="csv",
+        help="Format of the output file",
+    )
+    parser.add_argument(
+        "--float_dtype",
+        choices=["float64", "float32"],
+        default="float64",
+        help="Floating point precision of the features in the output file",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=0,
+        help="Number of CPUs shared by the parallel jobs and the BLAS threads. If 0, the NASQQ_CPUS environment variable or all available CPUs.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Path to the JSON file with the time and peak memory of each step. If empty, the metrics are not saved.",
+    )
 
     args = parser.parse_args()
+    profiler.configure("data_merge", args.metrics_file)
+    parallelism.configure(args.n_jobs)
     log1p = args.log1p.lower() == "true" if args.log1p else False
 
     merged_dataframe = merge_files(
@@ -76,7 +116,10 @@ def main():
         args.batch_value,
         log1p,
         args.metadata_column,
+        args.format,
+        args.float_dtype,
     )
+    profiler.write()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@ import sys
 sys.path.append("/bin")
 import os
 import argparse
+import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
@@ -46,6 +47,85 @@ def load_data(
     return df_features_proc, index_columns
 
 
+def compute_pca(scaled_data, svd_solver="full", n_components=10):
+    """Compute PCA with all valid components or only the leading ones.
+
+    With the "randomized" or "arpack" solvers only the leading components are
+    computed, and the explained variance ratios are taken relative to the total
+    variance of the data, obtained from the column variances without a full
+    decomposition.
+
+    Parameters:
+    - scaled_data (np.ndarray): Standardized metabolite data.
+    - svd_solver (str): "full" to compute all components, "randomized" or "arpack"
+      to compute only the leading ones.
+    - n_components (int): Number of leading components computed by the truncated
+      solvers.
+
+    Returns:
+    - np.ndarray: PCA results.
+    - np.ndarray: Explained variance ratio for each principal component.
+
+    """
+    valid_n_components = min(scaled_data.shape[0], scaled_data.shape[1])
+    if svd_solver == "full":
+        pca = PCA(n_components=valid_n_components)
+        pca_result = pca.fit_transform(scaled_data)
+        return pca_result, pca.explained_variance_ratio_
+
+    if svd_solver == "arpack":
+        valid_n_components -= 1
+    pca = PCA(
+        n_components=min(n_components, valid_n_components),
+        svd_solver=svd_solver,
+        random_state=0,
+    )
+    pca_result = pca.fit_transform(scaled_data)
+    total_variance = np.var(scaled_data, axis=0, ddof=1).sum()
+    return pca_result, pca.explained_variance_ / total_variance
+
+
+def write_eda_tables(
+    pca_result,
+    explained_variance_ratio,
+    df,
+    df_patients,
+    patient_metacol,
+    results_location,
+    max_samples=None,
+    method="pearson",
+):
+    """Save the tables underlying the exploratory figures instead of the figures.
+
+    Parameters:
+    - pca_result (np.ndarray): PCA results.
+    - explained_variance_ratio (np.ndarray): Explained variance ratio for each principal component.
+    - df (pd.DataFrame): Input DataFrame.
+    - df_patients (pd.DataFrame): Input DataFrame indexed for the patient correlations.
+    - patient_metacol (str or pd.Index): Patient metadata column of df_patients.
+    - results_location (str): Path to the directory where the tables will be saved.
+    - max_samples (int, optional): Maximum number of samples in the correlation tables.
+    - method (str): Correlation coefficient, pearson or spearman.
+
+    """
+    tables_location = os.path.join(results_location, "tables")
+    pd.DataFrame(
+        {"explained_variance_ratio": explained_variance_ratio},
+        index=pd.Index(range(1, len(explained_variance_ratio) + 1), name="PC"),
+    ).to_csv(os.path.join(tables_location, "pca_explained_variance.csv"))
+    pd.DataFrame(
+        pca_result,
+        index=df.index,
+        columns=[f"PC {i + 1}" for i in range(pca_result.shape[1])],
+    ).to_csv(os.path.join(tables_location, "pca_scores.csv"))
+
+    features_corr, patients_corr = correlation_matrices(
+        df_patients, patient_metacol, max_samples=max_samples, method=method
+    )
+    features_corr.to_csv(os.path.join(tables_location, "correlation_features.csv"))
+    patients_corr.to_csv(os.path.join(tables_location, "correlation_patients.csv"))
+
+
 def main(args):
     """Main function to process and analyze metabolite data.
 
@@ -55,21 +135,57 @@ def main(args):
     """
     create_results_dir(args.results_location)
 
-    df_features_proc, index_columns = load_data(
-        args.data_location,
-        args.results_location,
-        args.disease_metacol,
-        args.batch_metacol,
-        args.patient_metacol,
-        args.data_file,
-    )
+    with profiler.step("load"):
+        df_features_proc, index_columns = load_data(
+            args.data_location,
+            args.results_location,
+            args.disease_metacol,
+            args.batch_metacol,
+            args.patient_metacol,
+            args.data_file,
+        )
 
-    scaler = StandardScaler()
-    scaled_data = scaler.fit_transform(df_features_proc)
-    valid_n_components = min(scaled_data.shape[0], scaled_data.shape[1])
-    pca = PCA(n_components=valid_n_components)
-    pca_result = pca.fit_transform(scaled_data)
-    explained_variance_ratio = pca.explained_variance_ratio_
+    cache = ResultsCache(args.cache_dir, args.cache_size)
+    with profiler.step("scaling"):
+        scaled_data = cache.get_or_compute(
+            "scaled",
+            lambda: StandardScaler().fit_transform(df_features_proc),
+            args.data_file,
+        )
+    with profiler.step("pca"):
+        pca_result, explained_variance_ratio = cache.get_or_compute(
+            "pca",
+            lambda: compute_pca(scaled_data, args.pca_solver, args.pca_components),
+            args.data_file,
+            pca_solver=args.pca_solver,
+            pca_components=args.pca_components,
+        )
+
+    if args.batch_metacol is not None:
+        patient_batch_index = df_features_proc.index.get_level_values('patient_no').astype(str) + '_' + df_features_proc.index.get_level_values('batch').astype(str)
+        df_patients = df_features_proc.set_index(patient_batch_index)
+        patient_metacol = patient_batch_index
+    else:
+        df_patients = df_features_proc
+        patient_metacol = args.patient_metacol
+
+    if args.figure_format == "none":
+        with profiler.step("write_tables"):
+            write_eda_tables(
+                pca_result=pca_result,
+                explained_variance_ratio=explained_variance_ratio,
+                df=df_features_proc,
+                df_patients=df_patients,
+                patient_metacol=patient_metacol,
+                results_location=args.results_location,
+                max_samples=args.clustermap_max_samples,
+                method=args.correlation_method,
+            )
+        return
+
+    figure_options = dict(
+        figure_format=args.figure_format, raster_threshold=args.raster_threshold
+    )
 
     create_pca_explained_variance_plot(
         explained_variance_ratio=explained_variance_ratio,
@@ -82,6 +198,7 @@ def main(args):
         df=df_features_proc,
         metacol=args.disease_metacol,
         results_location=args.results_location,
+        **figure_options,
     )
 
     create_distribution_plots(
@@ -89,6 +206,7 @@ def main(args):
         index_columns=index_columns,
         metacol=args.disease_metacol,
         results_location=args.results_location,
+        **figure_options,
     )
 
     if args.batch_metacol is not None:
@@ -98,26 +216,24 @@ def main(args):
             df=df_features_proc,
             metacol=args.batch_metacol,
             results_location=args.results_location,
+            **figure_options,
         )
         create_distribution_plots(
             df=df_features_proc,
             index_columns=index_columns,
             metacol=args.batch_metacol,
             results_location=args.results_location,
+            **figure_options,
         )
-        
-        patient_batch_index = df_features_proc.index.get_level_values('patient_no').astype(str) + '_' + df_features_proc.index.get_level_values('batch').astype(str)
-        create_clustermaps(
-            df=df_features_proc.set_index(patient_batch_index),
-            patient_metacol=patient_batch_index,
-            results_location=args.results_location,
-        )
-    else:
-        create_clustermaps(
-            df=df_features_proc,
-            patient_metacol=args.patient_metacol,
-            results_location=args.results_location,
-        )
+
+    create_clustermaps(
+        df=df_patients,
+        patient_metacol=patient_metacol,
+        results_location=args.results_location,
+        max_samples=args.clustermap_max_samples,
+        method=args.correlation_method,
+        **figure_options,
+    )
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process and analyze metabolite data.")
@@ -136,6 +252,65 @@ if __name__ == "__main__":
     parser.add_argument(
         "--patient_metacol", required=True, help="Name of the patient metadata column."
     )
+    parser.add_argument(
+        "--pca_solver",
+        choices=["full", "randomized", "arpack"],
+        default="full",
+        help="PCA solver, randomized and arpack compute only the leading components.",
+    )
+    parser.add_argument(
+        "--pca_components",
+        type=int,
+        default=10,
+        help="Number of leading components computed by the randomized and arpack solvers.",
+    )
+    parser.add_argument(
+        "--figure_format",
+        choices=["svg", "png", "auto", "none"],
+        default="svg",
+        help="Format of the figures: svg, png, svg with rasterized data above --raster_threshold drawn elements (auto), or none to save only the underlying tables.",
+    )
+    parser.add_argument(
+        "--raster_threshold",
+        type=int,
+        default=10000,
+        help="Number of points or heatmap cells above which auto figures are rasterized.",
+    )
+    parser.add_argument(
+        "--clustermap_max_samples",
+        type=int,
+        default=0,
+        help="Maximum number of randomly selected samples in the correlation clustermaps. If 0, all samples are used.",
+    )
+    parser.add_argument(
+        "--correlation_method",
+        choices=["pearson", "spearman"],
+        default="pearson",
+        help="Correlation coefficient of the clustermaps, spearman correlates the ranks of the data, computed once.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the cache of intermediate results. If empty, caching is disabled.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=2048,
+        help="Maximum size of the cache in megabytes.",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=0,
+        help="Number of CPUs shared by the parallel jobs and the BLAS threads. If 0, the NASQQ_CPUS environment variable or all available CPUs.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Path to the JSON file with the time and peak memory of each step. If empty, the metrics are not saved.",
+    )
 
     args = parser.parse_args()
+    profiler.configure("exploratory_data_analysis", args.metrics_file)
+    args.n_jobs = parallelism.configure(args.n_jobs)
     main(args)
+    profiler.write()
@@ -11,51 +11,131 @@ os.environ["FONTCONFIG_PATH"] = "fontconfig_cache"
 import numpy as np
 import pandas as pd
 import argparse
-from ml_helpers import create_results_dir, metadata_check
+from ml_helpers import (
+    FILE_EXTENSIONS,
+    ResultsCache,
+    create_results_dir,
+    iter_chunks,
+    metadata_check,
+    parallelism,
+    profiler,
+    read_table,
+)
 
 
-def load_and_process_data(data_location, data_file, index_columns, zeronan_threshold):
-    """Load and preprocess metabolite data.
+def zeronan_counts(df):
+    """Count zero and NaN values of every numeric column in a single pass.
 
     Parameters:
-    - data_location (str): Location of data files.
-    - data_file (str): Name of the data file.
-    - index_columns (list): List of columns to be used as index.
+    - df (pd.DataFrame): Metabolite data.
+
+    Returns:
+    - pd.DataFrame: Number of zero, NaN and zero or NaN values of each numeric column.
+
+    """
+    numeric = df.select_dtypes(include=np.number)
+    values = numeric.to_numpy(dtype=np.float64)
+    is_zero = values == 0
+    is_nan = np.isnan(values)
+    return pd.DataFrame(
+        {
+            "zero": is_zero.sum(axis=0),
+            "nan": is_nan.sum(axis=0),
+            "zeronan": (is_zero | is_nan).sum(axis=0),
+        },
+        index=numeric.columns,
+    )
+
+
+def zeronan_summary(counts, n_rows, zeronan_threshold):
+    """Turn zero and NaN counts into fractions and flag the columns to remove.
+
+    Columns with all zeros, or with a fraction of zero or NaN values above the
+    threshold are removed.
+
+    Parameters:
+    - counts (pd.DataFrame): Counts returned by `zeronan_counts`.
+    - n_rows (int): Number of rows the counts were computed on.
     - zeronan_threshold (float): Threshold for zero or NaN values.
 
     Returns:
-    - pd.DataFrame: Processed metabolite data.
+    - pd.DataFrame: Zero, NaN and zero or NaN fractions and removal flag of each feature.
 
     """
-    df_features = pd.read_csv(
-        os.path.join(data_location, data_file), sep=";", index_col=index_columns
+    summary = pd.DataFrame(
+        {
+            "zero_fraction": counts["zero"] / n_rows,
+            "nan_fraction": counts["nan"] / n_rows,
+            "zeronan_fraction": counts["zeronan"] / n_rows,
+        }
+    )
+    summary["removed"] = (counts["zero"] == n_rows) | (
+        summary["zeronan_fraction"] > zeronan_threshold
     )
+    return summary.rename_axis("Feature")
 
-    # Drop columns with all zeros
-    columns_with_zeros = df_features.columns[df_features.eq(0).all()]
-    df_features.drop(columns=columns_with_zeros, inplace=True)
 
-    cols_to_remove = []
+def load_and_process_data(
+    data_location,
+    data_file,
+    index_columns,
+    zeronan_threshold,
+    file_format="csv",
+    chunksize=None,
+    return_summary=False,
+):
+    """Load and preprocess metabolite data.
 
-    for col in df_features.columns:
-        # Skip non-numeric columns
-        if not np.issubdtype(df_features[col].dtype, np.number):
-            continue
+    Parameters:
+    - data_location (str): Location of data files.
+    - data_file (str): Name of the data file.
+    - index_columns (list): List of columns to be used as index.
+    - zeronan_threshold (float): Threshold for zero or NaN values.
+    - file_format (str): Format of the data file, one of 'csv', 'parquet' or 'arrow'.
+    - chunksize (int, optional): Number of rows per chunk. If provided, zero and NaN
+                                 values are counted chunk by chunk and only the kept
+                                 columns are loaded.
+    - return_summary (bool): Whether to also return the per-feature summary.
 
-        zero_percentage = (df_features[col] == 0).mean()
-        nan_percentage = (df_features[col].isna()).mean()
-        zeronan_percentage = (
-            (df_features[col].isna()) | (df_features[col] == 0)
-        ).mean()
+    Returns:
+    - pd.DataFrame: Processed metabolite data.
+    - pd.DataFrame: Zero and NaN fractions of each feature, if return_summary is True.
 
-        if (zero_percentage > zeronan_threshold) or (
-            nan_percentage > zeronan_threshold
-        ):
-            cols_to_remove.append(col)
-        elif zeronan_percentage > zeronan_threshold:
-            cols_to_remove.append(col)
+    """
+    file_path = os.path.join(data_location, data_file)
+    if chunksize:
+        counts, n_rows, columns = None, 0, None
+        for chunk in iter_chunks(file_path, file_format, chunksize):
+            chunk = chunk.set_index(index_columns)
+            chunk_counts = zeronan_counts(chunk)
+            counts = (
+                chunk_counts
+                if counts is None
+                else counts.add(chunk_counts, fill_value=0)
+            )
+            n_rows += len(chunk)
+            columns = chunk.columns
+        summary = zeronan_summary(
+            counts.reindex([col for col in columns if col in counts.index]),
+            n_rows,
+            zeronan_threshold,
+        )
+        removed = summary.index[summary["removed"]]
+        df_features_proc = read_table(
+            file_path,
+            file_format,
+            index_columns,
+            columns=[col for col in columns if col not in removed],
+        )
+    else:
+        df_features = read_table(file_path, file_format, index_columns)
+        summary = zeronan_summary(
+            zeronan_counts(df_features), len(df_features), zeronan_threshold
+        )
+        df_features_proc = df_features.drop(columns=summary.index[summary["removed"]])
 
-    df_features_proc = df_features.drop(columns=list(set(cols_to_remove)))
+    if return_summary:
+        return df_features_proc, summary
     return df_features_proc
 
 
@@ -74,19 +154,46 @@ def main(args):
         if metacol is not None
     ]
 
-    df_features_proc = load_and_process_data(
-        args.data_location, args.data_file, index_columns, args.zeronan_threshold
-    )
-
-    metadata_check(df_features_proc, args.disease_metacol)
+    cache = ResultsCache(args.cache_dir, args.cache_size)
+    with profiler.step("load_and_filter"):
+        df_features_proc, summary = cache.get_or_compute(
+            "features_processing",
+            lambda: load_and_process_data(
+                args.data_location,
+                args.data_file,
+                index_columns,
+                args.zeronan_threshold,
+                args.format,
+                args.chunksize,
+                return_summary=True,
+            ),
+            os.path.join(args.data_location, args.data_file),
+            index_columns=index_columns,
+            zeronan_threshold=args.zeronan_threshold,
+            format=args.format,
+        )
 
-    df_features_proc.to_parquet(
-        path=os.path.join(
-            args.results_location, "tables", "metabolites_processed.parquet"
-        ),
-        index=True,
+    metadata_check(
+        df_features_proc, args.disease_metacol, multi_state=args.contrasts != "binary"
     )
 
+    with profiler.step("write"):
+        df_features_proc.to_parquet(
+            path=os.path.join(
+                args.results_location, "tables", "metabolites_processed.parquet"
+            ),
+            index=True,
+        )
+        summary.to_csv(
+            os.path.join(
+                args.results_location, "tables", "features_zeronan_summary.csv"
+            ),
+            header=True,
+            sep=",",
+            index=True,
+            encoding="utf-8",
+        )
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process and analyze metabolite data.")
@@ -111,8 +218,48 @@ if __name__ == "__main__":
         default=0.7,
         help="Threshold for zero or NaN values. Must be a float.",
     )
+    parser.add_argument(
+        "--format",
+        choices=list(FILE_EXTENSIONS),
+        default="csv",
+        help="Format of the data file.",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Number of rows per chunk to filter files larger than memory.",
+    )
+    parser.add_argument(
+        "--contrasts",
+        choices=["binary", "pairwise", "one_vs_rest"],
+        default="binary",
+        help="Contrasts of the univariate analysis, binary requires exactly two disease states and the others at least two.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the cache of intermediate results. If empty, caching is disabled.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=2048,
+        help="Maximum size of the cache in megabytes.",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=0,
+        help="Number of CPUs shared by the parallel jobs and the BLAS threads. If 0, the NASQQ_CPUS environment variable or all available CPUs.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Path to the JSON file with the time and peak memory of each step. If empty, the metrics are not saved.",
+    )
 
     args = parser.parse_args()
     os.makedirs(args.results_location, exist_ok=True)
+    profiler.configure("features_processing", args.metrics_file)
+    args.n_jobs = parallelism.configure(args.n_jobs)
 
     main(args)
+    profiler.write()
@@ -4,31 +4,194 @@ import argparse
 import pandas as pd
 import glob
 import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from script_helpers import (
+    FILE_EXTENSIONS,
+    iter_chunks,
+    parallelism,
+    profiler,
+    read_table,
+    write_table,
+)
 
 
-def merge_csv_files(folder_path, output_name):
+def read_columns(file, file_format="csv"):
+    """Read the column names of a data file without loading its values.
+
+    Parameters:
+    - file (str): Path to the data file.
+    - file_format (str): Format of the file, one of 'csv', 'parquet' or 'arrow'.
+
+    Returns:
+    - list: Column names of the file.
+    - dict: Arrow types of the columns, empty for csv files.
+
+    """
+    if file_format == "csv":
+        return pd.read_csv(file, sep=";", nrows=0).columns.tolist(), {}
+    if file_format == "parquet":
+        schema = pq.read_schema(file)
+    else:
+        with pa.memory_map(file) as source:
+            schema = pa.ipc.open_file(source).schema
+    return schema.names, {field.name: field.type for field in schema}
+
+
+def _is_numeric_type(arrow_type):
+    """Check whether an Arrow type is numeric, unknown types (csv) count as numeric."""
+    return (
+        arrow_type is None
+        or pa.types.is_integer(arrow_type)
+        or pa.types.is_floating(arrow_type)
+    )
+
+
+def stream_merge_files(
+    file_list, output_name, file_format="csv", float_dtype="float64", chunksize=1000
+):
+    """Merge data files chunk by chunk, keeping at most one chunk in memory.
+
+    A first pass reads only the column names to build the union of the columns,
+    then every file is aligned to it and appended to the output chunk by chunk,
+    with missing values filled with zeros.
+
+    Parameters:
+    - file_list (list): Paths to the data files to merge.
+    - output_name (str): Path to the output file.
+    - file_format (str): Format of the input and output files, one of 'csv', 'parquet'
+                         or 'arrow'.
+    - float_dtype (str): Floating point precision of the features, float32 or float64.
+    - chunksize (int): Number of rows per chunk.
+
+    """
+    columns, types, counts = [], {}, {}
+    for file in file_list:
+        file_columns, file_types = read_columns(file, file_format)
+        for col in file_columns:
+            col_type = file_types.get(col)
+            if col not in counts:
+                columns.append(col)
+                counts[col] = 0
+                types[col] = col_type
+            elif types[col] != col_type:
+                both_numeric = _is_numeric_type(types[col]) and _is_numeric_type(
+                    col_type
+                )
+                types[col] = pa.float64() if both_numeric else pa.string()
+            counts[col] += 1
+
+    # As in pandas concatenation, numeric columns missing from some of the files
+    # become float once the gaps are filled with zeros.
+    for col in columns:
+        if counts[col] < len(file_list) and _is_numeric_type(types[col]):
+            types[col] = pa.float64()
+    float_columns = [
+        col
+        for col in columns
+        if types[col] is not None and pa.types.is_floating(types[col])
+    ]
+    missing_columns = [col for col in columns if counts[col] < len(file_list)]
+    string_columns = [
+        col
+        for col in columns
+        if types[col] is not None and pa.types.is_string(types[col])
+    ]
+
+    writer = None
+    if file_format == "parquet" or file_format == "arrow":
+        schema = pa.schema(
+            [
+                (
+                    pa.field(col, pa.from_numpy_dtype(np.dtype(float_dtype)))
+                    if col in float_columns
+                    else pa.field(col, types[col])
+                )
+                for col in columns
+            ]
+        )
+        if file_format == "parquet":
+            writer = pq.ParquetWriter(output_name, schema)
+        else:
+            writer = pa.ipc.new_file(output_name, schema)
+
+    try:
+        header = True
+        for file in file_list:
+            for chunk in iter_chunks(file, file_format, chunksize):
+                chunk = chunk.reindex(columns=columns).fillna(0)
+                chunk = chunk.astype(
+                    {
+                        col: "float64"
+                        for col in float_columns + missing_columns
+                        if pd.api.types.is_numeric_dtype(chunk[col])
+                    }
+                )
+                chunk = chunk.astype(
+                    {
+                        col: float_dtype
+                        for col in chunk.select_dtypes(include="floating").columns
+                    }
+                )
+                if writer is None:
+                    chunk.to_csv(
+                        output_name,
+                        sep=";",
+                        index=False,
+                        header=header,
+                        mode="w" if header else "a",
+                    )
+                    header = False
+                else:
+                    chunk = chunk.astype({col: str for col in string_columns})
+                    writer.write_table(
+                        pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                    )
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def merge_csv_files(
+    folder_path, output_name, file_format="csv", float_dtype="float64", chunksize=None
+):
     """Merge data from multiple CSV files in the current directory into a single CSV
     file.
 
     Parameters:
     - folder_path (str): Name of the folder with input TSV files containing the merged features and metadata.
     - output_name (str): Name of the output TXT file containing the merged data. If the file
-                        extension is not provided, '.txt' will be appended.
+                        extension is not provided, the extension of the format
+                        ('.txt' for csv) will be appended.
+    - file_format (str): Format of the input and output files, one of 'csv', 'parquet'
+                         or 'arrow'.
+    - float_dtype (str): Floating point precision of the features, float32 or float64.
+    - chunksize (int, optional): Number of rows per chunk. If provided, the files are
+                                 merged chunk by chunk and not kept in memory.
 
     Returns:
-    - pd.DataFrame: Merged DataFrame containing the combined data from CSV files.
+    - pd.DataFrame: Merged DataFrame containing the combined data from CSV files, None
+                    when merged chunk by chunk.
 
     """
-    search_pattern = os.path.join(folder_path, "*.txt")
+    search_pattern = os.path.join(folder_path, f"*{FILE_EXTENSIONS[file_format]}")
     file_list = sorted(glob.glob(search_pattern, recursive=True))
 
-    merged_data = pd.concat(
-        [pd.read_csv(file, sep=";") for file in file_list],
-        ignore_index=True,
-        sort=False,
-    )
-    merged_data.fillna(0, inplace=True)
-    merged_data.to_csv(output_name, index=False, sep=";")
+    if chunksize:
+        with profiler.step("stream_merge"):
+            stream_merge_files(
+                file_list, output_name, file_format, float_dtype, chunksize
+            )
+        return None
+
+    with profiler.step("load"):
+        tables = [read_table(file, file_format) for file in file_list]
+    with profiler.step("merge"):
+        merged_data = pd.concat(tables, ignore_index=True, sort=False)
+        merged_data.fillna(0, inplace=True)
+    with profiler.step("write"):
+        write_table(merged_data, output_name, file_format, float_dtype)
 
     return merged_data
 
@@ -39,10 +202,43 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output_name", help="Specify the output file name", required=True
     )
+    parser.add_argument(
+        "--format",
+        choices=list(FILE_EXTENSIONS),
+        default="csv",
+        help="Specify the format of the input and output files",
+    )
+    parser.add_argument(
+        "--float_dtype",
+        choices=["float64", "float32"],
+        default="float64",
+        help="Specify the floating point precision of the output features",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Specify the number of rows per chunk to merge the files without loading them into memory",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=0,
+        help="Number of CPUs shared by the parallel jobs and the BLAS threads. If 0, the NASQQ_CPUS environment variable or all available CPUs.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Path to the JSON file with the time and peak memory of each step. If empty, the metrics are not saved.",
+    )
     args = parser.parse_args()
+    profiler.configure("merge_batches", args.metrics_file)
+    parallelism.configure(args.n_jobs)
 
     output_name = args.output_name
     folder_path = args.folder_path
-    if not output_name.endswith(".txt"):
-        output_name += ".txt"
-    merge_csv_files(folder_path, output_name)
+    extension = FILE_EXTENSIONS[args.format]
+    if not output_name.endswith(extension):
+        output_name += extension
+    merge_csv_files(
+        folder_path, output_name, args.format, args.float_dtype, args.chunksize
+    )
+    profiler.write()
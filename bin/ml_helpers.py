@@ -1,12 +1,37 @@
 #!/usr/bin/env python
 
 import os
+import copy
+import hashlib
+import json
 import matplotlib.pyplot as plt
 import plotly.express as px
 import seaborn as sns
 import numpy as np
 import pandas as pd
 import shap
+import joblib
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.cluster import hierarchy
+from scipy.stats import norm, rankdata
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.pipeline import Pipeline
+
+# the helpers without modelling and plotting dependencies live in script_helpers,
+# so that the data preparation scripts import them quickly
+from script_helpers import (
+    FILE_EXTENSIONS,
+    Parallelism,
+    StageProfiler,
+    available_cpus,
+    iter_chunks,
+    parallelism,
+    profiler,
+    read_table,
+    split_jobs,
+    table_writer,
+    write_table,
+)
 
 
 class MLException(Exception):
@@ -15,6 +40,210 @@ class MLException(Exception):
     pass
 
 
+class ResultsCache:
+    """Content-addressed cache of intermediate results with LRU eviction.
+
+    Results are stored under a hash of the input file content, the stage name and
+    the arguments the stage depends on, so a repeated run skips every stage whose
+    inputs did not change. The least recently used entries are removed once the
+    cache grows over its size cap.
+
+    Parameters:
+    - cache_dir (str, optional): Directory of the cache. Caching is disabled if empty.
+    - max_size_mb (float): Maximum size of the cache in megabytes.
+
+    """
+
+    def __init__(self, cache_dir=None, max_size_mb=2048):
+        self.cache_dir = cache_dir or None
+        self.max_size_mb = max_size_mb
+        self._digests = {}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def file_digest(self, file_path, block_size=1 << 20):
+        """Compute the SHA-256 digest of a file content, once per file."""
+        file_path = os.path.abspath(file_path)
+        if file_path not in self._digests:
+            digest = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for block in iter(lambda: f.read(block_size), b""):
+                    digest.update(block)
+            self._digests[file_path] = digest.hexdigest()
+        return self._digests[file_path]
+
+    def key(self, stage, data_file, **params):
+        """Build the cache key of a stage from its input file and arguments."""
+        content = json.dumps(
+            [stage, self.file_digest(data_file), params], sort_keys=True, default=str
+        )
+        return f"{stage}_{hashlib.sha256(content.encode()).hexdigest()}"
+
+    def get_or_compute(self, stage, compute, data_file, **params):
+        """Return the cached result of a stage, computing and storing it if missing.
+
+        Parameters:
+        - stage (str): Name of the stage.
+        - compute (callable): Function computing the result of the stage.
+        - data_file (str): Path to the input file of the stage.
+        - **params: Arguments the result of the stage depends on.
+
+        Returns:
+        - Result of the stage.
+
+        """
+        if self.cache_dir is None:
+            return compute()
+
+        path = os.path.join(
+            self.cache_dir, f"{self.key(stage, data_file, **params)}.joblib"
+        )
+        if os.path.exists(path):
+            try:
+                result = joblib.load(path)
+                os.utime(path)
+                print(f"Loaded cached {stage} results.")
+                return result
+            except Exception as e:
+                print(f"Could not load cached {stage} results: {e}")
+
+        result = compute()
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(result, temporary_path)
+        os.replace(temporary_path, path)
+        self.evict(keep=path)
+        return result
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits its size cap.
+
+        Parameters:
+        - keep (str, optional): Path to an entry that is never removed.
+
+        """
+        entries = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(".joblib")
+        ]
+        entries = sorted(entries, key=os.path.getmtime)
+        total_size = sum(os.path.getsize(entry) for entry in entries)
+        for entry in entries:
+            if total_size <= self.max_size_mb * 1024**2:
+                break
+            if entry == keep:
+                continue
+            total_size -= os.path.getsize(entry)
+            os.remove(entry)
+
+
+class FoldStatistics:
+    """Means and standard deviations of the training part of every cv split.
+
+    The statistics of all of the splits are computed at once from the sums and
+    sums of squares of the rows of each training set, as the product of a split
+    membership matrix with the data, instead of rescaling the data for every model
+    and split. They are looked up by a digest of the index of the training rows,
+    so the index of the data must be unique. The statistics are kept as two arrays
+    of one row per split, which joblib memory-maps when the cloned scalers are
+    sent to the workers instead of pickling them again for every model.
+
+    Parameters:
+    - X (pd.DataFrame): Features.
+    - splits (list): Train and test indices of the cross-validation splits.
+
+    """
+
+    def __init__(self, X, splits):
+        self.n_features = X.shape[1]
+        self.splits = {}
+        self.means = self.scales = None
+        if not X.index.is_unique:
+            return
+
+        values = X.to_numpy(dtype="float64")
+        # the sums of squares are taken around the overall mean for precision
+        offset = values.mean(axis=0)
+        values = values - offset
+        membership = np.zeros((len(splits), len(X)))
+        for split, (train, _) in enumerate(splits):
+            membership[split, train] = 1
+        counts = membership.sum(axis=1, keepdims=True)
+        means = membership @ values / counts
+        variances = np.maximum(membership @ values**2 / counts - means**2, 0)
+        self.means = means + offset
+        self.scales = _scale(variances)
+        self.splits = {
+            self._key(X.index[train]): split for split, (train, _) in enumerate(splits)
+        }
+
+    def __deepcopy__(self, memo):
+        # the statistics are never modified, cloned scalers share them
+        return self
+
+    @staticmethod
+    def _key(index):
+        hashes = pd.util.hash_pandas_object(index, index=False).to_numpy()
+        return hashlib.sha256(hashes.tobytes()).digest()
+
+    def get(self, X):
+        """Return the means and scales of a training set, None if it is not a split."""
+        if X.shape[1] != self.n_features or not self.splits:
+            return None
+        split = self.splits.get(self._key(X.index))
+        if split is None:
+            return None
+        return self.means[split], self.scales[split]
+
+
+def _scale(variances):
+    # constant features are left unscaled, as by StandardScaler
+    scale = np.sqrt(variances)
+    scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+    return scale
+
+
+class FoldStandardScaler(TransformerMixin, BaseEstimator):
+    """Standard scaler reusing the precomputed statistics of the cv splits.
+
+    Fitted on the training part of a split, the scaler takes its statistics from
+    `statistics` instead of computing them, any other data is fitted as by
+    StandardScaler.
+
+    Parameters:
+    - statistics (FoldStatistics, optional): Statistics of the cross-validation splits.
+
+    """
+
+    def __init__(self, statistics=None):
+        self.statistics = statistics
+
+    def fit(self, X, y=None):
+        fold_statistics = (
+            self.statistics.get(X)
+            if self.statistics is not None and isinstance(X, pd.DataFrame)
+            else None
+        )
+        if fold_statistics is None:
+            values = np.asarray(X, dtype="float64")
+            fold_statistics = values.mean(axis=0), _scale(values.var(axis=0))
+        self.mean_, self.scale_ = fold_statistics
+        if isinstance(X, pd.DataFrame):
+            self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        return self
+
+    def transform(self, X):
+        scaled = (np.asarray(X, dtype="float64") - self.mean_) / self.scale_
+        if isinstance(X, pd.DataFrame):
+            return pd.DataFrame(scaled, index=X.index, columns=X.columns)
+        return scaled
+
+
+def final_estimator(model):
+    """Return the model of a pipeline, or the model itself if it is not one."""
+    return model[-1] if isinstance(model, Pipeline) else model
+
+
 def create_results_dir(results_location):
     """Create subdirectories 'tables' and 'figures' in the specified results location.
 
@@ -85,7 +314,11 @@ def ROC_AUC(model, X_test, y_test):
 
 
 def metadata_check(
-    df, disease_metacol, minimum_class_threshold=3, minimum_class_perc_threshold=0.03
+    df,
+    disease_metacol,
+    minimum_class_threshold=3,
+    minimum_class_perc_threshold=0.03,
+    multi_state=False,
 ):
     """Check the metadata for class balance and feature availability.
 
@@ -94,38 +327,80 @@ def metadata_check(
     - disease_metacol (str): Name of the disease metadata column.
     - minimum_class_threshold (int): Minimum count for each class.
     - minimum_class_perc_threshold (float): Minimum percentage for each class.
+    - multi_state (bool): Whether more than two states are allowed, for the
+                          multi-contrast univariate analysis.
 
     """
     disease_states = df.index.get_level_values(disease_metacol).unique()
-    if len(disease_states) != 2:
+    if multi_state and len(disease_states) < 2:
+        raise ValueError(
+            "There are less than two unique states. Please specify column with at least two states to compare."
+        )
+    if not multi_state and len(disease_states) != 2:
         raise ValueError(
             "There are more/less than two unique states. Please specify column with exact two states to compare."
         )
-    else:
-        disease_state_counts = df.index.get_level_values(disease_metacol).value_counts()
-        n_patients = df.shape[0]
-        disease_state1_count = disease_state_counts.get(disease_states[0], 0)
-        disease_state2_count = disease_state_counts.get(disease_states[1], 0)
-        if (disease_state1_count < minimum_class_threshold) or (
-            (disease_state1_count / n_patients) < minimum_class_perc_threshold
+    disease_state_counts = df.index.get_level_values(disease_metacol).value_counts()
+    n_patients = df.shape[0]
+    for disease_state in disease_states:
+        disease_state_count = disease_state_counts.get(disease_state, 0)
+        if (disease_state_count < minimum_class_threshold) or (
+            (disease_state_count / n_patients) < minimum_class_perc_threshold
         ):
-            raise MLException(f"not enough {disease_states[0]} samples")
-        if (disease_state2_count < minimum_class_threshold) or (
-            (disease_state2_count / n_patients) < minimum_class_perc_threshold
-        ):
-            raise MLException(f"not enough {disease_states[1]} samples")
-        if df.shape[1] < 5:
-            raise MLException("not enough features")
+            raise MLException(f"not enough {disease_state} samples")
+    if df.shape[1] < 5:
+        raise MLException("not enough features")
     print(
-        disease_states[0],
-        ":",
-        disease_state1_count,
-        disease_states[1],
-        ":",
-        disease_state2_count,
+        *[
+            f"{disease_state} : {disease_state_counts.get(disease_state, 0)}"
+            for disease_state in disease_states
+        ]
     )
 
 
+def figure_path(
+    results_location, name, n_points=0, figure_format="svg", raster_threshold=10000
+):
+    """Build the output path of a figure and decide whether it is rasterized.
+
+    Parameters:
+    - results_location (str): Path to the directory where the figure will be saved.
+    - name (str): File name of the figure without extension.
+    - n_points (int): Number of points, boxes or cells drawn in the figure.
+    - figure_format (str): "svg" for vector figures, "png" for raster figures, or
+      "auto" for vector figures with rasterized data above the threshold.
+    - raster_threshold (int): Number of drawn elements above which "auto" rasterizes.
+
+    Returns:
+    - str: Path to the figure.
+    - bool: Whether the data of the vector figure is rasterized.
+
+    """
+    if figure_format == "png":
+        return os.path.join(results_location, "figures", f"{name}.png"), False
+    rasterize = figure_format == "auto" and n_points > raster_threshold
+    return os.path.join(results_location, "figures", f"{name}.svg"), rasterize
+
+
+def save_figure(fig, path, rasterize=False, **kwargs):
+    """Save a matplotlib figure, rasterizing its data artists if requested, and close it.
+
+    Parameters:
+    - fig (matplotlib.figure.Figure): Figure to save.
+    - path (str): Path to the figure.
+    - rasterize (bool): Whether to rasterize the data artists in a vector figure.
+    - **kwargs: Additional arguments passed to savefig.
+
+    """
+    if rasterize:
+        for ax in fig.axes:
+            for artist in ax.collections + ax.patches + ax.lines + ax.images:
+                artist.set_rasterized(True)
+    fig.savefig(path, **kwargs)
+    plt.close(fig)
+
+
+@profiler.profile
 def create_pca_explained_variance_plot(
     explained_variance_ratio, results_location, pc_range=10, figsize=(12, 5)
 ):
@@ -159,10 +434,18 @@ def create_pca_explained_variance_plot(
     fig.savefig(
         os.path.join(results_location, "figures", f"pca_explained_variance_barplot.svg")
     )
+    plt.close(fig)
 
 
+@profiler.profile
 def create_pca_matrix_plot(
-    explained_variance_ratio, pca_result, df, metacol, results_location
+    explained_variance_ratio,
+    pca_result,
+    df,
+    metacol,
+    results_location,
+    figure_format="svg",
+    raster_threshold=10000,
 ):
     """Create and save a scatter matrix plot for PCA results.
 
@@ -172,6 +455,8 @@ def create_pca_matrix_plot(
     - df (pd.DataFrame): Input DataFrame.
     - metacol (str): Name of the metadata column.
     - results_location (str): Path to the directory where the plot will be saved.
+    - figure_format (str): "svg", "png" or "auto", see figure_path.
+    - raster_threshold (int): Number of points above which "auto" rasterizes.
 
     """
     labels = {
@@ -188,13 +473,29 @@ def create_pca_matrix_plot(
     )
     fig.update_traces(diagonal_visible=False, showupperhalf=False)
     fig.update_layout(width=1500, height=1000)
-    fig.write_image(
-        os.path.join(results_location, "figures", f"pca_matrix_{metacol}.svg")
+    path, rasterize = figure_path(
+        results_location,
+        f"pca_matrix_{metacol}",
+        n_points=6 * len(pca_result),
+        figure_format=figure_format,
+        raster_threshold=raster_threshold,
     )
+    # kaleido cannot rasterize only the markers of a vector figure
+    if rasterize:
+        path = f"{os.path.splitext(path)[0]}.png"
+    fig.write_image(path)
 
 
+@profiler.profile
 def create_distribution_plots(
-    df, index_columns, metacol, results_location, n_size=10, figsize=(12, 8)
+    df,
+    index_columns,
+    metacol,
+    results_location,
+    n_size=10,
+    figsize=(12, 8),
+    figure_format="svg",
+    raster_threshold=10000,
 ):
     """Create and save boxplots and distribution plots for random features.
 
@@ -205,6 +506,8 @@ def create_distribution_plots(
     - results_location (str): Path to the directory where the plots will be saved.
     - n_size (int): Number of features to plot.
     - figsize (tuple): Size of the plots.
+    - figure_format (str): "svg", "png" or "auto", see figure_path.
+    - raster_threshold (int): Number of points above which "auto" rasterizes.
 
     """
     features_col = df.sample(frac=1, random_state=1).columns
@@ -225,13 +528,14 @@ def create_distribution_plots(
     )
     plt.xticks(rotation=45)
     sns.move_legend(box, "upper left", bbox_to_anchor=(1, 1))
-    plt.savefig(
-        os.path.join(
-            results_location, "figures", f"distribution_boxplots_{metacol}.svg"
-        ),
-        bbox_inches="tight",
+    path, rasterize = figure_path(
+        results_location,
+        f"distribution_boxplots_{metacol}",
+        n_points=len(melted_df),
+        figure_format=figure_format,
+        raster_threshold=raster_threshold,
     )
-    fig = plt.figure(figsize=figsize)
+    save_figure(fig, path, rasterize, bbox_inches="tight")
     dist = sns.displot(
         melted_df,
         x="value",
@@ -243,21 +547,207 @@ def create_distribution_plots(
         kind="kde",
         palette="colorblind",
     )
-    plt.savefig(
-        os.path.join(
-            results_location, "figures", f"distribution_distplots_{metacol}.svg"
-        )
+    # density curves do not grow with the number of samples and stay vectors
+    path, rasterize = figure_path(
+        results_location,
+        f"distribution_distplots_{metacol}",
+        figure_format=figure_format,
+        raster_threshold=raster_threshold,
     )
+    save_figure(dist.figure, path, rasterize)
 
 
-def create_clustermaps(df, patient_metacol, results_location, figsize=(12, 6)):
-    """Create and save clustermaps for feature and patient correlations.
+def _unit_columns(values, dtype="float32"):
+    """Center the columns in double precision and scale them to unit norm."""
+    values = np.asarray(values, dtype="float64")
+    values = values - values.mean(axis=0)
+    norms = np.sqrt(np.einsum("ij,ij->j", values, values))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (values / norms).astype(dtype)
+
+
+class RankedMatrix:
+    """Columns of a sample matrix ranked once, for the rank-based statistics.
+
+    Ties get their average rank and the ranks are kept in float32, exact for up to
+    2**23 samples. The tie corrections of the statistics are derived from the sum
+    of squared deviations of the ranks, so nothing is sorted again.
+
+    Parameters:
+    - values (array-like): Samples in rows and features in columns. Columns with
+      missing values get NaN ranks.
+    - dtype (str): Floating point type of the stored ranks.
+
+    """
+
+    def __init__(self, values, dtype="float32"):
+        self.ranks = rankdata(np.asarray(values, dtype="float64"), axis=0).astype(dtype)
+        n = len(self.ranks)
+        centered = self.ranks.astype("float64") - (n + 1) / 2
+        # (n**3 - n) / 12 without ties, reduced by the tie correction otherwise
+        self.rank_ss = np.einsum("ij,ij->j", centered, centered)
+
+    @property
+    def n_samples(self):
+        return self.ranks.shape[0]
+
+    @property
+    def has_ties(self):
+        """Whether each column contains repeated values."""
+        n = self.n_samples
+        # every tie reduces the sum of squares by at least 1/2
+        return self.rank_ss < (n**3 - n) / 12 - 0.25
+
+    def take(self, rows=None, columns=None):
+        """Reorder the samples or select columns without ranking again.
+
+        Parameters:
+        - rows (array-like, optional): New order of all of the samples.
+        - columns (array-like, optional): Indices or mask of the selected columns.
+
+        Returns:
+        - RankedMatrix: Ranks of the selected columns in the new sample order.
+
+        """
+        ranked = copy.copy(self)
+        ranked.ranks = self.ranks if rows is None else self.ranks[rows]
+        ranked.rank_ss = self.rank_ss
+        if columns is not None:
+            ranked.ranks = ranked.ranks[:, columns]
+            ranked.rank_ss = ranked.rank_ss[columns]
+        return ranked
+
+    def rank_sums(self, in_group):
+        """Sum the ranks of a group of samples, or of a matrix of groups in rows."""
+        return np.asarray(in_group, dtype="float64") @ self.ranks
+
+    def mannwhitneyu(self, in_group1):
+        """Two-sided Mann-Whitney U test of a group against the other samples.
+
+        The p-values are the asymptotic ones of `scipy.stats.mannwhitneyu`, with tie
+        and continuity corrections.
+
+        Parameters:
+        - in_group1 (array-like): Whether each sample belongs to the first group.
+
+        Returns:
+        - np.ndarray: U statistic of the first group for every column.
+        - np.ndarray: p-value for every column.
+
+        """
+        n = self.n_samples
+        n1 = np.count_nonzero(in_group1)
+        n2 = n - n1
+        u1 = self.rank_sums(in_group1) - n1 * (n1 + 1) / 2
+        u = np.maximum(u1, n1 * n2 - u1)
+        sd = np.sqrt(n1 * n2 / (n * (n - 1)) * self.rank_ss)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            z = (u - n1 * n2 / 2 - 0.5) / sd
+        return u1, np.clip(2 * norm.sf(z), 0, 1)
+
+    def rank_biserial(self, in_group1):
+        """Rank-biserial correlation of a group against the other samples.
+
+        Positive values mean that the first group tends to have the larger values.
+        """
+        n1 = np.count_nonzero(in_group1)
+        n2 = self.n_samples - n1
+        u1 = self.rank_sums(in_group1) - n1 * (n1 + 1) / 2
+        return 2 * u1 / (n1 * n2) - 1
+
+    def spearman(self, covariates=None, dtype="float32"):
+        """Spearman correlations of the columns with covariates of the same samples.
+
+        Parameters:
+        - covariates (array-like, optional): Covariates of the samples in columns.
+          The columns are correlated with each other if not given.
+        - dtype (str): Floating point precision of the matrix product.
+
+        Returns:
+        - np.ndarray: Correlations, one row per column and one column per covariate.
+
+        """
+        ranks = _unit_columns(self.ranks, dtype)
+        if covariates is None:
+            other = ranks
+        else:
+            other = _unit_columns(RankedMatrix(covariates).ranks, dtype)
+        corr = ranks.T @ other
+        np.clip(corr, -1, 1, out=corr)
+        return corr
+
+
+def correlation_matrix(df, dtype="float32", method="pearson"):
+    """Compute the Pearson or Spearman correlations between the columns of a DataFrame.
+
+    Columns are centered in double precision and scaled to unit norm, so the
+    correlations are a single matrix product, computed by BLAS in the requested
+    precision. Spearman correlations are computed in the same way on the ranks of
+    the columns. Tables with missing values fall back to the pairwise correlations
+    of pandas.
+
+    Parameters:
+    - df (pd.DataFrame): Input DataFrame.
+    - dtype (str): Floating point precision of the matrix product, float32 or float64.
+    - method (str): Correlation coefficient, pearson or spearman.
+
+    Returns:
+    - pd.DataFrame: Correlations between the columns, NaN for constant columns.
+
+    """
+    values = df.to_numpy(dtype="float64")
+    if np.isnan(values).any():
+        return df.corr(method=method)
+    if method == "spearman":
+        corr = RankedMatrix(values).spearman(dtype=dtype)
+    else:
+        values = _unit_columns(values, dtype)
+        corr = values.T @ values
+        np.clip(corr, -1, 1, out=corr)
+    return pd.DataFrame(corr, index=df.columns, columns=df.columns)
+
+
+def correlation_linkage(corr, method="average"):
+    """Cluster the rows of a correlation matrix as the clustermaps do.
+
+    The matrix is symmetric, so the linkage of its rows is also the linkage of its
+    columns and is computed once for both.
+
+    Parameters:
+    - corr (pd.DataFrame): Correlation matrix.
+    - method (str): Linkage method of the hierarchical clustering.
+
+    Returns:
+    - np.ndarray: Linkage matrix.
+
+    """
+    return hierarchy.linkage(
+        corr.to_numpy(dtype="float64"), method=method, metric="euclidean"
+    )
+
+
+def correlation_matrices(
+    df,
+    patient_metacol,
+    max_features=1000,
+    max_samples=None,
+    dtype="float32",
+    method="pearson",
+):
+    """Compute the feature and patient correlation matrices shown in the clustermaps.
 
     Parameters:
     - df (pd.DataFrame): Input DataFrame.
     - patient_metacol (str): Name of the patient metadata column.
-    - results_location (str): Path to the directory where the plots will be saved.
-    - figsize (tuple): Size of the plots.
+    - max_features (int): Maximum number of features in the feature correlations.
+    - max_samples (int, optional): Maximum number of samples, randomly selected, in
+                                   both correlations. By default all samples are used.
+    - dtype (str): Floating point precision of the correlations, float32 or float64.
+    - method (str): Correlation coefficient, pearson or spearman.
+
+    Returns:
+    - pd.DataFrame: Correlations between a subset of the features.
+    - pd.DataFrame: Correlations between patients.
 
     """
     df_features = (
@@ -265,79 +755,321 @@ def create_clustermaps(df, patient_metacol, results_location, figsize=(12, 6)):
         .set_index([patient_metacol])
         .select_dtypes(include=["int64", "float64"])
     )
-    df_patients = df_features.T
-    fig = plt.figure(figsize=figsize)
-    sns.clustermap(
-        feature_subset(df_features, max_features=1000).corr().fillna(0),
-        vmin=-1,
-        vmax=1,
-        center=0,
+    if max_samples and len(df_features) > max_samples:
+        df_features = df_features.sample(max_samples, random_state=0)
+    features_corr = correlation_matrix(
+        feature_subset(df_features, max_features=max_features), dtype, method
+    ).fillna(0)
+    return features_corr, correlation_matrix(df_features.T, dtype, method)
+
+
+@profiler.profile
+def create_clustermaps(
+    df,
+    patient_metacol,
+    results_location,
+    figure_format="svg",
+    raster_threshold=10000,
+    max_samples=None,
+    method="pearson",
+):
+    """Create and save clustermaps for feature and patient correlations.
+
+    Parameters:
+    - df (pd.DataFrame): Input DataFrame.
+    - patient_metacol (str): Name of the patient metadata column.
+    - results_location (str): Path to the directory where the plots will be saved.
+    - figure_format (str): "svg", "png" or "auto", see figure_path.
+    - raster_threshold (int): Number of heatmap cells above which "auto" rasterizes.
+    - max_samples (int, optional): Maximum number of samples in the clustermaps.
+    - method (str): Correlation coefficient, pearson or spearman.
+
+    """
+    features_corr, patients_corr = correlation_matrices(
+        df, patient_metacol, max_samples=max_samples, method=method
     )
-    plt.savefig(
-        os.path.join(
-            results_location, "figures", f"correlation_clustermap_features.svg"
+    for name, corr in [("features", features_corr), ("patients", patients_corr)]:
+        linkage = correlation_linkage(corr)
+        grid = sns.clustermap(
+            corr,
+            vmin=-1,
+            vmax=1,
+            center=0,
+            row_linkage=linkage,
+            col_linkage=linkage,
         )
-    )
-    fig = plt.figure(figsize=figsize)
-    sns.clustermap(df_patients.corr(), vmin=-1, vmax=1, center=0)
-    plt.savefig(
-        os.path.join(
-            results_location, "figures", f"correlation_clustermap_patients.svg"
+        path, rasterize = figure_path(
+            results_location,
+            f"correlation_clustermap_{name}",
+            n_points=corr.size,
+            figure_format=figure_format,
+            raster_threshold=raster_threshold,
         )
+        save_figure(grid.figure, path, rasterize)
+
+
+def _fold_shap_values(
+    model,
+    X_test,
+    model_type,
+    X_train=None,
+    y_train=None,
+    feature_perturbation="tree_path_dependent",
+    approximate=False,
+    background_size=100,
+):
+    """Explain the test set of a single cross-validation fold.
+
+    Parameters:
+    - model: Machine learning model or pipeline, fitted unless y_train is given.
+    - X_test (pd.DataFrame): Test set features.
+    - model_type (str): Type of the model (linear or rf).
+    - X_train (pd.DataFrame, optional): Training set features, the model is fitted
+      on them if y_train is given and they are the background data of interventional
+      tree explanations.
+    - y_train (pd.Series, optional): Training set target variable.
+    - feature_perturbation (str): Tree explanation algorithm (tree_path_dependent or
+      interventional).
+    - approximate (bool): Use the Saabas approximation of tree explanations.
+    - background_size (int): Maximum number of background samples of interventional
+      tree explanations.
+
+    Returns:
+    - pd.DataFrame: DataFrame containing SHAP values of the test set.
+
+    """
+    if y_train is not None:
+        model = clone(model).fit(X_train, y_train)
+    if isinstance(model, Pipeline):
+        # the model is explained on the data transformed by the preceding steps
+        X_test = model[:-1].transform(X_test)
+        if X_train is not None:
+            X_train = model[:-1].transform(X_train)
+        model = model[-1]
+    if model_type == "linear":
+        masker = shap.maskers.Independent(data=X_test)
+        explainer = shap.LinearExplainer(model, masker=masker, random_seed=0)
+        shap_values = explainer.shap_values(X_test)
+    if model_type == "rf":
+        background = None
+        if feature_perturbation == "interventional":
+            background = X_train.sample(
+                min(background_size, len(X_train)), random_state=0
+            )
+        explainer = shap.TreeExplainer(
+            model, data=background, feature_perturbation=feature_perturbation
+        )
+        # all test rows of the fold are explained by one call over the whole forest
+        shap_values = explainer.shap_values(
+            X_test, approximate=approximate, check_additivity=False
+        )[1]
+    return pd.DataFrame(shap_values, columns=X_test.columns, index=X_test.index)
+
+
+def _linear_coefficients(model):
+    """Return the coefficients of a linear model on the features before scaling.
+
+    Returns None if the model is not linear or is preceded by other steps than a
+    standard scaler, its SHAP values have no closed form then.
+    """
+    scale = 1.0
+    if isinstance(model, Pipeline):
+        if len(model) != 2 or not hasattr(model[0], "scale_"):
+            return None
+        if model[0].scale_ is not None:
+            scale = model[0].scale_
+        model = model[-1]
+    coef = getattr(model, "coef_", None)
+    if coef is None or coef.shape[0] != 1:
+        return None
+    return coef[0] / scale
+
+
+def linear_shap_values(X, splits, coefficients, max_samples=100):
+    """Compute the SHAP values of linear models on the test sets of all cv splits.
+
+    With the test set as independent background data, the SHAP values of a linear
+    model are coef * (x - mean(x)), so the values of all of the folds are computed
+    as one batched operation on the stacked coefficients, without explainers. As in
+    `shap.maskers.Independent`, the mean is taken over at most `max_samples` test
+    samples drawn by `shap.utils.sample`.
+
+    Parameters:
+    - X (pd.DataFrame): Input features.
+    - splits (list): Train and test indices of the cross-validation splits.
+    - coefficients (np.ndarray): Coefficients of the model of each split, on the
+      features before scaling, one row per split.
+    - max_samples (int): Maximum number of background samples of each test set.
+
+    Returns:
+    - list: DataFrames containing SHAP values of the test set of each split.
+
+    """
+    test_indices = [test for _, test in splits]
+    sizes = np.array([len(test) for test in test_indices])
+    folds = np.repeat(np.arange(len(splits)), sizes)
+    values = X.to_numpy(dtype="float64")[np.concatenate(test_indices)]
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    means = np.stack(
+        [
+            values[start + shap.utils.sample(np.arange(size), max_samples)].mean(axis=0)
+            for start, size in zip(starts, sizes)
+        ]
     )
+    shap_values = coefficients[folds] * (values - means[folds])
+    return [
+        pd.DataFrame(fold_values, index=X.index[test], columns=X.columns)
+        for fold_values, test in zip(
+            np.split(shap_values, np.cumsum(sizes)[:-1]), test_indices
+        )
+    ]
+
+
+def _batch_shap_values(folds, model_type, **kwargs):
+    """Explain a batch of cross-validation folds in a single worker."""
+    return [
+        _fold_shap_values(
+            model, X_test, model_type, X_train=X_train, y_train=y_train, **kwargs
+        )
+        for model, X_test, X_train, y_train in folds
+    ]
 
 
-def get_shap_values(X, y, cv, model, model_type="linear"):
+def get_shap_values(
+    X,
+    y,
+    cv,
+    model=None,
+    model_type="linear",
+    estimators=None,
+    n_jobs=1,
+    feature_perturbation="tree_path_dependent",
+    approximate=False,
+    concatenate=True,
+):
     """Get SHAP values for a given model using cross-validation.
 
+    Folds are explained in parallel, in one batch of consecutive folds per job. When
+    the estimators already fitted on the cross-validation splits are given, they are
+    reused instead of refitting the model, and the SHAP values of fitted linear
+    models are computed in closed form for all of the folds at once.
+
     Parameters:
     - X (pd.DataFrame): Input features.
     - y (pd.Series): Target variable.
     - cv: Cross-validation strategy.
-    - model: Machine learning model.
+    - model: Machine learning model, refitted on every fold if estimators are not given.
     - model_type (str): Type of the model (linear or rf).
+    - estimators (list, optional): Models fitted on the training part of each cv split.
+    - n_jobs (int): Number of worker processes explaining the folds.
+    - feature_perturbation (str): Tree explanation algorithm of rf models, the
+      cheaper tree_path_dependent or interventional, with the training set of each
+      fold as background data.
+    - approximate (bool): Use the Saabas approximation of tree explanations, only
+      with tree_path_dependent explanations.
+    - concatenate (bool): Concatenate the SHAP values of the folds.
 
     Returns:
-    - pd.DataFrame: DataFrame containing SHAP values.
+    - pd.DataFrame or list: DataFrame containing SHAP values, or DataFrames of the
+      SHAP values of each fold if concatenate is False.
 
     """
-    shaps = {}
-    for fold, (train_index, test_index) in enumerate(cv.split(X, y)):
-        X_train, X_test, y_train, y_test = (
-            X.iloc[train_index],
-            X.iloc[test_index],
-            y.iloc[train_index],
-            y.iloc[test_index],
+    if approximate and feature_perturbation != "tree_path_dependent":
+        raise ValueError(
+            "Approximate tree explanations are only available with tree_path_dependent feature perturbation."
         )
-        model.fit(X_train, y_train)
-        masker = shap.maskers.Independent(data=X_test)
-        if model_type == "linear":
-            explainer = shap.LinearExplainer(model, masker=masker, random_seed=0)
-            shap_values = explainer.shap_values(X_test)
-        if model_type == "rf":
-            explainer = shap.TreeExplainer(model, random_seed=0)
-            shap_values = explainer.shap_values(X_test)[1]
-        shaps[fold] = pd.DataFrame(
-            shap_values, columns=X_test.columns, index=X_test.index
+    splits = list(cv.split(X, y))
+    if estimators is not None and len(estimators) != len(splits):
+        raise ValueError(
+            "The number of fitted estimators does not match the number of cv splits."
+        )
+
+    shaps = None
+    if model_type == "linear" and estimators is not None:
+        coefficients = [_linear_coefficients(estimator) for estimator in estimators]
+        if all(coef is not None for coef in coefficients):
+            shaps = linear_shap_values(X, splits, np.vstack(coefficients))
+    if shaps is None:
+        shaps = _explain_folds(
+            X,
+            y,
+            splits,
+            model,
+            model_type,
+            estimators,
+            n_jobs,
+            feature_perturbation,
+            approximate,
         )
-    return pd.concat(shaps, names=["Fold"])
+    if not concatenate:
+        return shaps
+    return pd.concat(dict(enumerate(shaps)), names=["Fold"])
+
+
+def _explain_folds(
+    X,
+    y,
+    splits,
+    model,
+    model_type,
+    estimators,
+    n_jobs,
+    feature_perturbation,
+    approximate,
+):
+    """Explain the folds with SHAP explainers, in one batch of folds per job."""
+    needs_train = estimators is None or (
+        model_type == "rf" and feature_perturbation == "interventional"
+    )
+    folds = []
+    for fold, (train_index, test_index) in enumerate(splits):
+        folds.append(
+            (
+                model if estimators is None else estimators[fold],
+                X.iloc[test_index],
+                X.iloc[train_index] if needs_train else None,
+                y.iloc[train_index] if estimators is None else None,
+            )
+        )
+    n_batches = min(effective_n_jobs(n_jobs), len(folds))
+    batches = np.array_split(np.arange(len(folds)), n_batches)
+    shaps = Parallel(n_jobs=n_jobs)(
+        delayed(_batch_shap_values)(
+            [folds[fold] for fold in batch],
+            model_type,
+            feature_perturbation=feature_perturbation,
+            approximate=approximate,
+        )
+        for batch in batches
+    )
+    return [fold_shaps for batch_shaps in shaps for fold_shaps in batch_shaps]
 
 
 def get_shaps_relative_importance(shap_df, threshold=0.95):
     """Calculate relative importance of features based on SHAP values.
 
+    The SHAP values can be given fold by fold, their mean absolute values are then
+    accumulated without concatenating them.
+
     Parameters:
-    - shap_df (pd.DataFrame): DataFrame containing SHAP values.
+    - shap_df (pd.DataFrame or iterable): DataFrame containing SHAP values, or
+      DataFrames of the SHAP values of each fold.
     - threshold (float): Threshold for cumulative relative importance.
 
     Returns:
     - pd.DataFrame: DataFrame containing feature names and relative importance.
 
     """
-    importance = shap_df.abs().mean()
+    if isinstance(shap_df, pd.DataFrame):
+        shap_df = [shap_df]
+    total, count = 0, 0
+    for fold_shaps in shap_df:
+        total = total + fold_shaps.abs().sum()
+        count = count + fold_shaps.notna().sum()
+    importance = total / count
     relative_importance = (importance / importance.sum()).sort_values(ascending=False)
     return pd.DataFrame(
         relative_importance.pipe(
             lambda imp: imp[imp.cumsum() < threshold]
         ).reset_index()
-    ).set_axis(["Feature", "relative_importance"], axis=1)
\ No newline at end of file
+    ).set_axis(["Feature", "relative_importance"], axis=1)
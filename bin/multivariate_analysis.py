@@ -5,22 +5,38 @@ import sys
 sys.path.append("/bin")
 import os
 import argparse
+import copy
 import re
+import time
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from joblib import Parallel, delayed
 from sklearn.base import clone
 from sklearn.datasets import make_classification
 from sklearn.ensemble import ExtraTreesClassifier
 from sklearn.linear_model import LogisticRegression, LogisticRegressionCV
-from sklearn.model_selection import StratifiedShuffleSplit, cross_validate
+from sklearn.model_selection import (
+    StratifiedKFold,
+    StratifiedShuffleSplit,
+    cross_validate,
+)
+from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
+from sklearn.svm import l1_min_c
 import shap
 from ml_helpers import (
+    FoldStandardScaler,
+    FoldStatistics,
+    ResultsCache,
     data_loading,
+    final_estimator,
+    profiler,
     get_shap_values,
     get_shaps_relative_importance,
+    parallelism,
+    split_jobs,
 )
 
 
@@ -60,38 +76,367 @@ def load_data(
     return X, y
 
 
+def successive_halving(models, X, y, splits, min_splits=20, factor=3, n_jobs=4):
+    """Cross-validate models, spending the full split budget only on the best ones.
+
+    Every model is evaluated on the first `min_splits` splits, then only the best
+    1/`factor` of the models are evaluated on `factor` times more splits, until the
+    remaining models have been evaluated on all of the splits.
+
+    Parameters:
+    - models (dict): Models to evaluate, keyed by name.
+    - X (pd.DataFrame): Features.
+    - y (pd.Series): Target variable.
+    - splits (list): Train and test indices of the cross-validation splits.
+    - min_splits (int): Number of splits every model is evaluated on.
+    - factor (int): Factor by which the models are reduced and the budget increased.
+    - n_jobs (int): Number of parallel jobs for cross-validation.
+
+    Returns:
+    - dict: Cross-validation results of each model, with the number of splits it
+            was evaluated on in the 'n_splits' column.
+
+    """
+    if min_splits < 1:
+        raise ValueError("Successive halving needs at least one split per model.")
+    if factor < 2:
+        raise ValueError("The successive halving factor must be at least 2.")
+    results = {name: [] for name in models}
+    candidates = list(models)
+    evaluated = 0
+    budget = min(min_splits, len(splits))
+    while True:
+        for name in candidates:
+            with profiler.step(name):
+                results[name].append(
+                    pd.DataFrame(
+                        cross_validate(
+                            models[name],
+                            X,
+                            y,
+                            cv=splits[evaluated:budget],
+                            return_estimator=True,
+                            n_jobs=n_jobs,
+                        )
+                    )
+                )
+        evaluated = budget
+        if budget == len(splits):
+            break
+        scores = {
+            name: pd.concat(results[name])["test_score"].mean() for name in candidates
+        }
+        n_survivors = max(1, int(np.ceil(len(candidates) / factor)))
+        candidates = sorted(candidates, key=scores.get, reverse=True)[:n_survivors]
+        budget = min(budget * factor, len(splits))
+
+    for name, model_results in results.items():
+        results[name] = pd.concat(model_results, ignore_index=True)
+        results[name]["n_splits"] = len(results[name])
+    return results
+
+
+def c_grid(X, y, n_values, penalty="l2", c_min=0.01, c_max=10.0):
+    """Build the grid of inverse regularization strengths of a logistic model path.
+
+    For the L1 penalty the grid starts at the smallest C giving a non-empty model,
+    since all coefficients are zero below it.
+
+    Parameters:
+    - X (pd.DataFrame): Features.
+    - y (array-like): Target variable.
+    - n_values (int): Number of C values.
+    - penalty (str): Penalty of the logistic model.
+    - c_min (float): Smallest C value.
+    - c_max (float): Largest C value.
+
+    Returns:
+    - np.ndarray: Increasing C values, evenly spaced on a log scale.
+
+    """
+    if penalty == "l1":
+        c_min = min(max(c_min, l1_min_c(X, y, loss="log")), c_max)
+    return np.logspace(np.log10(c_min), np.log10(c_max), n_values)
+
+
+def _fit_path(model, X, y, train, test, Cs, scaler=None):
+    """Fit a logistic model on one split for every C, from the most regularized.
+
+    Every fit is warm started from the coefficients of the previous C. If a scaler
+    is given, it is fitted on the training part of the split only and the estimators
+    are returned as pipelines of the scaler and the model.
+    """
+    model = clone(model).set_params(warm_start=True)
+    if scaler is not None:
+        scaler = clone(scaler).fit(X.iloc[train])
+    # the split is converted to arrays once rather than at every fit
+    values, target = X.to_numpy(), np.asarray(y)
+    X_train, y_train = values[train], target[train]
+    X_test, y_test = values[test], target[test]
+    if scaler is not None:
+        X_train, X_test = scaler.transform(X_train), scaler.transform(X_test)
+    fits = []
+    for C in Cs:
+        start = time.perf_counter()
+        model.set_params(C=C).fit(X_train, y_train)
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        test_score = model.score(X_test, y_test)
+        estimator = copy.deepcopy(model)
+        estimator.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        if scaler is not None:
+            estimator = make_pipeline(scaler, estimator)
+        fits.append(
+            {
+                "fit_time": fit_time,
+                "score_time": time.perf_counter() - start,
+                "estimator": estimator,
+                "test_score": test_score,
+            }
+        )
+    return fits
+
+
+def regularization_path(model, X, y, splits, Cs, n_jobs=4, scaler=None):
+    """Cross-validate a logistic model along a grid of C values in one pass.
+
+    On every split the model is fitted for all C values with warm starts, so the
+    whole path costs little more than a single fit from scratch.
+
+    Parameters:
+    - model (LogisticRegression): Logistic model supporting warm starts.
+    - X (pd.DataFrame): Features.
+    - y (pd.Series): Target variable.
+    - splits (list): Train and test indices of the cross-validation splits.
+    - Cs (array-like): Increasing C values.
+    - n_jobs (int): Number of parallel jobs, over the splits.
+    - scaler (FoldStandardScaler, optional): Scaler fitted on the training part of
+                                             every split.
+
+    Returns:
+    - dict: Cross-validation results for every C, as DataFrames with the columns
+            of `cross_validate`.
+
+    """
+    fits = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_path)(model, X, y, train, test, Cs, scaler)
+        for train, test in splits
+    )
+    return {
+        C: pd.DataFrame([split_fits[i] for split_fits in fits])
+        for i, C in enumerate(Cs)
+    }
+
+
+def select_models(models, X, y, cv, args, path_models=None, scaler=None):
+    """Cross-validate the candidate models with the selected strategy.
+
+    Parameters:
+    - models (dict): Candidate models by name.
+    - X (pd.DataFrame): Features, scaled unless a scaler is given.
+    - y (array-like): Target variable.
+    - cv (cross-validation generator): Cross-validation splitter.
+    - args (argparse.Namespace): Command-line arguments.
+    - path_models (dict, optional): Logistic models by name, cross-validated on every
+                                    split along a path of `args.c_path` C values.
+    - scaler (FoldStandardScaler, optional): Scaler fitted on the training part of
+                                             every split for the path models, the
+                                             other models already include it.
+
+    Returns:
+    - dict: Cross-validation results of each model, as DataFrames.
+
+    """
+    if args.model_selection == "successive_halving":
+        results = successive_halving(
+            models,
+            X,
+            y,
+            list(cv.split(X, y)),
+            min_splits=args.screening_splits,
+            factor=args.halving_factor,
+            n_jobs=args.n_jobs,
+        )
+    else:
+        results = {}
+        for name, model in models.items():
+            with profiler.step(name):
+                results[name] = pd.DataFrame(
+                    cross_validate(
+                        model, X, y, cv=cv, return_estimator=True, n_jobs=args.n_jobs
+                    )
+                )
+
+    for name, model in (path_models or {}).items():
+        with profiler.step(name):
+            Cs = c_grid(
+                X if scaler is None else clone(scaler).fit_transform(X),
+                y,
+                args.c_path,
+                model.penalty,
+            )
+            path = regularization_path(
+                model,
+                X,
+                y,
+                list(cv.split(X, y)),
+                Cs,
+                n_jobs=args.n_jobs,
+                scaler=scaler,
+            )
+        for C, path_results in path.items():
+            if args.model_selection == "successive_halving":
+                path_results["n_splits"] = len(path_results)
+            results[f"{name} (C={C:.3g})"] = path_results
+    return results
+
+
+def path_coefficients(results, features):
+    """Summarize the coefficients and scores of the logistic models along their path.
+
+    Parameters:
+    - results (dict): Cross-validation results by model name, as returned by
+                      `select_models`.
+    - features (pd.Index): Names of the features.
+
+    Returns:
+    - pd.DataFrame: Model, C, Feature, mean test score, mean weight and proportion of
+                    non-zero weights over the splits.
+
+    """
+    rows = []
+    for name, model_results in results.items():
+        match = re.fullmatch(r"(Logistic regression.*) \(C=([0-9.e+-]+)\)", name)
+        if match is None:
+            continue
+        estimators = model_results["estimator"].map(final_estimator)
+        weights = np.array([model.coef_[0] for model in estimators])
+        rows.append(
+            pd.DataFrame(
+                {
+                    "Model": match.group(1),
+                    "C": estimators.iloc[0].C,
+                    "Feature": features,
+                    "Mean test score": model_results["test_score"].mean(),
+                    "Mean weight": weights.mean(axis=0),
+                    "Nonzero proportion": (weights != 0).mean(axis=0),
+                }
+            )
+        )
+    return pd.concat(rows, ignore_index=True)
+
+
+def _outer_fold(models, X, y, train, test, inner_cv, args, path_models, scaler):
+    """Select a model on the training part of an outer fold and score it on the rest."""
+    X_train, y_train = X.iloc[train], y.iloc[train]
+    results = select_models(
+        models, X_train, y_train, inner_cv, args, path_models, scaler
+    )
+    scores = pd.Series(
+        {
+            name: model_results["test_score"].mean()
+            for name, model_results in results.items()
+            if len(model_results) == inner_cv.get_n_splits()
+        }
+    )
+    best_model = scores.idxmax()
+    estimator = clone(results[best_model]["estimator"].iloc[0]).fit(X_train, y_train)
+    return {
+        "Selected model": best_model,
+        "Inner test score": scores[best_model],
+        "Outer test score": estimator.score(X.iloc[test], y.iloc[test]),
+    }
+
+
+def nested_cross_validation(
+    models, X, y, outer_cv, inner_cv, args, path_models=None, scaler=None
+):
+    """Estimate the score of the model selection itself with nested cross-validation.
+
+    On the training part of every outer fold, the candidate models are
+    cross-validated on the inner splits with the selected strategy, and the best
+    one is refitted and scored on the test part of the outer fold. The outer folds
+    run in parallel processes, sharing the `args.n_jobs` budget with the inner
+    cross-validation.
+
+    Parameters:
+    - models (dict): Candidate models by name.
+    - X (pd.DataFrame): Features, scaled unless a scaler is given.
+    - y (pd.Series): Target variable.
+    - outer_cv (cross-validation generator): Splitter of the outer folds.
+    - inner_cv (cross-validation generator): Splitter of the model selection.
+    - args (argparse.Namespace): Command-line arguments.
+    - path_models (dict, optional): Logistic models cross-validated along a path of
+                                    `args.c_path` C values.
+    - scaler (FoldStandardScaler, optional): Scaler of the path models.
+
+    Returns:
+    - pd.DataFrame: Selected model, its inner and outer test scores for every outer
+                    fold.
+
+    """
+    outer_jobs, inner_jobs = split_jobs(
+        args.n_jobs, outer_cv.get_n_splits(), n_workers=args.outer_jobs
+    )
+    inner_args = argparse.Namespace(**{**vars(args), "n_jobs": inner_jobs})
+    folds = Parallel(n_jobs=outer_jobs)(
+        delayed(_outer_fold)(
+            models, X, y, train, test, inner_cv, inner_args, path_models, scaler
+        )
+        for train, test in outer_cv.split(X, y)
+    )
+    return pd.DataFrame(folds).rename_axis("Outer fold")
+
+
 def main(args):
     subdirectories = ["tables", "figures"]
     for directory in subdirectories:
         os.makedirs(os.path.join(args.results_location, directory), exist_ok=True)
 
-    X, y = load_data(
-        args.data_location,
-        args.results_location,
-        args.disease_metacol,
-        args.batch_metacol,
-        args.patient_metacol,
-        args.data_file,
-    )
+    with profiler.step("load"):
+        X, y = load_data(
+            args.data_location,
+            args.results_location,
+            args.disease_metacol,
+            args.batch_metacol,
+            args.patient_metacol,
+            args.data_file,
+        )
 
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
+    cv = StratifiedShuffleSplit(n_splits=200, random_state=0, test_size=args.test_size)
 
-    models = {
-        "Logistic regression (C=0)": LogisticRegression(random_state=0, C=0.1),
-        "Logistic regression (C=1)": LogisticRegression(random_state=0, C=1.0),
-        "Logistic regression L1 (C=0)": LogisticRegression(
-            random_state=0, penalty="l1", tol=0.01, solver="saga", C=0.1
-        ),
-        "Logistic regression L1 (C=1)": LogisticRegression(
-            random_state=0, penalty="l1", tol=0.01, solver="saga", C=1.0
-        ),
-        "Logistic regression L2 (C=0)": LogisticRegression(
-            random_state=0, penalty="l2", tol=0.01, solver="saga", C=0.1
+    with profiler.step("scaling"):
+        if args.scaling == "fold":
+            # every model scales the training part of a split with its own statistics,
+            # computed once here for all of the models
+            scaler = FoldStandardScaler(FoldStatistics(X, list(cv.split(X, y))))
+            X_scaled = X
+        else:
+            scaler = None
+            X_scaled = pd.DataFrame(
+                StandardScaler().fit_transform(X), index=X.index, columns=X.columns
+            )
+
+    logistic_models = {
+        "Logistic regression": LogisticRegression(random_state=0),
+        "Logistic regression L1": LogisticRegression(
+            random_state=0, penalty="l1", tol=0.01, solver="saga"
         ),
-        "Logistic regression L2 (C=1)": LogisticRegression(
-            random_state=0, penalty="l2", tol=0.01, solver="saga", C=1.0
+        "Logistic regression L2": LogisticRegression(
+            random_state=0, penalty="l2", tol=0.01, solver="saga"
         ),
+    }
+    if args.c_path:
+        models = {}
+        path_models = logistic_models
+    else:
+        models = {
+            f"{name} (C={label})": clone(model).set_params(C=C)
+            for name, model in logistic_models.items()
+            for label, C in [("0", 0.1), ("1", 1.0)]
+        }
+        path_models = None
+    models |= {
         f"Logistic regression (CV={args.cross_val_fold})": LogisticRegressionCV(
             random_state=0,
             penalty="elasticnet",
@@ -102,13 +447,97 @@ def main(args):
         ),
         "Random forest": ExtraTreesClassifier(random_state=0),
     }
-    cv = StratifiedShuffleSplit(n_splits=200, random_state=0, test_size=args.test_size)
+    if scaler is not None:
+        models = {name: make_pipeline(scaler, model) for name, model in models.items()}
+
+    cache = ResultsCache(args.cache_dir, args.cache_size)
+    cache_params = dict(
+        disease_metacol=args.disease_metacol,
+        test_size=args.test_size,
+        cross_val_fold=args.cross_val_fold,
+        model_selection=args.model_selection,
+        screening_splits=args.screening_splits,
+        halving_factor=args.halving_factor,
+        c_path=args.c_path,
+        scaling=args.scaling,
+    )
+    fitted = {}
 
-    results = {}
-    for name, model in models.items():
-        results[name] = pd.DataFrame(
-            cross_validate(model, X_scaled, y, cv=cv, return_estimator=True, n_jobs=4)
+    def cross_validation():
+        results = select_models(models, X_scaled, y, cv, args, path_models, scaler)
+        fitted.update(results)
+        coefficients = path_coefficients(results, X.columns) if args.c_path else None
+        # the estimators fitted on every split are not cached, only their description
+        # and an unfitted copy of every model to refit the best one
+        templates = {
+            name: clone(model_results["estimator"].iloc[0])
+            for name, model_results in results.items()
+        }
+        scores = {
+            name: model_results.assign(estimator=model_results["estimator"].astype(str))
+            for name, model_results in results.items()
+        }
+        return scores, coefficients, templates
+
+    with profiler.step("cross_validation"):
+        results, coefficients, templates = cache.get_or_compute(
+            "cross_validation", cross_validation, args.data_file, **cache_params
         )
+    if args.c_path:
+        coefficients.to_csv(
+            os.path.join(
+                args.results_location, "tables", "logistic_regression_path.csv"
+            ),
+            header=True,
+            sep=",",
+            index=False,
+            encoding="utf-8",
+        )
+    if args.nested_cv:
+        # the outer test folds must not take part in the scaling, so the nested
+        # cross-validation scales the training part of every split in any case
+        if scaler is None:
+            nested_scaler = FoldStandardScaler()
+            nested_models = {
+                name: make_pipeline(nested_scaler, model)
+                for name, model in models.items()
+            }
+        else:
+            nested_scaler, nested_models = scaler, models
+        with profiler.step("nested_cross_validation"):
+            nested_results = cache.get_or_compute(
+                "nested_cross_validation",
+                lambda: nested_cross_validation(
+                    nested_models,
+                    X,
+                    y,
+                    StratifiedKFold(
+                        n_splits=args.nested_cv, shuffle=True, random_state=0
+                    ),
+                    StratifiedShuffleSplit(
+                        n_splits=args.inner_splits,
+                        random_state=0,
+                        test_size=args.test_size,
+                    ),
+                    args,
+                    path_models,
+                    nested_scaler,
+                ),
+                args.data_file,
+                nested_cv=args.nested_cv,
+                inner_splits=args.inner_splits,
+                **cache_params,
+            )
+        nested_results.to_csv(
+            os.path.join(
+                args.results_location, "tables", "nested_cross_validation.csv"
+            ),
+            header=True,
+            sep=",",
+            index=True,
+            encoding="utf-8",
+        )
+
     results = pd.concat(results, names=["model"])
     results.to_csv(
         os.path.join(args.results_location, "tables", f"models_stratification.csv"),
@@ -118,17 +547,37 @@ def main(args):
         encoding="utf-8",
     )
 
-    best_model = results.groupby("model")["test_score"].mean().idxmax()
-    shap_model = clone(models[best_model])
+    scores = results.groupby("model")["test_score"].agg(["mean", "size"])
+    best_model = scores[scores["size"] == cv.get_n_splits()]["mean"].idxmax()
+
+    def best_model_estimators():
+        if best_model in fitted:
+            return fitted[best_model]["estimator"].tolist()
+        return cross_validate(
+            templates[best_model],
+            X_scaled,
+            y,
+            cv=cv,
+            return_estimator=True,
+            n_jobs=args.n_jobs,
+        )["estimator"]
+
+    with profiler.step("best_estimators"):
+        best_estimators = cache.get_or_compute(
+            "best_estimators",
+            best_model_estimators,
+            args.data_file,
+            best_model=best_model,
+            **cache_params,
+        )
 
     cleaned_model_name = re.sub(r"\W+", "_", best_model.lower())
     if "Logistic regression" in best_model:
         plt.figure(figsize=(20, 25), dpi=400)
         weights = (
-            results.loc[best_model]
-            .apply(
-                lambda row: pd.Series(row["estimator"].coef_[0], index=X.columns),
-                axis=1,
+            pd.DataFrame(
+                [final_estimator(estimator).coef_[0] for estimator in best_estimators],
+                columns=X.columns,
             )
             .rename_axis("Split", axis=0)
             .rename_axis("Feature", axis=1)
@@ -136,12 +585,15 @@ def main(args):
             .rename("Weight")
             .reset_index()
         )
-        sns.barplot(weights, x="Weight", y="Feature", errorbar="sd")
-        plt.savefig(
-            os.path.join(
-                args.results_location, "figures", f"logistic_regression_weights.svg"
+        with profiler.step("weights_plot"):
+            sns.barplot(weights, x="Weight", y="Feature", errorbar="sd")
+            plt.savefig(
+                os.path.join(
+                    args.results_location,
+                    "figures",
+                    f"logistic_regression_weights.svg",
+                )
             )
-        )
 
         prob_df = pd.concat(
             [
@@ -164,9 +616,30 @@ def main(args):
             index=True,
             encoding="utf-8",
         )
-        shap_df = get_shap_values(X=X, y=y, cv=cv, model=shap_model)
+        model_type = "linear"
     else:
-        shap_df = get_shap_values(X=X, y=y, cv=cv, model=shap_model, model_type="rf")
+        model_type = "rf"
+
+    with profiler.step("shap"):
+        shap_df = cache.get_or_compute(
+            "shap",
+            lambda: get_shap_values(
+                X=X_scaled,
+                y=y,
+                cv=cv,
+                model_type=model_type,
+                estimators=best_estimators,
+                n_jobs=args.n_jobs,
+                feature_perturbation=args.shap_perturbation,
+                approximate=args.shap_approximate,
+                concatenate=False,
+            ),
+            args.data_file,
+            best_model=best_model,
+            shap_perturbation=args.shap_perturbation,
+            shap_approximate=args.shap_approximate,
+            **cache_params,
+        )
 
     shap_relative_importance = get_shaps_relative_importance(shap_df=shap_df, threshold=0.95)
     shap_relative_importance.to_csv(
@@ -208,6 +681,88 @@ if __name__ == "__main__":
         default=2,
         help="Number of cross-validation folds.",
     )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=0,
+        help="Number of CPUs shared by the parallel jobs of cross-validation and SHAP values and the BLAS threads. If 0, the NASQQ_CPUS environment variable or all available CPUs.",
+    )
+    parser.add_argument(
+        "--model_selection",
+        choices=["full", "successive_halving"],
+        default="full",
+        help="Evaluate all models on every split or screen them by successive halving.",
+    )
+    parser.add_argument(
+        "--screening_splits",
+        type=int,
+        default=20,
+        help="Number of splits every model is evaluated on in successive halving.",
+    )
+    parser.add_argument(
+        "--halving_factor",
+        type=int,
+        default=3,
+        help="Factor by which models are reduced and the split budget increased.",
+    )
+    parser.add_argument(
+        "--c_path",
+        type=int,
+        default=0,
+        help="Number of C values of the regularization path of the logistic models, fitted with warm starts on every split. If 0, the logistic models are fitted for C=0.1 and C=1 only.",
+    )
+    parser.add_argument(
+        "--scaling",
+        choices=["fold", "global"],
+        default="fold",
+        help="Standardize the features on the training part of every split (fold) or once on all of the data (global).",
+    )
+    parser.add_argument(
+        "--nested_cv",
+        type=int,
+        default=0,
+        help="Number of outer folds of the nested cross-validation estimating the score of the model selection. The features are always scaled on the training part of every split, whatever the --scaling. If 0, it is not run.",
+    )
+    parser.add_argument(
+        "--inner_splits",
+        type=int,
+        default=20,
+        help="Number of splits of the model selection within each outer fold of the nested cross-validation.",
+    )
+    parser.add_argument(
+        "--outer_jobs",
+        type=int,
+        default=0,
+        help="Number of outer folds of the nested cross-validation run at once, the rest of the --n_jobs budget is used within each of them. If 0, as many as --n_jobs allows.",
+    )
+    parser.add_argument(
+        "--shap_perturbation",
+        choices=["tree_path_dependent", "interventional"],
+        default="tree_path_dependent",
+        help="SHAP algorithm of the random forest, interventional uses the training set of each split as background data.",
+    )
+    parser.add_argument(
+        "--shap_approximate",
+        action="store_true",
+        help="Approximate the SHAP values of the random forest with the Saabas method, only with tree_path_dependent.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the cache of intermediate results. If empty, caching is disabled.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=2048,
+        help="Maximum size of the cache in megabytes.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Path to the JSON file with the time and peak memory of each step. If empty, the metrics are not saved.",
+    )
 
     args = parser.parse_args()
+    profiler.configure("multivariate_analysis", args.metrics_file)
+    args.n_jobs = parallelism.configure(args.n_jobs)
     main(args)
+    profiler.write()
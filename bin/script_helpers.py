@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import resource
+import time
+from contextlib import contextmanager
+from functools import wraps
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from threadpoolctl import threadpool_limits
+
+FILE_EXTENSIONS = {"csv": ".txt", "parquet": ".parquet", "arrow": ".arrow"}
+# ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1024**2 if sys.platform == "darwin" else 1024
+
+
+def read_table(file_path, file_format="csv", index_columns=None, columns=None):
+    """Read a features table exchanged between the data analysis steps.
+
+    Parameters:
+    - file_path (str): Path to the file.
+    - file_format (str): Format of the file, one of 'csv' (semicolon separated text),
+                         'parquet' or 'arrow' (Arrow IPC).
+    - index_columns (list, optional): List of columns to be used as index.
+    - columns (list, optional): List of columns to load besides the index columns,
+                                all of them by default.
+
+    Returns:
+    - pd.DataFrame: Loaded data.
+
+    """
+    if columns is not None:
+        columns = list(index_columns or []) + list(columns)
+    if file_format == "parquet":
+        df = pd.read_parquet(file_path, columns=columns)
+    elif file_format == "arrow":
+        df = pd.read_feather(file_path, columns=columns)
+    elif file_format == "csv":
+        return pd.read_csv(file_path, sep=";", index_col=index_columns, usecols=columns)
+    else:
+        raise ValueError(f"Unsupported file format: {file_format}")
+    if index_columns:
+        df = df.set_index(index_columns)
+    return df
+
+
+def iter_chunks(file, file_format="csv", chunksize=1000):
+    """Read a data file chunk by chunk.
+
+    Parameters:
+    - file (str): Path to the data file.
+    - file_format (str): Format of the file, one of 'csv', 'parquet' or 'arrow'.
+    - chunksize (int): Number of rows per chunk.
+
+    Yields:
+    - pd.DataFrame: Consecutive rows of the file.
+
+    """
+    if file_format == "csv":
+        yield from pd.read_csv(file, sep=";", chunksize=chunksize)
+    elif file_format == "parquet":
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        with pa.memory_map(file) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                table = pa.Table.from_batches([reader.get_batch(i)])
+                for offset in range(0, table.num_rows, chunksize):
+                    yield table.slice(offset, chunksize).to_pandas()
+
+
+def write_table(df, file_path, file_format="csv", float_dtype="float64", index=False):
+    """Write a features table exchanged between the data analysis steps.
+
+    Binary formats keep the index levels as typed columns, so they are restored
+    by `read_table` without re-parsing.
+
+    Parameters:
+    - df (pd.DataFrame): Data to write.
+    - file_path (str): Path to the output file.
+    - file_format (str): Format of the file, one of 'csv' (semicolon separated text),
+                         'parquet' or 'arrow' (Arrow IPC).
+    - float_dtype (str): Floating point precision of the features, float32 or float64.
+    - index (bool): Whether to write the index levels as leading columns.
+
+    """
+    if index:
+        df = df.reset_index()
+    float_columns = df.select_dtypes(include="floating").columns
+    df = df.astype({col: float_dtype for col in float_columns})
+    if file_format == "parquet":
+        df.to_parquet(file_path, index=False)
+    elif file_format == "arrow":
+        df.reset_index(drop=True).to_feather(file_path)
+    elif file_format == "csv":
+        df.to_csv(file_path, sep=";", index=False)
+    else:
+        raise ValueError(f"Unsupported file format: {file_format}")
+
+
+@contextmanager
+def table_writer(file_path, file_format="csv", float_dtype="float64"):
+    """Open a features table to be written chunk by chunk.
+
+    The columns and types of the table are taken from the first written chunk,
+    later chunks are cast to them.
+
+    Parameters:
+    - file_path (str): Path to the output file.
+    - file_format (str): Format of the file, one of 'csv', 'parquet' or 'arrow'.
+    - float_dtype (str): Floating point precision of the features, float32 or float64.
+
+    Yields:
+    - callable: Function appending a pd.DataFrame chunk to the table, without its index.
+
+    """
+    if file_format not in FILE_EXTENSIONS:
+        raise ValueError(f"Unsupported file format: {file_format}")
+    state = {"writer": None, "schema": None, "header": True}
+
+    def write(chunk):
+        float_columns = chunk.select_dtypes(include="floating").columns
+        chunk = chunk.astype({col: float_dtype for col in float_columns})
+        if file_format == "csv":
+            chunk.to_csv(
+                file_path,
+                sep=";",
+                index=False,
+                header=state["header"],
+                mode="w" if state["header"] else "a",
+            )
+            state["header"] = False
+            return
+        if state["writer"] is None:
+            state["schema"] = pa.Schema.from_pandas(chunk, preserve_index=False)
+            if file_format == "parquet":
+                state["writer"] = pq.ParquetWriter(file_path, state["schema"])
+            else:
+                state["writer"] = pa.ipc.new_file(file_path, state["schema"])
+        state["writer"].write_table(
+            pa.Table.from_pandas(chunk, schema=state["schema"], preserve_index=False)
+        )
+
+    try:
+        yield write
+    finally:
+        if state["writer"] is not None:
+            state["writer"].close()
+
+
+class StageProfiler:
+    """Record the wall time and peak memory of the named steps of a script.
+
+    Steps can be nested, their names are then joined with "/". On Linux the peak
+    resident memory of the process is reset when a step starts, so the peak of each
+    step is its own and not the peak of the whole run so far. Elsewhere the peak
+    of a step is the peak of the process up to its end. Memory of worker
+    processes is only included in the peak of the terminated children.
+
+    Parameters:
+    - name (str): Name of the profiled script.
+    - metrics_file (str, optional): Path to the JSON metrics file. The metrics are
+      not saved if empty.
+
+    """
+
+    def __init__(self, name="", metrics_file=None):
+        self.configure(name, metrics_file)
+
+    def configure(self, name, metrics_file=None):
+        """Start profiling a new run of a script, discarding the recorded steps."""
+        self.name = name
+        self.metrics_file = metrics_file or None
+        self.steps = []
+        self._stack = []
+        self._peak_rss_mb = 0.0
+        self._start = time.perf_counter()
+
+    @staticmethod
+    def _peak_rss():
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / RSS_UNIT
+
+    @staticmethod
+    def _reset_peak_rss():
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+    def _update_peaks(self, peak_rss_mb):
+        self._peak_rss_mb = max(self._peak_rss_mb, peak_rss_mb)
+        for step in self._stack:
+            step["peak_rss_mb"] = max(step["peak_rss_mb"], peak_rss_mb)
+
+    @contextmanager
+    def step(self, name):
+        """Time a named step and record its peak resident memory.
+
+        Parameters:
+        - name (str): Name of the step.
+
+        """
+        self._update_peaks(self._peak_rss())
+        self._reset_peak_rss()
+        step = {
+            "step": "/".join([parent["step"] for parent in self._stack] + [name]),
+            "seconds": 0.0,
+            "peak_rss_mb": 0.0,
+        }
+        self.steps.append(step)
+        self._stack.append(step)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            step["seconds"] = time.perf_counter() - start
+            self._update_peaks(self._peak_rss())
+            self._stack.pop()
+            self._update_peaks(step["peak_rss_mb"])
+
+    def profile(self, func):
+        """Decorate a function so that each of its calls is recorded as a step."""
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.step(func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def metrics(self):
+        """Return the recorded metrics of the run."""
+        self._update_peaks(self._peak_rss())
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            "script": self.name,
+            "seconds": time.perf_counter() - self._start,
+            "peak_rss_mb": self._peak_rss_mb,
+            "children_peak_rss_mb": children.ru_maxrss / RSS_UNIT,
+            "cpu_count": os.cpu_count(),
+            "steps": self.steps,
+        }
+
+    def write(self):
+        """Save the recorded metrics to the metrics file, if any."""
+        if self.metrics_file is None:
+            return
+        directory = os.path.dirname(self.metrics_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.metrics_file, "w") as f:
+            json.dump(self.metrics(), f, indent=2)
+
+
+profiler = StageProfiler()
+
+
+def available_cpus():
+    """Number of CPUs the process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def split_jobs(n_jobs, n_tasks, n_workers=0):
+    """Split a CPU budget between worker processes and the jobs within each of them.
+
+    Parameters:
+    - n_jobs (int): Total number of parallel jobs.
+    - n_tasks (int): Number of tasks shared by the workers.
+    - n_workers (int): Number of workers. If 0, as many as the budget allows.
+
+    Returns:
+    - int: Number of worker processes.
+    - int: Number of parallel jobs within each worker.
+
+    """
+    n_workers = n_workers or min(n_jobs, n_tasks)
+    n_workers = max(1, min(n_workers, n_jobs, n_tasks))
+    return n_workers, max(1, n_jobs // n_workers)
+
+
+class Parallelism:
+    """CPU budget of a script, shared by its worker processes and BLAS threads.
+
+    The budget is the --n_jobs argument of the script if given, else the
+    NASQQ_CPUS environment variable, else the CPUs available to the process.
+    The Nextflow modules pass task.cpus as --n_jobs. joblib is capped to the
+    budget, so each of its n_jobs worker processes limits its BLAS and OpenMP
+    threads to budget // n_jobs, and the BLAS and OpenMP threads of the main process
+    are limited to the budget, instead of one per CPU of the machine.
+
+    """
+
+    def __init__(self):
+        self.n_cpus = available_cpus()
+
+    def configure(self, n_jobs=0):
+        """Set the CPU budget of the script and return it."""
+        self.n_cpus = max(
+            1, n_jobs or int(os.environ.get("NASQQ_CPUS") or 0) or available_cpus()
+        )
+        # read by joblib to size its pools and the threads of its workers
+        os.environ["LOKY_MAX_CPU_COUNT"] = str(self.n_cpus)
+        threadpool_limits(limits=self.n_cpus)
+        return self.n_cpus
+
+    def split(self, n_tasks, n_workers=0):
+        """Split the budget between worker processes and the jobs within each of them."""
+        return split_jobs(self.n_cpus, n_tasks, n_workers)
+
+
+parallelism = Parallelism()
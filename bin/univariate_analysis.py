@@ -5,10 +5,23 @@ import sys
 sys.path.append("/bin")
 import os
 import argparse
+import numpy as np
 import pandas as pd
+from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from sklearn.neighbors import LocalOutlierFactor
-from scipy.stats import mannwhitneyu, ttest_ind, shapiro, false_discovery_control
+from itertools import combinations
+from scipy.stats import (
+    mannwhitneyu,
+    ttest_ind,
+    shapiro,
+    false_discovery_control,
+    f_oneway,
+    kruskal,
+    norm,
+    t as student_t,
+)
+from ml_helpers import RankedMatrix, ResultsCache, parallelism, profiler
 
 
 def load_data(data_location, results_location, data_file):
@@ -44,69 +57,924 @@ def test_normality(data, threshold):
     return p_value > threshold
 
 
-def main(args):
-    """Main function to analyze metabolite data.
+def _swilk_poly(coefficients, x):
+    """Evaluate a polynomial with ascending coefficients (AS R94 convention)."""
+    result = 0.0
+    for coefficient in coefficients[:0:-1]:
+        result = (result + coefficient) * x
+    return coefficients[0] + result
+
+
+def _swilk_ppnd(p):
+    """Normal quantile approximation (AS 111) used by the Shapiro-Wilk coefficients."""
+    q = p - 0.5
+    if abs(q) <= 0.42:
+        r = q * q
+        numerator = q * (
+            ((-25.44106049637 * r + 41.39119773534) * r - 18.61500062529) * r
+            + 2.50662823884
+        )
+        denominator = (
+            ((3.13082909833 * r - 21.06224101826) * r + 23.08336743743) * r
+            - 8.47351093090
+        ) * r + 1.0
+        return numerator / denominator
+    r = 1 - p if q > 0 else p
+    if r <= 0:
+        return 0.0
+    r = np.sqrt(-np.log(r))
+    value = (
+        ((2.32121276858 * r + 4.85014127135) * r - 2.29796479134) * r - 2.78718931138
+    ) / ((1.63706781897 * r + 3.54388924762) * r + 1.0)
+    return -value if q < 0 else value
+
+
+def _swilk_alnorm(z):
+    """Vectorized upper tail area of the standard normal curve (AS 66)."""
+    z = np.asarray(z, dtype=np.float64)
+    upper = z > 0
+    z = np.where(upper, z, -z)
+    y = 0.5 * z * z
+    with np.errstate(all="ignore"):
+        near = 0.5 - z * (
+            0.398942280444
+            - 0.399903438504
+            * y
+            / (
+                y
+                + 5.75885480458
+                - 29.8213557808
+                / (y + 2.62433121679 + 48.6959930692 / (y + 5.92885724438))
+            )
+        )
+        far = (
+            0.398942280385
+            * np.exp(-y)
+            / (
+                z
+                - 3.8052e-8
+                + 1.00000615302
+                / (
+                    z
+                    + 3.98064794e-4
+                    + 1.98615381364
+                    / (
+                        z
+                        - 0.151679116635
+                        + 5.29330324926
+                        / (
+                            z
+                            + 4.8385912808
+                            - 15.1508972451
+                            / (z + 0.742380924027 + 30.789933034 / (z + 3.99019417011))
+                        )
+                    )
+                )
+            )
+        )
+    tail = np.where(z <= 1.28, near, far)
+    tail = np.where(upper, tail, 1 - tail)
+    out_of_range = ~((z <= 7.0) | (upper & (z <= 38.0)))
+    return np.where(out_of_range, np.where(upper, 0.0, 1.0), tail)
+
+
+def _swilk_coefficients(n):
+    """Antisymmetric Shapiro-Wilk coefficients for a sample of size n (AS R94)."""
+    nn2 = n // 2
+    a = np.zeros(nn2)
+    if n == 3:
+        a[0] = np.sqrt(2) / 2
+    else:
+        an25 = n + 0.25
+        summ2 = 0.0
+        for i in range(nn2):
+            a[i] = _swilk_ppnd((i + 1 - 0.375) / an25)
+            summ2 += a[i] ** 2
+        summ2 *= 2.0
+        ssumm2 = np.sqrt(summ2)
+        rsn = 1 / np.sqrt(n)
+        a1 = (
+            _swilk_poly([0.0, 0.221157, -0.147981, -2.071190, 4.434685, -2.706056], rsn)
+            - a[0] / ssumm2
+        )
+        if n > 5:
+            i1 = 2
+            a2 = -a[1] / ssumm2 + _swilk_poly(
+                [0.0, 0.042981, -0.293762, -1.752461, 5.682633, -3.582633], rsn
+            )
+            fac = np.sqrt(
+                (summ2 - 2 * a[0] ** 2 - 2 * a[1] ** 2)
+                / (1 - 2 * a1**2 - 2 * a2**2)
+            )
+            a[1] = a2
+        else:
+            i1 = 1
+            fac = np.sqrt((summ2 - 2 * a[0] ** 2) / (1 - 2 * a1**2))
+        a[0] = a1
+        a[i1:] *= -1.0 / fac
+
+    full = np.zeros(n)
+    full[:nn2] = -a
+    full[n - nn2 :] = a[::-1]
+    return full
+
+
+def shapiro_wilk(data):
+    """Perform the Shapiro-Wilk test for normality on every column at once.
+
+    Vectorized translation of the AS R94 algorithm behind `scipy.stats.shapiro`,
+    so the p-values match the per-column SciPy calls.
 
     Parameters:
-    - args (argparse.Namespace): Command-line arguments.
+    - data (np.ndarray): Samples in rows, features in columns, without NaN values.
+
+    Returns:
+    - np.ndarray: W statistic for each column.
+    - np.ndarray: p-value for each column.
+
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[0]
+    if n < 3:
+        raise ValueError("Data must be at least length 3.")
+
+    x = np.sort(data, axis=0) - data[n // 2]
+    value_range = x[-1] - x[0]
+    zero_range = value_range < 1e-19
+
+    coefficients = _swilk_coefficients(n)
+    sa = 0.0
+    for coefficient in coefficients:
+        sa += coefficient
+    sa /= n
+    asa = coefficients - sa
+
+    with np.errstate(all="ignore"):
+        x_scaled = x / value_range
+        xsx = x_scaled - x_scaled.sum(axis=0) / n
+        ssa = np.sum(asa * asa)
+        ssx = np.sum(xsx * xsx, axis=0)
+        sax = np.sum(asa[:, np.newaxis] * xsx, axis=0)
+        ssassx = np.sqrt(ssa * ssx)
+        w1 = (ssassx - sax) * (ssassx + sax) / (ssa * ssx)
+        w = 1 - w1
+
+        if n == 3:
+            p_value = np.where(w < 0.75, 0.0, 1.0 - 6 / np.pi * np.arccos(np.sqrt(w)))
+            w = np.maximum(w, 0.75)
+        else:
+            y = np.log(w1)
+            if n <= 11:
+                gamma = _swilk_poly([-2.273, 0.459], n)
+                too_large = y >= gamma
+                y = -np.log(gamma - y)
+                m = _swilk_poly([0.5440, -0.39978, 0.025054, -0.0006714], n)
+                s = np.exp(_swilk_poly([1.3822, -0.77857, 0.062767, -0.0020322], n))
+            else:
+                too_large = np.zeros_like(y, dtype=bool)
+                m = _swilk_poly([-1.5861, -0.31082, -0.083751, 0.0038915], np.log(n))
+                s = np.exp(_swilk_poly([-0.4803, -0.082676, 0.0030302], np.log(n)))
+            p_value = np.where(too_large, 1e-19, _swilk_alnorm((y - m) / s))
+
+    w = np.where(zero_range, 1.0, w)
+    p_value = np.where(zero_range, 1.0, p_value)
+    return w, p_value
+
+
+def _mannwhitneyu_matrix(group1, group2, ranked=None):
+    """Run `mannwhitneyu` column-wise, keeping SciPy's per-column method choice.
+
+    The asymptotic tests are computed from the ranks of the combined samples, the
+    exact tests of small samples without ties fall back to SciPy.
+    """
+    statistics = np.empty(group1.shape[1])
+    p_values = np.empty(group1.shape[1])
+    if ranked is None:
+        ranked = RankedMatrix(np.concatenate([group1, group2], axis=0))
+    if group1.shape[0] > 8 and group2.shape[0] > 8:
+        asymptotic = np.ones(group1.shape[1], dtype=bool)
+    else:
+        asymptotic = ranked.has_ties
+    in_group1 = np.arange(ranked.n_samples) < group1.shape[0]
+    if asymptotic.any():
+        statistics[asymptotic], p_values[asymptotic] = ranked.take(
+            columns=asymptotic
+        ).mannwhitneyu(in_group1)
+    if (~asymptotic).any():
+        statistics[~asymptotic], p_values[~asymptotic] = mannwhitneyu(
+            group1[:, ~asymptotic], group2[:, ~asymptotic], axis=0
+        )
+    return statistics, p_values
+
+
+def normality(data, pvalue_shapiro):
+    """Flag the normally distributed features of a group with the Shapiro-Wilk test.
+
+    Features containing NaN values fall back to the per-feature SciPy calls.
+
+    Parameters:
+    - data (pd.DataFrame): Samples of the group.
+    - pvalue_shapiro (float): Threshold for normality Shapiro-Wilk test.
+
+    Returns:
+    - np.ndarray: Whether each feature is normally distributed.
 
     """
-    df_features_proc = load_data(
-        args.data_location, args.results_location, args.data_file
+    values = data.to_numpy(dtype=np.float64)
+    with_nan = np.isnan(values).any(axis=0)
+    is_normal = np.empty(values.shape[1], dtype=bool)
+    for i in np.flatnonzero(with_nan):
+        is_normal[i] = test_normality(data.iloc[:, i], pvalue_shapiro)
+    _, p_values = shapiro_wilk(values[:, ~with_nan])
+    is_normal[~with_nan] = p_values > pvalue_shapiro
+    return is_normal
+
+
+def _moments(group):
+    """Means and unbiased variances of the columns of a group."""
+    return group.mean(axis=0), group.var(axis=0, ddof=1)
+
+
+def _pooled_ttest(moments1, moments2, n1, n2):
+    """Student's T-test of two groups from their moments, as `ttest_ind`."""
+    (mean1, var1), (mean2, var2) = moments1, moments2
+    df = n1 + n2 - 2
+    pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / df
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistics = (mean1 - mean2) / np.sqrt(pooled * (1 / n1 + 1 / n2))
+    return statistics, 2 * student_t.sf(np.abs(statistics), df)
+
+
+def _bootstrap_counts(rng, n_bootstrap, n):
+    """Count every sample in each bootstrap resample, one row per resample."""
+    draws = rng.integers(0, n, size=(n_bootstrap, n))
+    draws += n * np.arange(n_bootstrap)[:, np.newaxis]
+    return (
+        np.bincount(draws.ravel(), minlength=n_bootstrap * n)
+        .reshape(n_bootstrap, n)
+        .astype(np.float64)
     )
 
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(df_features_proc)
-    lof_outlier = LocalOutlierFactor()
-    outlier_scores = lof_outlier.fit_predict(X_scaled)
-    outlier_indices = outlier_scores == -1
 
-    with open(os.path.join(args.results_location, "outliers.txt"), "w") as f:
-        print(
-            "Outliers detected:",
-            df_features_proc[outlier_indices]
-            .index.get_level_values(args.patient_metacol)
-            .values,
-            file=f,
+def _fold_change_and_cohen_d(mean1, var1, mean2, var2, n1, n2):
+    """Fold change of the means and Cohen's d with the pooled standard deviation."""
+    pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / (n1 + n2 - 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return mean1 / mean2, (mean1 - mean2) / np.sqrt(pooled)
+
+
+def effect_sizes(
+    group1,
+    group2,
+    moments=None,
+    n_bootstrap=0,
+    confidence=0.95,
+    chunk_size=1000,
+    random_state=0,
+):
+    """Compute the effect sizes of the first group against the second.
+
+    The fold change of the means and Cohen's d are derived from the group moments.
+    Their bootstrap confidence intervals resample both groups with index count
+    matrices, so the moments of all of the resamples of a chunk of features are
+    matrix products. The Hodges-Lehmann shift is the median of all differences
+    between the samples of the groups, computed on chunks of features.
+
+    Parameters:
+    - group1 (np.ndarray): Samples of the first group, without NaN values.
+    - group2 (np.ndarray): Samples of the second group, without NaN values.
+    - moments (tuple, optional): Means and variances of each group, as returned by
+                                 `_moments`. Computed if not given.
+    - n_bootstrap (int): Number of bootstrap resamples, no intervals if 0.
+    - confidence (float): Confidence level of the percentile intervals.
+    - chunk_size (int): Number of features resampled at once.
+    - random_state (int): Seed of the resamples.
+
+    Returns:
+    - dict: Effect size columns of the features.
+
+    """
+    n1, n2 = len(group1), len(group2)
+    if moments is None:
+        moments = (_moments(group1), _moments(group2))
+    (mean1, var1), (mean2, var2) = moments
+    fold_change, cohen_d = _fold_change_and_cohen_d(mean1, var1, mean2, var2, n1, n2)
+
+    shift = np.empty(group1.shape[1])
+    step = max(1, 2**22 // max(n1 * n2, 1))
+    for start in range(0, group1.shape[1], step):
+        columns = slice(start, start + step)
+        differences = group1[:, np.newaxis, columns] - group2[np.newaxis, :, columns]
+        shift[columns] = np.median(differences.reshape(n1 * n2, -1), axis=0)
+
+    columns = {
+        "Fold change": fold_change,
+        "Cohen's d": cohen_d,
+        "Hodges-Lehmann shift": shift,
+    }
+    if not n_bootstrap:
+        return columns
+
+    rng = np.random.default_rng(random_state)
+    counts1 = _bootstrap_counts(rng, n_bootstrap, n1)
+    counts2 = _bootstrap_counts(rng, n_bootstrap, n2)
+    percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+    intervals = np.full((4, group1.shape[1]), np.nan)
+    for start in range(0, group1.shape[1], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # the moments are taken around the overall mean for precision
+        offset = np.concatenate([group1[:, chunk], group2[:, chunk]]).mean(axis=0)
+        resampled = []
+        for counts, group, n in [(counts1, group1, n1), (counts2, group2, n2)]:
+            centered = group[:, chunk] - offset
+            means = counts @ centered / n
+            variances = (counts @ centered**2 - n * means**2) / (n - 1)
+            resampled.extend([means + offset, variances])
+        for i, values in enumerate(_fold_change_and_cohen_d(*resampled, n1, n2)):
+            intervals[2 * i : 2 * i + 2, chunk] = np.nanpercentile(
+                np.where(np.isfinite(values), values, np.nan), percentiles, axis=0
+            )
+    columns["Fold change CI low"], columns["Fold change CI high"] = intervals[:2]
+    columns["Cohen's d CI low"], columns["Cohen's d CI high"] = intervals[2:]
+    return columns
+
+
+def univariate_tests(
+    group1_data,
+    group2_data,
+    pvalue_shapiro,
+    normal=None,
+    ranked=None,
+    n_bootstrap=0,
+):
+    """Compare two groups feature by feature on the whole matrices at once.
+
+    Features normal in both groups according to the Shapiro-Wilk test are
+    compared with the T-test, the remaining ones with the Mann-Whitney U test.
+    Features containing NaN values fall back to the per-feature SciPy calls.
+    The Mann-Whitney U tests and the rank-biserial correlations of every feature
+    are derived from the ranks of the combined samples, computed once, the T-tests
+    and the other effect sizes from the group means and variances, computed once.
+
+    Parameters:
+    - group1_data (pd.DataFrame): Samples of the first group.
+    - group2_data (pd.DataFrame): Samples of the second group.
+    - pvalue_shapiro (float): Threshold for normality Shapiro-Wilk test.
+    - normal (tuple, optional): Normality flags of the features in each group, as
+                                returned by `normality`. Computed if not given.
+    - ranked (RankedMatrix, optional): Ranks of the samples of the first group
+                                       followed by the second. Computed if not given.
+    - n_bootstrap (int): Number of bootstrap resamples of the confidence intervals of
+                         the fold change and Cohen's d, no intervals if 0.
+
+    Returns:
+    - pd.DataFrame: Feature, Test, Statistic, p-value and the effect sizes, see
+                    `effect_sizes`, and Rank-biserial correlation in the original
+                    feature order. Effect sizes are NaN for features with NaN values.
+
+    """
+    features = group1_data.columns
+    group1 = group1_data.to_numpy(dtype=np.float64)
+    group2 = group2_data.to_numpy(dtype=np.float64)
+    if normal is None:
+        normal = (
+            normality(group1_data, pvalue_shapiro),
+            normality(group2_data, pvalue_shapiro),
+        )
+    normal_both = normal[0] & normal[1]
+    if ranked is None:
+        ranked = RankedMatrix(np.concatenate([group1, group2], axis=0))
+
+    tests = np.full(len(features), "Mann-Whitney U", dtype=object)
+    statistics = np.empty(len(features))
+    p_values = np.empty(len(features))
+
+    with_nan = np.isnan(group1).any(axis=0) | np.isnan(group2).any(axis=0)
+    for i in np.flatnonzero(with_nan):
+        feature = features[i]
+        if normal_both[i]:
+            tests[i] = "T-test"
+            statistics[i], p_values[i] = ttest_ind(
+                group1_data[feature], group2_data[feature]
+            )
+        else:
+            statistics[i], p_values[i] = mannwhitneyu(
+                group1_data[feature], group2_data[feature]
+            )
+
+    complete = ~with_nan
+    group1, group2 = group1[:, complete], group2[:, complete]
+    is_normal = normal_both[complete]
+    complete_ranked = ranked.take(columns=complete)
+    moments = (_moments(group1), _moments(group2))
+
+    complete_statistics = np.empty(group1.shape[1])
+    complete_p_values = np.empty(group1.shape[1])
+    if is_normal.any():
+        complete_statistics[is_normal], complete_p_values[is_normal] = _pooled_ttest(
+            [moment[is_normal] for moment in moments[0]],
+            [moment[is_normal] for moment in moments[1]],
+            len(group1),
+            len(group2),
+        )
+    if (~is_normal).any():
+        (
+            complete_statistics[~is_normal],
+            complete_p_values[~is_normal],
+        ) = _mannwhitneyu_matrix(
+            group1[:, ~is_normal],
+            group2[:, ~is_normal],
+            complete_ranked.take(columns=~is_normal),
         )
 
-    disease_states = df_features_proc.index.get_level_values(
-        args.disease_metacol
-    ).unique()
+    tests[np.flatnonzero(complete)[is_normal]] = "T-test"
+    statistics[complete] = complete_statistics
+    p_values[complete] = complete_p_values
+    sizes = {}
+    for column, values in effect_sizes(group1, group2, moments, n_bootstrap).items():
+        sizes[column] = np.full(len(features), np.nan)
+        sizes[column][complete] = values
+    rank_biserial = np.full(len(features), np.nan)
+    rank_biserial[complete] = complete_ranked.rank_biserial(
+        np.arange(ranked.n_samples) < len(group1)
+    )
+
+    return pd.DataFrame(
+        {
+            "Feature": features,
+            "Test": tests,
+            "Statistic": statistics,
+            "p-value": p_values,
+            **sizes,
+            "Rank-biserial correlation": rank_biserial,
+        }
+    )
+
+
+def _permutation_statistics(values, ranks, in_group1):
+    """Standardized two-sided statistics of every feature for a batch of labelings.
+
+    Parameters:
+    - values (np.ndarray): Centered samples of the T-test features.
+    - ranks (np.ndarray): Ranks of the samples of the Mann-Whitney U features.
+    - in_group1 (np.ndarray): One row per labeling, 1 for the samples of the first
+                              group and 0 for the others.
+
+    Returns:
+    - np.ndarray: Absolute T statistics, then absolute standardized U statistics,
+                  one row per labeling.
+
+    """
+    n = in_group1.shape[1]
+    n1 = in_group1[0].sum()
+    n2 = n - n1
+
+    sum1 = in_group1 @ values
+    sum2 = values.sum(axis=0) - sum1
+    squares1 = in_group1 @ values**2
+    squares2 = (values**2).sum(axis=0) - squares1
+    pooled = (squares1 - sum1**2 / n1 + squares2 - sum2**2 / n2) / (n - 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (sum1 / n1 - sum2 / n2) / np.sqrt(pooled * (1 / n1 + 1 / n2))
+
+    # the permutation variance of U holds with ties, from the variance of the ranks
+    u_scale = np.sqrt(
+        n1 * n2 / (n * (n - 1)) * ((ranks - (n + 1) / 2) ** 2).sum(axis=0)
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (in_group1 @ ranks - n1 * (n1 + 1) / 2 - n1 * n2 / 2) / u_scale
+
+    # constant features carry no evidence against the null hypothesis
+    return np.nan_to_num(np.abs(np.hstack([t, z])), nan=0.0, posinf=0.0)
+
+
+def _asymptotic_p_values(statistics, n_ttest, df):
+    """Two-sided p-values of absolute T statistics followed by standardized U statistics.
+
+    The T statistics have heavier tails than the standardized U statistics, their
+    p-values put both on one scale for the adjustment for multiple testing.
+
+    Parameters:
+    - statistics (np.ndarray): Statistics returned by `_permutation_statistics`.
+    - n_ttest (int): Number of T-test features, the leading columns.
+    - df (int): Degrees of freedom of the T statistics.
+
+    Returns:
+    - np.ndarray: p-values, with the shape of the statistics.
+
+    """
+    return np.hstack(
+        [
+            2 * student_t.sf(statistics[:, :n_ttest], df),
+            2 * norm.sf(statistics[:, n_ttest:]),
+        ]
+    )
+
+
+def permutation_tests(
+    group1_data,
+    group2_data,
+    is_normal,
+    n_permutations=1000,
+    chunk_size=100,
+    random_state=0,
+    ranked=None,
+):
+    """Compute empirical p-values of the univariate tests by label permutations.
+
+    All of the permutations of a chunk are evaluated at once, as products of their
+    group membership matrix with the data for the T statistics and with the ranks,
+    computed once, for the rank sums of the Mann-Whitney U test. Memory is bounded
+    by the number of permutations of a chunk. Features containing NaN values are
+    not tested.
+
+    Parameters:
+    - group1_data (pd.DataFrame): Samples of the first group.
+    - group2_data (pd.DataFrame): Samples of the second group.
+    - is_normal (np.ndarray): Whether each feature is compared with the T-test,
+                              otherwise with the Mann-Whitney U test.
+    - n_permutations (int): Number of label permutations.
+    - chunk_size (int): Number of permutations evaluated at once.
+    - random_state (int): Seed of the permutations.
+    - ranked (RankedMatrix, optional): Ranks of the samples of the first group
+                                       followed by the second. Computed if not given.
+
+    Returns:
+    - pd.DataFrame: Feature, Permutation p-value and the Min-P p-value adjusted for
+                    multiple testing by the single-step min-P procedure, on the
+                    asymptotic p-values of the statistics of every permutation.
+
+    """
+    features = group1_data.columns
+    data = np.concatenate(
+        [group1_data.to_numpy(dtype=np.float64), group2_data.to_numpy(dtype=np.float64)]
+    )
+    complete = ~np.isnan(data).any(axis=0)
+    order = np.concatenate(
+        [np.flatnonzero(complete & is_normal), np.flatnonzero(complete & ~is_normal)]
+    )
+    values = data[:, complete & is_normal]
+    values = values - values.mean(axis=0)
+    if ranked is None:
+        ranked = RankedMatrix(data)
+    ranks = ranked.take(columns=complete & ~is_normal).ranks
+
+    n, n1 = len(data), len(group1_data)
+    observed = _permutation_statistics(
+        values, ranks, (np.arange(n) < n1)[np.newaxis].astype(np.float64)
+    )[0]
+    # the observed statistics count as equal despite rounding differences
+    threshold = observed * (1 - 1e-10)
+    n_ttest = (complete & is_normal).sum()
+    observed_p = _asymptotic_p_values(observed[np.newaxis], n_ttest, n - 2)[0]
+    p_threshold = observed_p * (1 + 1e-10)
+
+    rng = np.random.default_rng(random_state)
+    exceedances = np.zeros(len(order))
+    min_p_exceedances = np.zeros(len(order))
+    for start in range(0, n_permutations, chunk_size):
+        size = min(chunk_size, n_permutations - start)
+        permuted = rng.random((size, n)).argsort(axis=1)[:, :n1]
+        in_group1 = np.zeros((size, n))
+        np.put_along_axis(in_group1, permuted, 1.0, axis=1)
+        statistics = _permutation_statistics(values, ranks, in_group1)
+        exceedances += (statistics >= threshold).sum(axis=0)
+        min_p = _asymptotic_p_values(statistics, n_ttest, n - 2).min(
+            axis=1, initial=1.0
+        )
+        min_p_exceedances += (min_p[:, np.newaxis] <= p_threshold).sum(axis=0)
+
+    p_values = np.full(len(features), np.nan)
+    adjusted = np.full(len(features), np.nan)
+    p_values[order] = (exceedances + 1) / (n_permutations + 1)
+    adjusted[order] = (min_p_exceedances + 1) / (n_permutations + 1)
+    return pd.DataFrame(
+        {
+            "Feature": features,
+            "Permutation p-value": p_values,
+            "Min-P p-value": adjusted,
+        }
+    )
+
+
+def compare_disease_states(
+    df_features_proc, disease_metacol, pvalue_shapiro, n_permutations=0, n_bootstrap=0
+):
+    """Compare features between the two disease states of the data.
+
+    Parameters:
+    - df_features_proc (pd.DataFrame): Feature data indexed by metadata columns.
+    - disease_metacol (str): Name of the disease state metadata column.
+    - pvalue_shapiro (float): Threshold of the Shapiro-Wilk normality test.
+    - n_permutations (int): Number of label permutations of the empirical p-values,
+                            not computed if 0.
+    - n_bootstrap (int): Number of bootstrap resamples of the effect size confidence
+                         intervals, not computed if 0.
+
+    Returns:
+    - pd.DataFrame: Test results sorted by p-value, with FDR corrected p-values.
+
+    """
+    disease_states = df_features_proc.index.get_level_values(disease_metacol).unique()
     if len(disease_states) > 2:
         raise ValueError(
             "There are more than two unique disease states. Please specify which two to compare."
         )
     else:
         group1_data = df_features_proc[
-            df_features_proc.index.get_level_values(args.disease_metacol).isin(
+            df_features_proc.index.get_level_values(disease_metacol).isin(
                 [disease_states[0]]
             )
         ]
         group2_data = df_features_proc[
-            df_features_proc.index.get_level_values(args.disease_metacol).isin(
+            df_features_proc.index.get_level_values(disease_metacol).isin(
                 [disease_states[1]]
             )
         ]
 
+    # the samples of both groups are ranked once for all rank-based statistics
+    ranked = RankedMatrix(pd.concat([group1_data, group2_data]))
+    df_results = univariate_tests(
+        group1_data, group2_data, pvalue_shapiro, ranked=ranked, n_bootstrap=n_bootstrap
+    )
+    if n_permutations:
+        df_results = df_results.merge(
+            permutation_tests(
+                group1_data,
+                group2_data,
+                (df_results["Test"] == "T-test").to_numpy(),
+                n_permutations,
+                ranked=ranked,
+            ),
+            on="Feature",
+            how="left",
+        )
+    df_results = df_results.sort_values(by=["p-value"], ascending=True)
+
+    df_results["FDR"] = false_discovery_control(df_results["p-value"])
+
+    return df_results
+
+
+def omnibus_tests(groups_data, normal):
+    """Compare all groups at once, feature by feature.
+
+    Features normal in every group are compared with the one-way ANOVA, the
+    remaining ones with the Kruskal-Wallis H test.
+
+    Parameters:
+    - groups_data (list): pd.DataFrame of the samples of every group.
+    - normal (list): Normality flags of the features in every group.
+
+    Returns:
+    - pd.DataFrame: Feature, Omnibus test, Omnibus statistic and Omnibus p-value in
+                    the original feature order.
+
+    """
+    features = groups_data[0].columns
+    groups = [group.to_numpy(dtype=np.float64) for group in groups_data]
+    is_normal = np.logical_and.reduce(normal)
+
+    tests = np.where(is_normal, "ANOVA", "Kruskal-Wallis")
+    statistics = np.empty(len(features))
+    p_values = np.empty(len(features))
+    for test, subset in [(f_oneway, is_normal), (kruskal, ~is_normal)]:
+        if subset.any():
+            statistics[subset], p_values[subset] = test(
+                *[group[:, subset] for group in groups], axis=0
+            )
+
+    return pd.DataFrame(
+        {
+            "Feature": features,
+            "Omnibus test": tests,
+            "Omnibus statistic": statistics,
+            "Omnibus p-value": p_values,
+        }
+    )
+
+
+def compare_contrasts(
+    df_features_proc,
+    disease_metacol,
+    pvalue_shapiro,
+    contrasts="pairwise",
+    n_permutations=0,
+    n_bootstrap=0,
+):
+    """Compare features between every contrast of the disease states of the data.
+
+    The normality of the features is tested once per disease state and reused by
+    every contrast. FDR corrected p-values are computed within each contrast, and
+    an omnibus test of all disease states is added to every row of its feature.
+
+    Parameters:
+    - df_features_proc (pd.DataFrame): Feature data indexed by metadata columns.
+    - disease_metacol (str): Name of the disease state metadata column.
+    - pvalue_shapiro (float): Threshold of the Shapiro-Wilk normality test.
+    - contrasts (str): "pairwise" compares every pair of disease states,
+                       "one_vs_rest" every disease state to all the others.
+    - n_permutations (int): Number of label permutations of the empirical p-values
+                            of every contrast, not computed if 0.
+    - n_bootstrap (int): Number of bootstrap resamples of the effect size confidence
+                         intervals of every contrast, not computed if 0.
+
+    Returns:
+    - pd.DataFrame: Test results in long format, with a Contrast column, sorted by
+                    p-value.
+
+    """
+    labels = df_features_proc.index.get_level_values(disease_metacol)
+    disease_states = sorted(labels.unique(), key=str)
+    if len(disease_states) < 2:
+        raise ValueError("There are less than two unique disease states to compare.")
+
+    groups = {state: df_features_proc[labels == state] for state in disease_states}
+    normal = {
+        state: normality(group, pvalue_shapiro) for state, group in groups.items()
+    }
+
+    if contrasts == "pairwise":
+        comparisons = [
+            (
+                f"{state1} vs {state2}",
+                groups[state1],
+                groups[state2],
+                normal[state1],
+                normal[state2],
+                RankedMatrix(pd.concat([groups[state1], groups[state2]])),
+            )
+            for state1, state2 in combinations(disease_states, 2)
+        ]
+    else:
+        # every contrast compares all of the samples, ranked once and reordered
+        ranked = RankedMatrix(df_features_proc)
+        comparisons = []
+        for state in disease_states:
+            rest = df_features_proc[labels != state]
+            order = np.concatenate(
+                [np.flatnonzero(labels == state), np.flatnonzero(labels != state)]
+            )
+            comparisons.append(
+                (
+                    f"{state} vs rest",
+                    groups[state],
+                    rest,
+                    normal[state],
+                    normality(rest, pvalue_shapiro),
+                    ranked.take(rows=order),
+                )
+            )
+
     results = []
+    for contrast, group1_data, group2_data, normal1, normal2, ranked in comparisons:
+        df_contrast = univariate_tests(
+            group1_data,
+            group2_data,
+            pvalue_shapiro,
+            normal=(normal1, normal2),
+            ranked=ranked,
+            n_bootstrap=n_bootstrap,
+        )
+        if n_permutations:
+            df_contrast = df_contrast.merge(
+                permutation_tests(
+                    group1_data,
+                    group2_data,
+                    (df_contrast["Test"] == "T-test").to_numpy(),
+                    n_permutations,
+                    ranked=ranked,
+                ),
+                on="Feature",
+                how="left",
+            )
+        df_contrast["FDR"] = false_discovery_control(df_contrast["p-value"])
+        df_contrast.insert(0, "Contrast", contrast)
+        results.append(df_contrast)
 
-    for feature in df_features_proc.columns:
-        is_normal_group1 = test_normality(group1_data[feature], args.pvalue_shapiro)
-        is_normal_group2 = test_normality(group2_data[feature], args.pvalue_shapiro)
+    df_omnibus = omnibus_tests(
+        list(groups.values()), [normal[state] for state in disease_states]
+    )
+    df_omnibus["Omnibus FDR"] = false_discovery_control(df_omnibus["Omnibus p-value"])
 
-        if is_normal_group1 and is_normal_group2:
-            stat, p = ttest_ind(group1_data[feature], group2_data[feature])
-            results.append([feature, "T-test", stat, p])
-        else:
-            stat, p = mannwhitneyu(group1_data[feature], group2_data[feature])
-            results.append([feature, "Mann-Whitney U", stat, p])
+    return (
+        pd.concat(results, ignore_index=True)
+        .merge(df_omnibus, on="Feature", how="left")
+        .sort_values(by=["p-value"], ascending=True, kind="stable")
+    )
 
-    df_results = pd.DataFrame(
-        results, columns=["Feature", "Test", "Statistic", "p-value"]
-    ).sort_values(by=["p-value"], ascending=True)
 
-    df_results["FDR"] = false_discovery_control(df_results["p-value"])
+def detect_outliers(X_scaled, method="exact", n_components=10, n_jobs=1):
+    """Detect outlying samples with the Local Outlier Factor.
+
+    The "exact" method searches the neighbours in the full standardized matrix.
+    The "projected" method first projects the samples onto their leading
+    principal components, where a KD-tree answers the neighbour queries much
+    faster than the brute force search required by wide data.
+
+    Parameters:
+    - X_scaled (np.ndarray): Standardized metabolite data.
+    - method (str): "exact" or "projected".
+    - n_components (int): Number of principal components of the "projected" method.
+    - n_jobs (int): Number of parallel jobs for the neighbour search.
+
+    Returns:
+    - np.ndarray: -1 for outliers and 1 for inliers.
+    - np.ndarray: LOF score of each sample, around 1 for inliers and larger for
+                  outliers.
+
+    """
+    if method == "projected":
+        n_components = min(n_components, *X_scaled.shape)
+        X_scaled = PCA(
+            n_components=n_components, svd_solver="randomized", random_state=0
+        ).fit_transform(X_scaled)
+        lof = LocalOutlierFactor(algorithm="kd_tree", n_jobs=n_jobs)
+    else:
+        lof = LocalOutlierFactor(n_jobs=n_jobs)
+    labels = lof.fit_predict(X_scaled)
+    return labels, -lof.negative_outlier_factor_
+
+
+def main(args):
+    """Main function to analyze metabolite data.
+
+    Parameters:
+    - args (argparse.Namespace): Command-line arguments.
+
+    """
+    with profiler.step("load"):
+        df_features_proc = load_data(
+            args.data_location, args.results_location, args.data_file
+        )
+
+    cache = ResultsCache(args.cache_dir, args.cache_size)
+    with profiler.step("scaling"):
+        X_scaled = cache.get_or_compute(
+            "scaled",
+            lambda: StandardScaler().fit_transform(df_features_proc),
+            args.data_file,
+        )
+    with profiler.step("lof"):
+        outlier_labels, outlier_scores = cache.get_or_compute(
+            "outliers",
+            lambda: detect_outliers(
+                X_scaled, args.outlier_method, args.outlier_components, args.n_jobs
+            ),
+            args.data_file,
+            outlier_method=args.outlier_method,
+            outlier_components=args.outlier_components,
+        )
+    outlier_indices = outlier_labels == -1
+
+    with open(os.path.join(args.results_location, "outliers.txt"), "w") as f:
+        print(
+            "Outliers detected:",
+            df_features_proc[outlier_indices]
+            .index.get_level_values(args.patient_metacol)
+            .values,
+            file=f,
+        )
+    pd.DataFrame(
+        {"LOF score": outlier_scores, "Outlier": outlier_indices},
+        index=df_features_proc.index,
+    ).sort_values(by="LOF score", ascending=False).to_csv(
+        os.path.join(args.results_location, "tables", "outlier_scores.csv"),
+        header=True,
+        sep=",",
+        index=True,
+        encoding="utf-8",
+    )
+
+    def compare():
+        if args.contrasts == "binary":
+            return compare_disease_states(
+                df_features_proc,
+                args.disease_metacol,
+                args.pvalue_shapiro,
+                args.permutations,
+                args.bootstrap,
+            )
+        return compare_contrasts(
+            df_features_proc,
+            args.disease_metacol,
+            args.pvalue_shapiro,
+            args.contrasts,
+            args.permutations,
+            args.bootstrap,
+        )
+
+    with profiler.step("univariate_tests"):
+        df_results = cache.get_or_compute(
+            "univariate_tests",
+            compare,
+            args.data_file,
+            disease_metacol=args.disease_metacol,
+            pvalue_shapiro=args.pvalue_shapiro,
+            contrasts=args.contrasts,
+            permutations=args.permutations,
+            bootstrap=args.bootstrap,
+        )
 
     df_results.to_csv(
         os.path.join(args.results_location, "tables", f"univariate_analysis.csv"),
@@ -138,6 +1006,59 @@ if __name__ == "__main__":
         default=0.05,
         help="Threshold for normality Shapiro-Wilk test.",
     )
+    parser.add_argument(
+        "--contrasts",
+        choices=["binary", "pairwise", "one_vs_rest"],
+        default="binary",
+        help="Compare the two disease states of the data (binary), every pair of disease states (pairwise) or every disease state to all the others (one_vs_rest), with an omnibus ANOVA or Kruskal-Wallis test of all states.",
+    )
+    parser.add_argument(
+        "--permutations",
+        type=int,
+        default=0,
+        help="Number of label permutations of the empirical and min-P adjusted p-values. If 0, they are not computed.",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Number of bootstrap resamples of the 95%% confidence intervals of the fold change and Cohen's d. If 0, they are not computed.",
+    )
+    parser.add_argument(
+        "--outlier_method",
+        choices=["exact", "projected"],
+        default="exact",
+        help="Search the LOF neighbours in the full data (exact) or with a KD-tree on the leading principal components (projected).",
+    )
+    parser.add_argument(
+        "--outlier_components",
+        type=int,
+        default=10,
+        help="Number of principal components of the projected outlier detection.",
+    )
+    parser.add_argument(
+        "--n_jobs",
+        type=int,
+        default=0,
+        help="Number of CPUs shared by the parallel jobs of outlier detection and the BLAS threads. If 0, the NASQQ_CPUS environment variable or all available CPUs.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the cache of intermediate results. If empty, caching is disabled.",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=2048,
+        help="Maximum size of the cache in megabytes.",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        help="Path to the JSON file with the time and peak memory of each step. If empty, the metrics are not saved.",
+    )
 
     args = parser.parse_args()
+    profiler.configure("univariate_analysis", args.metrics_file)
+    args.n_jobs = parallelism.configure(args.n_jobs)
     main(args)
+    profiler.write()
@@ -1 +1 @@
-docker build -t ghcr.io/ardigen/nasqq/python_utils:latest -f Dockerfile . --platform=linux/arm64/v8
+docker build -t ghcr.io/ardigen/nasqq/python_utils:latest -f Dockerfile ../.. --platform=linux/arm64/v8
@@ -44,17 +44,19 @@ workflow {
     PARSE_SAMPLES(params.manifest)
     SPECTRAL_PREPROCESSING(PARSE_SAMPLES.out.samples)
     METABOLITES_QUANTIFICATION(SPECTRAL_PREPROCESSING.out.normalized_metabolites, params.ncores, params.quantif_method)
-    ADD_METADATA(METABOLITES_QUANTIFICATION.out.flow, params.log1p, params.metadata_column)
+    ADD_METADATA(METABOLITES_QUANTIFICATION.out.flow, params.log1p, params.metadata_column, params.data_format, params.float_dtype)
 
     if (params.run_combine_project_batches) {
         combinedResults_to_merge = ADD_METADATA.out.files_to_merge.collect()
         combinedResults_without_merge = ADD_METADATA.out.files_without_merge.collect()
         if (combinedResults_to_merge) {
-            COMBINE_DATASET_BATCHES(combinedResults_to_merge)
+            COMBINE_DATASET_BATCHES(combinedResults_to_merge, params.data_format, params.float_dtype, params.merge_chunksize)
             merged_input = COMBINE_DATASET_BATCHES.out
             
             if (params.run_batch_correction) {
-                BATCH_CORRECTION(merged_input, params.metadata_column)
+                // an empty list stages no file when no saved model is given
+                combat_model = params.combat_model ? file(params.combat_model, checkIfExists: true) : []
+                BATCH_CORRECTION(merged_input, params.metadata_column, params.data_format, params.float_dtype, params.combat_chunksize, params.combat_ref_batch, combat_model)
                 corrected_data = BATCH_CORRECTION.out.flow
             } else {
                 corrected_data = merged_input
@@ -10,13 +10,21 @@ process ADD_METADATA {
         tuple(val(project), val(batch), path(disease_state), path(input_path))
         val(log1p)
         val(metadata)
+        val(data_format)
+        val(float_dtype)
     output:
-        tuple(val(project), val(batch), path("*.txt"), emit: flow)
-        path("*_merged_file.txt"), emit: files_to_merge , optional: true
-        tuple(val(project), val(batch), path("*_merged_file_without_merge.txt"), emit: files_without_merge, optional: true)
+        tuple(val(project), val(batch), path("*_merged_file*"), emit: flow)
+        path("*_merged_file.*"), emit: files_to_merge , optional: true
+        tuple(val(project), val(batch), path("*_merged_file_without_merge.*"), emit: files_without_merge, optional: true)
+        path("metrics_data_merge.json"), emit: metrics
 
     script:
+    def extension = data_format == 'csv' ? 'txt' : data_format
     """
-    data_merge.py $input_path $disease_state ${project}_merged_file.txt $batch $log1p $metadata
+    data_merge.py $input_path $disease_state ${project}_merged_file.${extension} $batch $log1p $metadata \
+        --format ${data_format} \
+        --float_dtype ${float_dtype} \
+        --n_jobs ${task.cpus} \
+        --metrics_file metrics_data_merge.json
     """
 }
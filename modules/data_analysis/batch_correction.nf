@@ -9,11 +9,20 @@ process BATCH_CORRECTION {
     input:
         tuple(val(project), val(batch), path(normalized_metabolites))
         val(metadata_column)
+        val(data_format)
+        val(float_dtype)
+        val(chunksize)
+        val(ref_batch)
+        path(combat_model)
     output:
-        tuple(val(project), val(batch), path('metabolites_batch_corrected.txt'), emit: flow)
+        tuple(val(project), val(batch), path('metabolites_batch_corrected.*'), emit: flow)
         val(metadata_column)
+        path("combat_model.joblib"), emit: model, optional: true
+        path("metrics_batch_correction.json"), emit: metrics
 
     script:
+    def ref_args = ref_batch ? "--ref_batch \"${ref_batch}\"" : ''
+    def model_args = combat_model ? "--apply_model \"${combat_model}\"" : ''
     """
     chmod 777 -R .
     mkdir -p fontconfig_cache
@@ -26,6 +35,14 @@ process BATCH_CORRECTION {
         --data_file "${normalized_metabolites}" \
         --disease_metacol "${metadata_column}" \
         --batch_metacol "batch" \
-        --patient_metacol "patient_no"
+        --patient_metacol "patient_no" \
+        --format "${data_format}" \
+        --float_dtype "${float_dtype}" \
+        --chunksize ${chunksize} \
+        --save_model combat_model.joblib \
+        --n_jobs ${task.cpus} \
+        --metrics_file metrics_batch_correction.json \
+        ${ref_args} \
+        ${model_args}
     """
 }
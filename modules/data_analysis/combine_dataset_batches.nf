@@ -6,11 +6,21 @@ options    = initOptions(params.options)
 process COMBINE_DATASET_BATCHES {
     input:
         path(input_path)
+        val(data_format)
+        val(float_dtype)
+        val(chunksize)
     output:
-        tuple(val("combined_projects"), val("combined_projects_batch"), path("merged_batches.txt"), emit: flow)
+        tuple(val("combined_projects"), val("combined_projects_batch"), path("merged_batches.*"), emit: flow)
+        path("metrics_merge_batches.json"), emit: metrics
 
     script:
+    def extension = data_format == 'csv' ? 'txt' : data_format
     """
-    merge_batches.py --folder_path "." --output_name merged_batches.txt
+    merge_batches.py --folder_path "." --output_name merged_batches.${extension} \
+        --format ${data_format} \
+        --float_dtype ${float_dtype} \
+        --chunksize ${chunksize} \
+        --n_jobs ${task.cpus} \
+        --metrics_file metrics_merge_batches.json
     """
 }
@@ -10,10 +10,16 @@ process EXPLORATORY_DATA_ANALYSIS {
     input:
         tuple(val(project), val(batch), path(normalized_metabolites))
         val(metadata_column)
+        val(pca_solver)
+        val(figure_format)
+        val(clustermap_max_samples)
+        val(cache_dir)
+        val(cache_size)
     output:
         path('*'), emit: fd
 
     script:
+    def cache_args = cache_dir ? "--cache_dir \"${cache_dir}\" --cache_size ${cache_size}" : ''
     """
     chmod 777 -R .
     mkdir -p fontconfig_cache
@@ -26,13 +32,25 @@ process EXPLORATORY_DATA_ANALYSIS {
         exploratory_data_analysis.py \
             --data_file "${normalized_metabolites}" \
             --disease_metacol "${metadata_column}" \
-            --patient_metacol "patient_no"
+            --patient_metacol "patient_no" \
+            --pca_solver "${pca_solver}" \
+            --figure_format "${figure_format}" \
+            --clustermap_max_samples ${clustermap_max_samples} \
+            --n_jobs ${task.cpus} \
+            --metrics_file results/metrics_exploratory_data_analysis.json \
+            ${cache_args}
     else
         exploratory_data_analysis.py \
             --data_file "${normalized_metabolites}" \
             --disease_metacol "${metadata_column}" \
             --patient_metacol "patient_no" \
-            --batch_metacol "batch"
+            --batch_metacol "batch" \
+            --pca_solver "${pca_solver}" \
+            --figure_format "${figure_format}" \
+            --clustermap_max_samples ${clustermap_max_samples} \
+            --n_jobs ${task.cpus} \
+            --metrics_file results/metrics_exploratory_data_analysis.json \
+            ${cache_args}
     fi
     """
 }
@@ -10,11 +10,17 @@ process FEATURES_PROCESSING {
         tuple(val(project), val(batch), path(normalized_metabolites))
         val(metadata_column)
         val(zeronan_threshold)
+        val(data_format)
+        val(chunksize)
+        val(contrasts)
+        val(cache_dir)
+        val(cache_size)
     output:
         tuple(val(project), val(batch), path('results/tables/metabolites_processed.parquet'), emit: fd)
         path('*')
 
     script:
+    def cache_args = cache_dir ? "--cache_dir \"${cache_dir}\" --cache_size ${cache_size}" : ''
     """
     chmod 777 -R .
     mkdir -p fontconfig_cache
@@ -28,6 +34,12 @@ process FEATURES_PROCESSING {
         --disease_metacol "${metadata_column}" \
         --batch_metacol "batch" \
         --patient_metacol "patient_no" \
-        --zeronan_threshold "${zeronan_threshold}"
+        --zeronan_threshold "${zeronan_threshold}" \
+        --format "${data_format}" \
+        --chunksize ${chunksize} \
+        --contrasts "${contrasts}" \
+        --n_jobs ${task.cpus} \
+        --metrics_file results/metrics_features_processing.json \
+        ${cache_args}
     """
 }
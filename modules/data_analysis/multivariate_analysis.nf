@@ -12,12 +12,22 @@ process MULTIVARIATE_ANALYSIS {
         val(metadata_column)
         val(test_size)
         val(cross_val_fold)
+        val(model_selection)
+        val(c_path)
+        val(scaling)
+        val(nested_cv)
+        val(cache_dir)
+        val(cache_size)
     output:
         tuple(val(project),val("multivariate"), path("results/tables/*features_relative_importance.csv"), emit: multivariate)
         path("results/tables/models_stratification.csv")
+        path("results/metrics_multivariate_analysis.json"), emit: metrics
+        path("results/tables/logistic_regression_path.csv"), optional: true
+        path("results/tables/nested_cross_validation.csv"), optional: true
         tuple(path("results/figures/*weights.svg"), path("results/tables/*features_weights.csv"), emit: optional_output, optional: true)
 
     script:
+    def cache_args = cache_dir ? "--cache_dir \"${cache_dir}\" --cache_size ${cache_size}" : ''
     """
     chmod 777 -R .
     mkdir -p fontconfig_cache
@@ -32,6 +42,13 @@ process MULTIVARIATE_ANALYSIS {
         --patient_metacol "patient_no" \
         --batch_metacol "batch" \
         --test_size "${test_size}" \
-        --cross_val_fold "${cross_val_fold}"
+        --cross_val_fold "${cross_val_fold}" \
+        --model_selection "${model_selection}" \
+        --c_path ${c_path} \
+        --scaling "${scaling}" \
+        --nested_cv ${nested_cv} \
+        --n_jobs ${task.cpus} \
+        --metrics_file results/metrics_multivariate_analysis.json \
+        ${cache_args}
     """
 }
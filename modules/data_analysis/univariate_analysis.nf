@@ -10,11 +10,20 @@ process UNIVARIATE_ANALYSIS {
         tuple(val(project), val(batch), path(normalized_metabolites))
         val(metadata_column)
         val(pvalue_shapiro)
+        val(outlier_method)
+        val(contrasts)
+        val(permutations)
+        val(bootstrap)
+        val(cache_dir)
+        val(cache_size)
     output:
         tuple(val(project), val("univariate"), path("results/tables/univariate_analysis.csv"), emit: univariate)
         path("results/outliers.txt")
+        path("results/tables/outlier_scores.csv")
+        path("results/metrics_univariate_analysis.json"), emit: metrics
 
     script:
+    def cache_args = cache_dir ? "--cache_dir \"${cache_dir}\" --cache_size ${cache_size}" : ''
     """
     chmod 777 -R .
     mkdir -p fontconfig_cache
@@ -27,6 +36,13 @@ process UNIVARIATE_ANALYSIS {
         --data_file "${normalized_metabolites}" \
         --disease_metacol "${metadata_column}" \
         --patient_metacol "patient_no" \
-        --pvalue_shapiro ${pvalue_shapiro}
+        --pvalue_shapiro ${pvalue_shapiro} \
+        --outlier_method "${outlier_method}" \
+        --contrasts "${contrasts}" \
+        --permutations ${permutations} \
+        --bootstrap ${bootstrap} \
+        --n_jobs ${task.cpus} \
+        --metrics_file results/metrics_univariate_analysis.json \
+        ${cache_args}
     """
 }
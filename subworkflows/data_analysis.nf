@@ -11,12 +11,23 @@ workflow DATA_ANALYSIS {
         metabolites
         metadata_column
     main:
-        FEATURES_PROCESSING(metabolites, metadata_column, params.zeronan_threshold)
-        EXPLORATORY_DATA_ANALYSIS(FEATURES_PROCESSING.out.fd, metadata_column)
-        UNIVARIATE_ANALYSIS(FEATURES_PROCESSING.out.fd, metadata_column, params.pvalue_shapiro)
-        MULTIVARIATE_ANALYSIS(FEATURES_PROCESSING.out.fd, metadata_column, params.test_size, params.cross_val_fold)
+        // the cache is shared by the tasks as an absolute host path, mounted in the containers
+        cache_dir = params.cache_dir ? file(params.cache_dir).toString() : ''
+        if (cache_dir) {
+            file(cache_dir).mkdirs()
+        }
+        FEATURES_PROCESSING(metabolites, metadata_column, params.zeronan_threshold, params.data_format, params.features_chunksize, params.contrasts, cache_dir, params.cache_size)
+        EXPLORATORY_DATA_ANALYSIS(FEATURES_PROCESSING.out.fd, metadata_column, params.pca_solver, params.figure_format, params.clustermap_max_samples, cache_dir, params.cache_size)
+        UNIVARIATE_ANALYSIS(FEATURES_PROCESSING.out.fd, metadata_column, params.pvalue_shapiro, params.outlier_method, params.contrasts, params.permutations, params.bootstrap, cache_dir, params.cache_size)
+        // the multivariate models are binary classifiers of two disease states
+        if (params.contrasts == 'binary') {
+            MULTIVARIATE_ANALYSIS(FEATURES_PROCESSING.out.fd, metadata_column, params.test_size, params.cross_val_fold, params.model_selection, params.c_path, params.scaling, params.nested_cv, cache_dir, params.cache_size)
+            multivariate_results = MULTIVARIATE_ANALYSIS.out.multivariate
+        } else {
+            multivariate_results = Channel.empty()
+        }
 
     emit:
         univariate = UNIVARIATE_ANALYSIS.out.univariate
-        multivariate = MULTIVARIATE_ANALYSIS.out.multivariate
+        multivariate = multivariate_results
 }
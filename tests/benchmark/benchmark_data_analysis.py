@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+BIN_LOCATION = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "bin")
+)
+FILE_EXTENSIONS = {"csv": ".txt", "parquet": ".parquet", "arrow": ".arrow"}
+STAGES = [
+    "merge_files",
+    "merge_batches",
+    "batch_correction",
+    "features_processing",
+    "exploratory_data_analysis",
+    "univariate_analysis",
+    "multivariate_analysis",
+]
+
+
+def generate_cohort(
+    output_location,
+    n_samples=100,
+    n_features=500,
+    n_batches=2,
+    sparsity=0.2,
+    effect_fraction=0.1,
+    random_state=0,
+):
+    """Generate a synthetic NMR-like cohort split into batches.
+
+    Log-scale metabolite intensities are drawn around a feature-specific level, with
+    a feature-specific shift in every batch and a shift between disease states for a
+    fraction of the features. Missing metabolites are recorded as zeros, with a
+    zero fraction that varies between features around the requested sparsity.
+
+    Parameters:
+    - output_location (str): Directory where the batch files will be written.
+    - n_samples (int): Total number of samples.
+    - n_features (int): Number of metabolites.
+    - n_batches (int): Number of batches.
+    - sparsity (float): Mean fraction of zero values, from range 0-1.
+    - effect_fraction (float): Fraction of metabolites differing between disease states.
+    - random_state (int): Seed of the random generator.
+
+    Returns:
+    - list: Tuples of features file, metadata file and batch name of every batch.
+
+    """
+    rng = np.random.RandomState(random_state)
+    os.makedirs(output_location, exist_ok=True)
+
+    features = [f"metabolite_{i}" for i in range(n_features)]
+    levels = rng.normal(16, 1.5, n_features)
+    effects = np.where(
+        rng.rand(n_features) < effect_fraction, rng.normal(0, 1, n_features), 0
+    )
+    zero_probabilities = np.clip(rng.uniform(0, 2 * sparsity, n_features), 0, 1)
+
+    batches = []
+    for batch_number, batch_index in enumerate(
+        np.array_split(np.arange(n_samples), n_batches), start=1
+    ):
+        batch = f"batch{batch_number}"
+        states = rng.rand(len(batch_index)) < 0.5
+        values = (
+            levels
+            + rng.normal(0, 0.5, n_features)
+            + np.outer(states, effects)
+            + rng.normal(0, 0.5, (len(batch_index), n_features))
+        )
+        values[rng.rand(*values.shape) < zero_probabilities] = 0
+
+        patients = [str(10 * (i + 1)) for i in batch_index]
+        metadata = pd.DataFrame(
+            {
+                "patient_no": patients,
+                "batch": batch,
+                "State": np.where(states, "Condition", "Baseline"),
+            }
+        )
+        df_features = pd.DataFrame(values, columns=features)
+        df_features.insert(0, "batch", batch)
+        df_features.insert(0, "patient_no", patients)
+
+        features_file = os.path.join(output_location, f"features_{batch_number}.txt")
+        metadata_file = os.path.join(output_location, f"metadata_{batch_number}.csv")
+        df_features.to_csv(features_file, index=False)
+        metadata.to_csv(metadata_file, index=False)
+        batches.append((features_file, metadata_file, batch))
+
+    return batches
+
+
+def run_stage(command, cwd):
+    """Run a pipeline script and measure its wall time and peak memory.
+
+    Parameters:
+    - command (list): Command line of the script.
+    - cwd (str): Working directory of the script.
+
+    Returns:
+    - dict: Wall time in seconds, peak resident memory in megabytes and return code.
+
+    """
+    env = dict(os.environ, MPLBACKEND="Agg")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        print(stderr.decode(errors="replace"), file=sys.stderr)
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    rss_unit = 1024**2 if sys.platform == "darwin" else 1024
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": usage.ru_maxrss / rss_unit,
+        "returncode": process.returncode,
+    }
+
+
+def stage_commands(stage, workdir, batches, args):
+    """Build the command lines of a stage, as called by the pipeline modules.
+
+    Parameters:
+    - stage (str): Name of the stage.
+    - workdir (str): Working directory of the benchmark.
+    - batches (list): Batches returned by `generate_cohort`.
+    - args (argparse.Namespace): Command-line arguments of the benchmark.
+
+    Returns:
+    - list: Command lines of the stage.
+
+    """
+    extension = FILE_EXTENSIONS[args.format]
+    merged_file = os.path.join(workdir, f"merged_batches{extension}")
+    corrected_file = os.path.join(workdir, f"metabolites_batch_corrected{extension}")
+    processed_file = os.path.join(
+        workdir, "results", "tables", "metabolites_processed.parquet"
+    )
+    metacols = ["--disease_metacol", "State", "--patient_metacol", "patient_no"]
+
+    def script(name):
+        return [sys.executable, os.path.join(BIN_LOCATION, name)]
+
+    if stage == "merge_files":
+        return [
+            script("data_merge.py")
+            + [
+                features_file,
+                metadata_file,
+                os.path.join(workdir, "batches", f"{batch}_merged_file{extension}"),
+                batch,
+                "false",
+                "State",
+                "--format",
+                args.format,
+            ]
+            for features_file, metadata_file, batch in batches
+        ]
+    if stage == "merge_batches":
+        return [
+            script("merge_batches.py")
+            + [
+                "--folder_path",
+                os.path.join(workdir, "batches"),
+                "--output_name",
+                merged_file,
+                "--format",
+                args.format,
+            ]
+        ]
+    if stage == "batch_correction":
+        return [
+            script("batch_correction.py")
+            + ["--data_file", merged_file, "--batch_metacol", "batch", "--format"]
+            + [args.format]
+            + metacols
+        ]
+    if stage == "features_processing":
+        data_file = corrected_file if os.path.exists(corrected_file) else merged_file
+        return [
+            script("features_processing.py")
+            + ["--data_file", data_file, "--batch_metacol", "batch", "--format"]
+            + [args.format, "--results_location", os.path.join(workdir, "results")]
+            + metacols
+        ]
+    extra_args = {
+        "exploratory_data_analysis": ["--batch_metacol", "batch"],
+        "univariate_analysis": [],
+        "multivariate_analysis": ["--batch_metacol", "batch"],
+    }[stage]
+    return [
+        script(f"{stage}.py")
+        + ["--data_file", processed_file, "--results_location"]
+        + [os.path.join(workdir, "results")]
+        + metacols
+        + extra_args
+    ]
+
+
+def read_steps(metrics_files):
+    """Combine the steps recorded by the scripts in their metrics files.
+
+    Parameters:
+    - metrics_files (list): Paths to the JSON metrics files of a stage.
+
+    Returns:
+    - dict: Total wall time in seconds and peak resident memory in megabytes of
+            every step, over all calls of the stage.
+
+    """
+    steps = {}
+    for metrics_file in metrics_files:
+        if not os.path.exists(metrics_file):
+            continue
+        with open(metrics_file) as f:
+            for step in json.load(f)["steps"]:
+                total = steps.setdefault(
+                    step["step"], {"seconds": 0.0, "peak_rss_mb": 0.0}
+                )
+                total["seconds"] += step["seconds"]
+                total["peak_rss_mb"] = max(total["peak_rss_mb"], step["peak_rss_mb"])
+    return steps
+
+
+def run_benchmark(args):
+    """Generate a synthetic cohort and benchmark every selected stage on it.
+
+    Parameters:
+    - args (argparse.Namespace): Command-line arguments.
+
+    Returns:
+    - dict: Benchmark report.
+
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark_data_analysis_")
+    os.makedirs(os.path.join(workdir, "batches"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "metrics"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "results", "tables"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "results", "figures"), exist_ok=True)
+
+    cohort = {
+        "n_samples": args.n_samples,
+        "n_features": args.n_features,
+        "n_batches": args.n_batches,
+        "sparsity": args.sparsity,
+        "random_state": args.random_state,
+    }
+    batches = generate_cohort(os.path.join(workdir, "cohort"), **cohort)
+
+    # importing the helpers and their dependencies is a fixed cost of every stage
+    baseline = run_stage(
+        [
+            sys.executable,
+            "-c",
+            f"import sys; sys.path.insert(0, {BIN_LOCATION!r}); import ml_helpers",
+        ],
+        workdir,
+    )
+
+    stages = {}
+    for stage in [stage for stage in STAGES if stage in args.stages]:
+        runs = []
+        for _ in range(args.repeat):
+            commands = stage_commands(stage, workdir, batches, args)
+            metrics_files = [
+                os.path.join(workdir, "metrics", f"{stage}_{i}.json")
+                for i in range(len(commands))
+            ]
+            results = [
+                run_stage(command + ["--metrics_file", metrics_file], workdir)
+                for command, metrics_file in zip(commands, metrics_files)
+            ]
+            runs.append(
+                {
+                    "seconds": sum(result["seconds"] for result in results),
+                    "peak_rss_mb": max(result["peak_rss_mb"] for result in results),
+                    "returncode": max(result["returncode"] for result in results),
+                    "steps": read_steps(metrics_files),
+                }
+            )
+        fastest_run = min(runs, key=lambda run: run["seconds"])
+        stages[stage] = {
+            "seconds": fastest_run["seconds"],
+            "seconds_median": float(np.median([run["seconds"] for run in runs])),
+            "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+            "returncode": max(run["returncode"] for run in runs),
+            "steps": fastest_run["steps"],
+        }
+        print(
+            f"{stage}: {stages[stage]['seconds']:.2f} s, "
+            f"{stages[stage]['peak_rss_mb']:.0f} MB"
+        )
+
+    return {
+        "label": args.label,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cohort": cohort,
+        "format": args.format,
+        "repeat": args.repeat,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "import_seconds": baseline["seconds"],
+            "import_peak_rss_mb": baseline["peak_rss_mb"],
+        },
+        "stages": stages,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the data analysis scripts on a synthetic cohort."
+    )
+    parser.add_argument("--n_samples", type=int, default=100, help="Number of samples.")
+    parser.add_argument(
+        "--n_features", type=int, default=500, help="Number of metabolites."
+    )
+    parser.add_argument("--n_batches", type=int, default=2, help="Number of batches.")
+    parser.add_argument(
+        "--sparsity", type=float, default=0.2, help="Mean fraction of zero values."
+    )
+    parser.add_argument(
+        "--random_state", type=int, default=0, help="Seed of the cohort generator."
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(FILE_EXTENSIONS),
+        default="csv",
+        help="Format of the tables exchanged between the stages.",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        default=STAGES,
+        help="Stages to benchmark. Later stages need the outputs of earlier ones.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Number of runs of every stage."
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Working directory of the benchmark. If empty, a temporary one is used.",
+    )
+    parser.add_argument(
+        "--label", default="", help="Label of the benchmarked version in the report."
+    )
+    parser.add_argument(
+        "--output", default="benchmark.json", help="Path to the JSON report."
+    )
+
+    args = parser.parse_args()
+    report = run_benchmark(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
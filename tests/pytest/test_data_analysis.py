@@ -2,7 +2,9 @@
 
 from argparse import Namespace
 import os
+import json
 import pytest
+import numpy as np
 import pandas as pd
 import random
 import sys
@@ -11,10 +13,15 @@ import sys
 sys.path.append("../../bin/")
 from data_merge import merge_files
 from merge_batches import merge_csv_files
-from exploratory_data_analysis import main as main_eda
+from exploratory_data_analysis import main as main_eda, compute_pca
 from features_processing import main as main_features_processing, load_and_process_data
-from univariate_analysis import main as main_univariate
-from multivariate_analysis import main as main_multivariate
+from univariate_analysis import main as main_univariate, shapiro_wilk, univariate_tests, compare_contrasts, permutation_tests, _permutation_statistics, effect_sizes
+from multivariate_analysis import main as main_multivariate, successive_halving, regularization_path, nested_cross_validation, split_jobs
+from batch_correction import apply_combat_correction, chunked_combat_correction
+from ml_helpers import get_shap_values, FoldStandardScaler, RankedMatrix, Parallelism, FoldStatistics, ResultsCache, StageProfiler, correlation_matrix, read_table, write_table
+
+sys.path.append("../benchmark/")
+from benchmark_data_analysis import generate_cohort
 
 # Set random seed for reproducibility
 random.seed(1234)
@@ -85,9 +92,43 @@ def test_merge_batches(request, tmpdir, data_location):
     result_df = pd.read_csv(result_file, sep=';')
     assert not result_df.empty
 
+    streamed_file = str(tmpdir.join("test_merged_features_metadata_streamed.csv"))
+    merge_csv_files(folder_path, streamed_file, chunksize=2)
+    pd.testing.assert_frame_equal(pd.read_csv(streamed_file, sep=';'), result_df)
+
     result_df_directory = os.path.dirname(result_file)
     request.config.cache.set("result_df_directory", result_df_directory)
 
+# Test for merging and processing data exchanged in binary formats
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+@pytest.mark.filterwarnings("ignore:np.find_common_type*")
+def test_binary_format_roundtrip(tmpdir, file_format):
+    extension = ".parquet" if file_format == "parquet" else ".arrow"
+    merged_files = [
+        merge_files(
+            get_sample_data_path(file_number, "metadata"),
+            get_sample_data_path(file_number, "features"),
+            str(tmpdir.join(f"test_merged_features_metadata_{file_number}{extension}")),
+            f"batch{file_number}",
+            False,
+            "State",
+            file_format,
+            "float32",
+        )
+        for file_number in [1, 2, 3]
+    ]
+
+    result_file = str(tmpdir.join(f"merged{extension}.out"))
+    merged_df = merge_csv_files(str(tmpdir), result_file, file_format, "float32")
+    assert len(merged_df) == sum(len(df) for df in merged_files)
+    assert merged_df["patient_no"].dtype == object
+
+    processed_data = load_and_process_data(
+        str(tmpdir), os.path.basename(result_file), ['patient_no', 'batch', 'State'], 0.7, file_format
+    )
+    assert all(dtype == "float32" for dtype in processed_data.dtypes)
+    assert processed_data.index.names == ['patient_no', 'batch', 'State']
+
 # Test for loading and processing data
 @pytest.mark.filterwarnings("ignore:np.find_common_type*")
 def test_load_and_process_data(request, data_location, data_file):
@@ -99,6 +140,12 @@ def test_load_and_process_data(request, data_location, data_file):
     assert isinstance(processed_data, pd.DataFrame)
     assert all(col in processed_data.index.names for col in index_columns)
 
+    chunked_data, summary = load_and_process_data(
+        data_location, data_file, index_columns, zeronan_threshold, chunksize=2, return_summary=True
+    )
+    pd.testing.assert_frame_equal(chunked_data, processed_data, check_dtype=False)
+    assert list(summary.index[~summary["removed"]]) == list(processed_data.columns)
+
 # Test for main features processing
 @pytest.mark.filterwarnings("ignore:np.find_common_type*")
 def test_main_features_processing(request, tmpdir, data_location):
@@ -116,12 +163,18 @@ def test_main_features_processing(request, tmpdir, data_location):
         disease_metacol=disease_metacol,
         batch_metacol=batch_metacol,
         patient_metacol=patient_metacol,
-        zeronan_threshold=zeronan_threshold
+        zeronan_threshold=zeronan_threshold,
+        format="csv",
+        chunksize=None,
+        contrasts="binary",
+        cache_dir=None,
+        cache_size=2048
     )
     main_features_processing(args_features_processing)
 
     metabolites_processed_file = os.path.join(results_location, "tables", "metabolites_processed.parquet")
     assert os.path.exists(metabolites_processed_file)
+    assert os.path.exists(os.path.join(results_location, "tables", "features_zeronan_summary.csv"))
     request.config.cache.set("metabolites_processed_file", metabolites_processed_file)
 
 # Test for main exploratory data analysis
@@ -138,7 +191,15 @@ def test_main_eda(request, tmpdir, data_location, data_file):
         data_file=data_file,
         disease_metacol=disease_metacol,
         patient_metacol=patient_metacol,
-        batch_metacol=batch_metacol
+        batch_metacol=batch_metacol,
+        pca_solver="randomized",
+        pca_components=10,
+        figure_format="auto",
+        raster_threshold=10000,
+        clustermap_max_samples=30,
+        correlation_method="pearson",
+        cache_dir=None,
+        cache_size=2048
     )
 
     os.makedirs(os.path.join(results_location, "figures"), exist_ok=True)
@@ -159,6 +220,22 @@ def test_main_eda(request, tmpdir, data_location, data_file):
     for file_name in figures_file_names:
         assert os.path.exists(os.path.join(results_location, "figures", file_name)) 
 
+    args_eda.figure_format = "none"
+    main_eda(args_eda)
+    for file_name in ["pca_explained_variance.csv", "pca_scores.csv", "correlation_features.csv", "correlation_patients.csv"]:
+        assert os.path.exists(os.path.join(results_location, "tables", file_name))
+
+# Test for truncated PCA against the full decomposition
+def test_compute_pca_truncated():
+    rng = np.random.RandomState(0)
+    scaled_data = rng.normal(size=(30, 50))
+    scaled_data = (scaled_data - scaled_data.mean(axis=0)) / scaled_data.std(axis=0)
+
+    _, full_ratio = compute_pca(scaled_data)
+    pca_result, truncated_ratio = compute_pca(scaled_data, svd_solver="arpack", n_components=5)
+    assert pca_result.shape == (30, 5)
+    assert np.allclose(truncated_ratio, full_ratio[:5])
+
 # Test for main univariate analysis
 @pytest.mark.filterwarnings("ignore:n_neighbors*", "ignore:np.find_common_type*")
 def test_main_univariate(request, tmpdir, data_location, data_file):
@@ -173,22 +250,56 @@ def test_main_univariate(request, tmpdir, data_location, data_file):
         data_file=data_file,
         disease_metacol=disease_metacol,
         patient_metacol=patient_metacol,
-        pvalue_shapiro=pvalue_shapiro
+        pvalue_shapiro=pvalue_shapiro,
+        outlier_method="projected",
+        outlier_components=10,
+        n_jobs=2,
+        contrasts="binary",
+        permutations=0,
+        bootstrap=0,
+        cache_dir=str(tmpdir.join("cache")),
+        cache_size=2048
     )
 
     os.makedirs(os.path.join(results_location, "tables"), exist_ok=True)
     main_univariate(args_univariate)
+    first_results_df = pd.read_csv(os.path.join(results_location, "tables", "univariate_analysis.csv"))
+    main_univariate(args_univariate)
 
     assert os.path.exists(os.path.join(results_location, "tables", "univariate_analysis.csv"))
 
     outliers_file = os.path.join(results_location, "outliers.txt")
     assert os.path.exists(outliers_file), "outliers.txt file does not exist"
+    outlier_scores = pd.read_csv(os.path.join(results_location, "tables", "outlier_scores.csv"))
+    assert all(col in outlier_scores.columns for col in ['patient_no', 'LOF score', 'Outlier'])
 
     results_file = os.path.join(results_location, "tables", "univariate_analysis.csv")
     results_df = pd.read_csv(results_file)
 
     assert not results_df.empty
     assert all(col in results_df.columns for col in ['Feature', 'Test', 'Statistic', 'p-value', 'FDR'])
+    pd.testing.assert_frame_equal(results_df, first_results_df)
+
+# Test for vectorized univariate engine against per-feature SciPy calls
+def test_univariate_tests_matches_scipy():
+    from scipy.stats import shapiro, ttest_ind, mannwhitneyu
+
+    rng = np.random.RandomState(0)
+    group1 = pd.DataFrame(np.round(rng.lognormal(size=(6, 40)), 1))
+    group2 = pd.DataFrame(rng.normal(size=(15, 40)))
+    group1.iloc[:, :20] = rng.normal(size=(6, 20))
+
+    w, p_values = shapiro_wilk(group2.values)
+    expected = [shapiro(group2[feature]) for feature in group2.columns]
+    assert np.allclose(w, [result[0] for result in expected])
+    assert np.allclose(p_values, [result[1] for result in expected])
+
+    results = univariate_tests(group1, group2, pvalue_shapiro=0.05)
+    for _, row in results.iterrows():
+        test = ttest_ind if row["Test"] == "T-test" else mannwhitneyu
+        stat, p = test(group1[row["Feature"]], group2[row["Feature"]])
+        assert np.isclose(row["Statistic"], stat)
+        assert np.isclose(row["p-value"], p)
 
 # Test for main multivariate analysis
 @pytest.mark.filterwarnings("ignore:DeprecationWarning")
@@ -206,7 +317,20 @@ def test_main_multivariate(request, tmpdir, data_location, data_file):
         patient_metacol=patient_metacol,
         batch_metacol=batch_metacol,
         test_size=0.5,
-        cross_val_fold=2
+        cross_val_fold=2,
+        n_jobs=2,
+        model_selection="full",
+        screening_splits=20,
+        halving_factor=3,
+        shap_perturbation="tree_path_dependent",
+        shap_approximate=False,
+        c_path=0,
+        scaling="fold",
+        nested_cv=0,
+        inner_splits=20,
+        outer_jobs=0,
+        cache_dir=str(tmpdir.join("cache")),
+        cache_size=2048
     )
 
     os.makedirs(os.path.join(results_location, "tables"), exist_ok=True)
@@ -236,3 +360,443 @@ def test_main_multivariate(request, tmpdir, data_location, data_file):
     assert not relative_importance_df.empty
     assert 'Feature' in relative_importance_df.columns
     assert 'relative_importance' in relative_importance_df.columns
+
+    # the cached cross-validation holds no fitted estimators, the best ones are refitted
+    import joblib
+
+    cache_dir = args_multivariate.cache_dir
+    weights_file = os.path.join(results_location, "tables", models_file_names[2])
+    expected_weights = pd.read_csv(weights_file)
+    for name in os.listdir(cache_dir):
+        if not name.startswith("cross_validation"):
+            os.remove(os.path.join(cache_dir, name))
+    scores, _, _ = joblib.load(os.path.join(cache_dir, os.listdir(cache_dir)[0]))
+    assert all(isinstance(estimator, str) for df in scores.values() for estimator in df["estimator"])
+    main_multivariate(args_multivariate)
+    pd.testing.assert_frame_equal(pd.read_csv(weights_file), expected_weights)
+
+# Test for successive halving model selection
+def test_successive_halving():
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import StratifiedShuffleSplit
+
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame(rng.normal(size=(40, 6)))
+    y = pd.Series((X[0] + rng.normal(scale=0.5, size=40) > 0).astype(int))
+    models = {
+        f"Logistic regression (C={C})": LogisticRegression(C=C) for C in [0.001, 0.1, 1.0]
+    }
+    splits = list(StratifiedShuffleSplit(n_splits=12, random_state=0).split(X, y))
+
+    results = successive_halving(models, X, y, splits, min_splits=2, factor=2, n_jobs=1)
+
+    budgets = {name: df["n_splits"].iloc[0] for name, df in results.items()}
+    assert sorted(budgets.values()) == [2, 4, 12]
+    assert all(len(df) == budgets[name] for name, df in results.items())
+
+    # a factor below 2 never reduces the candidates and a zero budget never grows
+    with pytest.raises(ValueError):
+        successive_halving(models, X, y, splits, min_splits=2, factor=1, n_jobs=1)
+    with pytest.raises(ValueError):
+        successive_halving(models, X, y, splits, min_splits=0, factor=2, n_jobs=1)
+
+# Test that the data preparation scripts do not load the modelling and plotting libraries
+def test_script_helpers_imports():
+    import subprocess
+
+    code = (
+        "import sys; sys.path.insert(0, '../../bin/'); import data_merge, merge_batches; "
+        "print(' '.join(m for m in ['matplotlib', 'shap', 'sklearn', 'scipy'] if m in sys.modules))"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
+
+# Test for the content-addressed results cache
+def test_results_cache(tmpdir):
+    data_file = str(tmpdir.join("data.txt"))
+    with open(data_file, "w") as f:
+        f.write("a;b\n1;2\n")
+    cache = ResultsCache(str(tmpdir.join("cache")), max_size_mb=1)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return np.zeros(1000)
+
+    cache.get_or_compute("stage", compute, data_file, threshold=0.5)
+    cache.get_or_compute("stage", compute, data_file, threshold=0.5)
+    assert len(calls) == 1
+    assert cache.key("stage", data_file, threshold=0.5) != cache.key("stage", data_file, threshold=0.7)
+
+    cache.max_size_mb = 0.01
+    cache.get_or_compute("stage", compute, data_file, threshold=0.7)
+    assert len(calls) == 2
+    assert len(os.listdir(str(tmpdir.join("cache")))) == 1
+
+    # an empty directory, as the default cache_dir parameter, disables caching
+    ResultsCache("").get_or_compute("stage", compute, data_file, threshold=0.7)
+    assert len(calls) == 3
+
+# Test for the synthetic cohort generator of the benchmarks
+def test_generate_cohort(tmpdir):
+    batches = generate_cohort(str(tmpdir), n_samples=40, n_features=30, n_batches=3, sparsity=0.25)
+    merged = [
+        merge_files(features_file, metadata_file, str(tmpdir.join(f"{batch}.txt")), batch, False, "State")
+        for features_file, metadata_file, batch in batches
+    ]
+    assert sum(len(df) for df in merged) == 40
+    assert all(df.shape[1] == 33 for df in merged)
+    assert 0.1 < np.mean([(df.iloc[:, 3:] == 0).values.mean() for df in merged]) < 0.4
+
+# Test for the per-step profiler
+def test_stage_profiler(tmpdir):
+    metrics_file = str(tmpdir.join("metrics", "metrics.json"))
+    profiler = StageProfiler("test", metrics_file)
+    with profiler.step("outer"):
+        with profiler.step("inner"):
+            np.ones((1000, 1000))
+    profiler.write()
+
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    assert [step["step"] for step in metrics["steps"]] == ["outer", "outer/inner"]
+    assert metrics["steps"][0]["peak_rss_mb"] >= metrics["steps"][1]["peak_rss_mb"] > 0
+    assert metrics["peak_rss_mb"] >= metrics["steps"][0]["peak_rss_mb"]
+
+# Test that the chunked batch correction matches the in-memory ComBat correction
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+def test_chunked_combat_correction(tmpdir, file_format):
+    batches = generate_cohort(str(tmpdir), n_samples=60, n_features=20, n_batches=3, sparsity=0.1)
+    data = pd.concat([pd.read_csv(features_file) for features_file, _, _ in batches])
+    data = data.sample(frac=1, random_state=0).set_index(["patient_no", "batch"])
+    data_file = str(tmpdir.join(f"merged.{file_format}"))
+    write_table(data, data_file, file_format, index=True)
+    output_file = "metabolites_batch_corrected" + (".txt" if file_format == "csv" else ".parquet")
+
+    with tmpdir.as_cwd():
+        apply_combat_correction(data, "batch", file_format=file_format)
+        expected = read_table(output_file, file_format, ["patient_no", "batch"])
+        chunked_combat_correction(data_file, ["patient_no", "batch"], "batch", file_format, chunksize=7)
+        corrected = read_table(output_file, file_format, ["patient_no", "batch"])
+
+    assert corrected.index.equals(expected.index)
+    assert np.allclose(corrected.values, expected.values)
+
+# Test that new batches corrected with a saved ComBat model match the correction of the whole cohort
+def test_combat_model_new_batch(tmpdir):
+    batches = generate_cohort(str(tmpdir), n_samples=60, n_features=20, n_batches=3, sparsity=0.1)
+    data = pd.concat([pd.read_csv(features_file) for features_file, _, _ in batches])
+    write_table(data, str(tmpdir.join("cohort.txt")))
+    write_table(data[data["batch"] != "batch3"], str(tmpdir.join("history.txt")))
+    write_table(data[data["batch"] == "batch3"], str(tmpdir.join("new_batch.txt")))
+    index_columns = ["patient_no", "batch"]
+
+    with tmpdir.as_cwd():
+        chunked_combat_correction("cohort.txt", index_columns, "batch", chunksize=None, ref_batch="batch1")
+        expected = read_table("metabolites_batch_corrected.txt", "csv", index_columns)
+        model = chunked_combat_correction("history.txt", index_columns, "batch", chunksize=10, ref_batch="batch1")
+        model = chunked_combat_correction("new_batch.txt", index_columns, "batch", chunksize=None, model=model)
+        corrected = read_table("metabolites_batch_corrected.txt", "csv", index_columns)
+
+    assert list(model["gamma"].index) == ["batch1", "batch2", "batch3"]
+    assert np.allclose(corrected.values, expected.loc[corrected.index].values)
+    assert np.allclose(expected.xs("batch1", level="batch").values, data[data["batch"] == "batch1"].iloc[:, 2:].values)
+
+# Test that a failed batch correction is reported instead of returning no output
+def test_chunked_combat_correction_failure(tmpdir):
+    batches = generate_cohort(str(tmpdir), n_samples=20, n_features=5, n_batches=2)
+    write_table(pd.read_csv(batches[0][0]), str(tmpdir.join("cohort.txt")))
+
+    with tmpdir.as_cwd(), pytest.raises(KeyError):
+        chunked_combat_correction("cohort.txt", ["patient_no", "batch"], "missing_batch", chunksize=None)
+    with tmpdir.as_cwd(), pytest.raises(ValueError):
+        apply_combat_correction(pd.read_csv(batches[0][0]), "batch")
+
+# Test that the BLAS correlations match the pandas correlations
+def test_correlation_matrix():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(rng.normal(16, 0.5, (50, 8)) + rng.normal(0, 1, (50, 1)))
+    df[3] = 1.0
+
+    corr = correlation_matrix(df)
+    assert corr.dtypes.eq("float32").all()
+    assert np.allclose(corr.values, df.corr().values, atol=1e-5, equal_nan=True)
+    df.iloc[0, 0] = np.nan
+    assert correlation_matrix(df).equals(df.corr())
+
+# Test the multi-contrast univariate analysis against separate two-state comparisons
+@pytest.mark.parametrize("contrasts", ["pairwise", "one_vs_rest"])
+def test_compare_contrasts(contrasts):
+    from scipy.stats import kruskal
+
+    rng = np.random.RandomState(0)
+    states = np.repeat(["A", "B", "C"], [15, 20, 25])
+    df = pd.DataFrame(
+        rng.normal(size=(60, 6)) + (states == "C")[:, None], columns=[f"metabolite_{i}" for i in range(6)]
+    )
+    df["metabolite_5"] = rng.exponential(size=60)
+    df.index = pd.MultiIndex.from_arrays([range(60), states], names=["patient_no", "State"])
+
+    results = compare_contrasts(df, "State", pvalue_shapiro=0.05, contrasts=contrasts)
+    assert len(results) == 3 * 6
+    assert set(results.columns) >= {"Contrast", "Feature", "Test", "p-value", "FDR", "Omnibus test", "Omnibus p-value"}
+
+    contrast, group1, group2 = ("A vs B", "A", ["B"]) if contrasts == "pairwise" else ("A vs rest", "A", ["B", "C"])
+    expected = univariate_tests(df[states == group1], df[np.isin(states, group2)], pvalue_shapiro=0.05)
+    observed = results[results["Contrast"] == contrast].set_index("Feature").loc[expected["Feature"]]
+    assert np.allclose(observed["p-value"], expected["p-value"])
+    assert list(observed["Test"]) == list(expected["Test"])
+
+    omnibus = results.drop_duplicates("Feature").set_index("Feature").loc["metabolite_5"]
+    assert omnibus["Omnibus test"] == "Kruskal-Wallis"
+    _, p_value = kruskal(*[df.loc[states == state, "metabolite_5"] for state in ["A", "B", "C"]])
+    assert np.isclose(omnibus["Omnibus p-value"], p_value)
+
+# Test the warm-started regularization path against models fitted from scratch
+def test_regularization_path():
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import StratifiedShuffleSplit, cross_validate
+
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame(rng.normal(size=(60, 5)), columns=[f"metabolite_{i}" for i in range(5)])
+    y = pd.Series((X["metabolite_0"] + rng.normal(scale=0.5, size=60) > 0).astype(int))
+    cv = StratifiedShuffleSplit(n_splits=4, random_state=0)
+    Cs = [0.01, 0.1, 1.0]
+
+    path = regularization_path(LogisticRegression(random_state=0), X, y, list(cv.split(X, y)), Cs, n_jobs=1)
+
+    assert list(path) == Cs
+    for C, results in path.items():
+        expected = cross_validate(LogisticRegression(random_state=0, C=C), X, y, cv=cv, return_estimator=True)
+        assert np.allclose(results["test_score"], expected["test_score"])
+        for estimator, expected_estimator in zip(results["estimator"], expected["estimator"]):
+            assert np.allclose(estimator.coef_, expected_estimator.coef_, atol=1e-3)
+            assert list(estimator.feature_names_in_) == list(X.columns)
+
+# Test the precomputed fold statistics against a scaler fitted on every training set
+def test_fold_standard_scaler():
+    from sklearn.base import clone
+    from sklearn.model_selection import StratifiedShuffleSplit
+    from sklearn.preprocessing import StandardScaler
+
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame(rng.normal(loc=100, size=(40, 4)), columns=[f"metabolite_{i}" for i in range(4)])
+    X["metabolite_3"] = 1.0
+    y = pd.Series(rng.randint(0, 2, size=40))
+    splits = list(StratifiedShuffleSplit(n_splits=5, random_state=0).split(X, y))
+    scaler = FoldStandardScaler(FoldStatistics(X, splits))
+
+    for train, test in splits:
+        fitted = clone(scaler).fit(X.iloc[train])
+        expected = StandardScaler().fit(X.iloc[train])
+        assert np.allclose(fitted.mean_, expected.mean_)
+        assert np.allclose(fitted.scale_, expected.scale_)
+        assert np.allclose(fitted.transform(X.iloc[test]), expected.transform(X.iloc[test]))
+
+    fitted = clone(scaler).fit(X)
+    assert np.allclose(fitted.scale_, StandardScaler().fit(X).scale_)
+
+# Test that tree explanations in batches of folds match explaining every fold alone
+@pytest.mark.parametrize("feature_perturbation", ["tree_path_dependent", "interventional"])
+def test_get_shap_values_rf(feature_perturbation):
+    import shap
+    from sklearn.ensemble import ExtraTreesClassifier
+    from sklearn.model_selection import StratifiedShuffleSplit
+
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame(rng.normal(size=(40, 4)), columns=[f"metabolite_{i}" for i in range(4)])
+    y = pd.Series((X["metabolite_0"] > 0).astype(int))
+    cv = StratifiedShuffleSplit(n_splits=3, random_state=0)
+    splits = list(cv.split(X, y))
+    estimators = [ExtraTreesClassifier(n_estimators=10, random_state=0).fit(X.iloc[train], y.iloc[train]) for train, _ in splits]
+
+    shap_df = get_shap_values(X, y, cv, model_type="rf", estimators=estimators, n_jobs=2, feature_perturbation=feature_perturbation)
+
+    assert shap_df.shape == (sum(len(test) for _, test in splits), 4)
+    train, test = splits[2]
+    background = X.iloc[train].sample(min(100, len(train)), random_state=0) if feature_perturbation == "interventional" else None
+    explainer = shap.TreeExplainer(estimators[2], data=background, feature_perturbation=feature_perturbation)
+    assert np.allclose(shap_df.loc[2], explainer.shap_values(X.iloc[test], check_additivity=False)[1])
+
+    with pytest.raises(ValueError):
+        get_shap_values(X, y, cv, model_type="rf", estimators=estimators, feature_perturbation="interventional", approximate=True)
+
+# Test the closed-form linear SHAP values against the linear explainer
+def test_linear_shap_values():
+    import shap
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import StratifiedShuffleSplit
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from ml_helpers import get_shaps_relative_importance
+
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame(rng.normal(loc=5, size=(40, 4)), columns=[f"metabolite_{i}" for i in range(4)])
+    y = pd.Series((X["metabolite_0"] > 5).astype(int))
+    cv = StratifiedShuffleSplit(n_splits=3, random_state=0)
+    splits = list(cv.split(X, y))
+    estimators = [make_pipeline(StandardScaler(), LogisticRegression()).fit(X.iloc[train], y.iloc[train]) for train, _ in splits]
+
+    shap_folds = get_shap_values(X, y, cv, model_type="linear", estimators=estimators, concatenate=False)
+
+    for estimator, (_, test), fold_shaps in zip(estimators, splits, shap_folds):
+        X_test = estimator[0].transform(X.iloc[test])
+        explainer = shap.LinearExplainer(estimator[-1], masker=shap.maskers.Independent(data=X_test))
+        assert np.allclose(fold_shaps, explainer.shap_values(X_test))
+
+    shap_df = get_shap_values(X, y, cv, model_type="linear", estimators=estimators)
+    pd.testing.assert_frame_equal(get_shaps_relative_importance(shap_folds), get_shaps_relative_importance(shap_df))
+
+    # test sets larger than the 100 background samples of the masker
+    X = pd.DataFrame(rng.normal(loc=5, size=(300, 4)), columns=X.columns)
+    y = pd.Series((X["metabolite_0"] > 5).astype(int))
+    cv = StratifiedShuffleSplit(n_splits=2, test_size=0.5, random_state=0)
+    splits = list(cv.split(X, y))
+    estimators = [make_pipeline(StandardScaler(), LogisticRegression()).fit(X.iloc[train], y.iloc[train]) for train, _ in splits]
+
+    shap_folds = get_shap_values(X, y, cv, model_type="linear", estimators=estimators, concatenate=False)
+
+    for estimator, (_, test), fold_shaps in zip(estimators, splits, shap_folds):
+        X_test = estimator[0].transform(X.iloc[test])
+        explainer = shap.LinearExplainer(estimator[-1], masker=shap.maskers.Independent(data=X_test))
+        assert np.allclose(fold_shaps, explainer.shap_values(X_test))
+
+# Test the batched permutation statistics and the empirical p-values
+def test_permutation_tests():
+    from scipy.stats import mannwhitneyu, rankdata, ttest_ind
+
+    rng = np.random.RandomState(0)
+    group1 = pd.DataFrame(rng.normal(size=(12, 4)), columns=[f"metabolite_{i}" for i in range(4)])
+    group2 = pd.DataFrame(rng.normal(size=(10, 4)), columns=group1.columns)
+    group1["metabolite_0"] += 3
+    group1["metabolite_1"] += 3
+    is_normal = np.array([True, False, True, False])
+
+    data = np.concatenate([group1, group2])
+    in_group1 = (np.arange(22) < 12)[np.newaxis].astype(float)
+    statistics = _permutation_statistics(data[:, is_normal] - data[:, is_normal].mean(axis=0), rankdata(data[:, ~is_normal], axis=0), in_group1)[0]
+    t, _ = ttest_ind(group1.loc[:, is_normal], group2.loc[:, is_normal], axis=0)
+    u, _ = mannwhitneyu(group1.loc[:, ~is_normal], group2.loc[:, ~is_normal], axis=0)
+    assert np.allclose(statistics[:2], np.abs(t))
+    assert np.allclose(statistics[2:], np.abs(u - 60) / np.sqrt(12 * 10 * 23 / 12))
+
+    results = permutation_tests(group1, group2, is_normal, n_permutations=999, chunk_size=250)
+    assert list(results["Feature"]) == list(group1.columns)
+    assert np.allclose(results["Permutation p-value"][:2], 0.001)
+    assert (results["Permutation p-value"][2:] > 0.01).all()
+    assert (results["Min-P p-value"] >= results["Permutation p-value"]).all()
+
+# Test the min-P adjustment of a Mann-Whitney U feature mixed with T-test features
+def test_permutation_tests_min_p():
+    from scipy.stats import mannwhitneyu, ttest_ind
+
+    rng = np.random.RandomState(1)
+    group1 = pd.DataFrame(rng.standard_t(2, size=(6, 5)), columns=[f"metabolite_{i}" for i in range(5)])
+    group2 = pd.DataFrame(rng.standard_t(2, size=(5, 5)), columns=group1.columns)
+    group1["metabolite_4"] += 1.5
+    is_normal = np.array([True, True, True, True, False])
+    data = np.concatenate([group1, group2])
+
+    def min_p(in_group1):
+        _, p_t = ttest_ind(data[in_group1][:, is_normal], data[~in_group1][:, is_normal], axis=0)
+        _, p_u = mannwhitneyu(data[in_group1][:, ~is_normal], data[~in_group1][:, ~is_normal], axis=0, use_continuity=False, method="asymptotic")
+        return np.concatenate([p_t, p_u])
+
+    # the permutations drawn by permutation_tests with its default seed
+    permuted = np.random.default_rng(0).random((200, 11)).argsort(axis=1)[:, :6]
+    null = []
+    for rows in permuted:
+        in_group1 = np.zeros(11, dtype=bool)
+        in_group1[rows] = True
+        null.append(min_p(in_group1).min())
+    observed = min_p(np.arange(11) < 6)[-1]
+    expected = (np.sum(np.array(null) <= observed * (1 + 1e-10)) + 1) / 201
+
+    results = permutation_tests(group1, group2, is_normal, n_permutations=200, chunk_size=64)
+    assert np.isclose(results["Min-P p-value"].iloc[-1], expected)
+
+# Test the rank-based statistics derived from the shared ranks against SciPy
+def test_ranked_matrix():
+    from scipy.stats import mannwhitneyu, spearmanr
+
+    rng = np.random.RandomState(0)
+    values = np.round(rng.normal(size=(30, 5)), 1)
+    in_group1 = np.arange(30) < 12
+    ranked = RankedMatrix(values)
+
+    assert ranked.ranks.dtype == np.float32
+    u, p_values = ranked.mannwhitneyu(in_group1)
+    expected_u, expected_p = mannwhitneyu(values[in_group1], values[~in_group1], axis=0, method="asymptotic")
+    assert np.allclose(u, expected_u)
+    assert np.allclose(p_values, expected_p)
+    assert np.allclose(ranked.rank_biserial(in_group1), 2 * expected_u / (12 * 18) - 1)
+
+    reordered = ranked.take(rows=np.arange(30)[::-1], columns=[0, 2])
+    assert np.allclose(reordered.mannwhitneyu(in_group1[::-1])[1], expected_p[[0, 2]])
+
+    covariates = rng.normal(size=(30, 2))
+    expected_corr = spearmanr(values, covariates).statistic[:5, 5:]
+    assert np.allclose(ranked.spearman(covariates), expected_corr, atol=1e-5)
+    assert np.allclose(correlation_matrix(pd.DataFrame(values), method="spearman"), spearmanr(values).statistic, atol=1e-5)
+
+# Test the effect sizes and their batched bootstrap intervals against direct computations
+def test_effect_sizes():
+    rng = np.random.RandomState(0)
+    group1 = rng.normal(loc=12, size=(15, 3))
+    group2 = rng.normal(loc=10, size=(11, 3))
+
+    sizes = effect_sizes(group1, group2, n_bootstrap=500)
+
+    assert np.allclose(sizes["Fold change"], group1.mean(axis=0) / group2.mean(axis=0))
+    pooled = (14 * group1.var(axis=0, ddof=1) + 10 * group2.var(axis=0, ddof=1)) / 24
+    assert np.allclose(sizes["Cohen's d"], (group1.mean(axis=0) - group2.mean(axis=0)) / np.sqrt(pooled))
+    expected_shift = [np.median(np.subtract.outer(group1[:, i], group2[:, i])) for i in range(3)]
+    assert np.allclose(sizes["Hodges-Lehmann shift"], expected_shift)
+    assert (sizes["Cohen's d CI low"] < sizes["Cohen's d"]).all()
+    assert (sizes["Cohen's d"] < sizes["Cohen's d CI high"]).all()
+    assert (sizes["Fold change CI low"] < sizes["Fold change"]).all()
+    assert (sizes["Fold change"] < sizes["Fold change CI high"]).all()
+
+# Test the nested cross-validation and the split of the CPU budget
+def test_nested_cross_validation():
+    from sklearn.ensemble import ExtraTreesClassifier
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
+
+    assert split_jobs(16, 5) == (5, 3)
+    assert split_jobs(4, 10) == (4, 1)
+    assert split_jobs(16, 5, n_workers=2) == (2, 8)
+
+    rng = np.random.RandomState(0)
+    X = pd.DataFrame(rng.normal(size=(60, 5)), columns=[f"metabolite_{i}" for i in range(5)])
+    y = pd.Series((X["metabolite_0"] > 0).astype(int))
+    models = {
+        "Logistic regression": LogisticRegression(random_state=0),
+        "Random forest": ExtraTreesClassifier(n_estimators=10, random_state=0),
+    }
+    args = Namespace(model_selection="full", n_jobs=2, outer_jobs=0, c_path=0)
+
+    results = nested_cross_validation(
+        models, X, y, StratifiedKFold(n_splits=3, shuffle=True, random_state=0), StratifiedShuffleSplit(n_splits=5, random_state=0), args
+    )
+
+    assert len(results) == 3
+    assert set(results["Selected model"]) <= set(models)
+    assert results["Outer test score"].between(0, 1).all()
+
+# Test the CPU budget read from the arguments or the environment
+def test_parallelism(monkeypatch):
+    monkeypatch.setenv("LOKY_MAX_CPU_COUNT", "1")
+    monkeypatch.setenv("NASQQ_CPUS", "6")
+    from threadpoolctl import threadpool_limits
+
+    parallelism = Parallelism()
+
+    # configure limits the BLAS threads of the process, restored for the other tests
+    with threadpool_limits(limits=None):
+        assert parallelism.configure(0) == 6
+        assert os.environ["LOKY_MAX_CPU_COUNT"] == "6"
+        assert parallelism.split(4) == (4, 1)
+        assert parallelism.split(2) == (2, 3)
+        assert parallelism.configure(2) == 2
+        assert parallelism.split(10, n_workers=4) == (2, 1)